@@ -0,0 +1,194 @@
+import os
+import hmac
+import json
+import time
+import base64
+import socket
+import struct
+import hashlib
+import logging
+import threading
+import socketserver
+from collections import OrderedDict
+
+from config import AGENT_SOCKET, AGENT_KEY_TTL, AGENT_MAX_KEYS
+from encrypt import derive_key
+
+logger = logging.getLogger(__name__)
+
+
+def get_socket_path() -> str:
+    """Socket path of the agent, ENCRYPT_AGENT_SOCK overrides the default."""
+    return os.path.expanduser(os.environ.get("ENCRYPT_AGENT_SOCK", AGENT_SOCKET))
+
+
+class KeyCache:
+    """LRU cache of derived keys with a TTL, keyed by (salt, password tag).
+
+    Passwords are never stored, only an HMAC of them under a per-agent secret.
+    """
+
+    def __init__(self, ttl: float = AGENT_KEY_TTL, max_keys: int = AGENT_MAX_KEYS):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.__secret = os.urandom(32)
+        self.__keys = OrderedDict()  # (salt, tag) -> (key, expires_at)
+        self.__salts = {}  # tag -> salt of the last key derived for encryption
+        self.__lock = threading.Lock()
+
+    def __tag(self, pwd: str) -> bytes:
+        return hmac.new(self.__secret, pwd.encode(), hashlib.sha256).digest()
+
+    def __evict(self, now: float):
+        for entry, (_, expires_at) in list(self.__keys.items()):
+            if expires_at <= now:
+                del self.__keys[entry]
+        while len(self.__keys) > self.max_keys:
+            self.__keys.popitem(last=False)
+        live = {salt for salt, _ in self.__keys}
+        self.__salts = {t: s for t, s in self.__salts.items() if s in live}
+
+    def get(self, pwd: str, salt: bytes | None) -> tuple[bytes, bytes]:
+        """Returns (key, salt), deriving the key only on a cache miss.
+
+        Without a salt (encryption) the salt of the last cached key for this
+        password is reused, so a whole session pays PBKDF2 once.
+        """
+        tag = self.__tag(pwd)
+        with self.__lock:
+            now = time.monotonic()
+            self.__evict(now)
+            if salt is None:
+                salt = self.__salts.get(tag)
+            cached = self.__keys.get((salt, tag)) if salt else None
+            if cached:
+                self.__keys.move_to_end((salt, tag))
+                self.__keys[(salt, tag)] = (cached[0], now + self.ttl)
+                return cached[0], salt
+
+        # derive outside the lock so one slow KDF does not block other clients
+        salt = salt or os.urandom(16)
+        key = derive_key(pwd, salt)
+        with self.__lock:
+            self.__keys[(salt, tag)] = (key, time.monotonic() + self.ttl)
+            self.__salts[tag] = salt
+            self.__evict(time.monotonic())
+        return key, salt
+
+    def clear(self):
+        with self.__lock:
+            self.__keys.clear()
+            self.__salts.clear()
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+    """Handles one JSON request per line: {"op": "derive" | "clear", ...}"""
+
+    def handle(self):
+        if not self.__is_same_user():
+            logger.warning("Rejected agent connection from another user")
+            return
+
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                response = self.__dispatch(request)
+            except Exception as e:
+                response = {"ok": False, "error": str(e)}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+
+    def __is_same_user(self) -> bool:
+        # socket dir is 0700 anyway, SO_PEERCRED is an extra check where available
+        if not hasattr(socket, "SO_PEERCRED"):
+            return True
+        creds = self.request.getsockopt(
+            socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+        )
+        _, uid, _ = struct.unpack("3i", creds)
+        return uid == os.getuid()
+
+    def __dispatch(self, request: dict) -> dict:
+        op = request.get("op")
+        if op == "derive":
+            salt = request.get("salt")
+            key, salt = self.server.cache.get(
+                request["pwd"], base64.b64decode(salt) if salt else None
+            )
+            return {
+                "ok": True,
+                "key": base64.b64encode(key).decode(),
+                "salt": base64.b64encode(salt).decode(),
+            }
+        if op == "clear":
+            self.server.cache.clear()
+            return {"ok": True}
+        raise ValueError(f"Unknown op: {op}")
+
+
+class KeyAgent(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str = None):
+        self.socket_path = socket_path or get_socket_path()
+        self.cache = KeyCache()
+
+        socket_dir = os.path.dirname(self.socket_path)
+        os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+        os.chmod(socket_dir, 0o700)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        # restrict permissions before the socket file is created
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(self.socket_path, AgentHandler)
+        finally:
+            os.umask(old_umask)
+
+    def run(self):
+        print(f"Key agent listening on {self.socket_path}")
+        print(f"export ENCRYPT_AGENT_SOCK={self.socket_path}")
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server_close()
+            os.remove(self.socket_path)
+
+
+class AgentClient:
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+
+    @classmethod
+    def from_env(cls):
+        """Returns a client if an agent socket exists, otherwise None."""
+        socket_path = get_socket_path()
+        if not hasattr(socket, "AF_UNIX") or not os.path.exists(socket_path):
+            return None
+        return cls(socket_path)
+
+    def __request(self, request: dict) -> dict:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.socket_path)
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            with sock.makefile("rb") as f:
+                response = json.loads(f.readline())
+        if not response.get("ok"):
+            raise RuntimeError(response.get("error", "agent request failed"))
+        return response
+
+    def derive(self, pwd: str, salt: bytes | None = None) -> tuple[bytes, bytes]:
+        """Gets the key for pwd and salt, a new or cached salt if salt is None."""
+        response = self.__request(
+            {
+                "op": "derive",
+                "pwd": pwd,
+                "salt": base64.b64encode(salt).decode() if salt else None,
+            }
+        )
+        return base64.b64decode(response["key"]), base64.b64decode(response["salt"])
+
+    def clear(self):
+        self.__request({"op": "clear"})
@@ -0,0 +1,180 @@
+"""Benchmarks for the encryption tool, run from the project root:
+
+    python src/benchmark.py scan <folder> [--create N]
+    python src/benchmark.py io <file> [--size-mb N]
+"""
+
+import os
+import sys
+import json
+import heapq
+import time
+import argparse
+import statistics
+import subprocess
+
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, modes
+from cryptography.hazmat.primitives.ciphers.algorithms import AES
+
+import scanner
+import encrypt
+
+try:
+    import resource
+except ImportError:
+    # Unix only, peak memory is not reported elsewhere
+    resource = None
+
+
+def _create_tree(root: str, n_files: int, per_dir: int = 1000):
+    """Creates n_files small files of varying size, per_dir files per folder."""
+    for i in range(n_files):
+        d = os.path.join(root, str(i // per_dir // 100), str(i // per_dir))
+        if i % per_dir == 0:
+            os.makedirs(d, exist_ok=True)
+        with open(os.path.join(d, f"{i}.txt"), "wb") as f:
+            f.write(b"x" * (i * 7919 % 4096))
+
+
+def _walk_baseline(root: str) -> int:
+    """The old os.walk + join + relpath traversal of __create_zip_archive."""
+    count = 0
+    for r, _, files in os.walk(root):
+        for file in files:
+            file_path = os.path.join(r, file)
+            os.path.relpath(file_path, root)
+            os.path.getsize(file_path)
+            count += 1
+    return count
+
+
+def _pool_tail(sizes: list[int], workers: int) -> float:
+    """Time the last worker runs alone, relative to a perfectly even split.
+
+    Models a pool taking tasks in the given order with cost proportional to size.
+    """
+    loads = [0] * workers
+    for size in sizes:
+        heapq.heapreplace(loads, loads[0] + size)
+    ideal = sum(sizes) / workers
+    return (max(loads) - ideal) / ideal if ideal else 0.0
+
+
+def bench_scan(root: str, create: int):
+    if create:
+        print(f"Creating {create} files in {root} ...")
+        _create_tree(root, create)
+
+    start = time.perf_counter()
+    count = _walk_baseline(root)
+    print(f"os.walk + relpath + getsize: {count} files in {time.perf_counter() - start:.2f}s")
+
+    # per directory latency, to see the tail of slow directories
+    latencies = []
+    original = scanner._scan_dir
+
+    def timed_scan_dir(path, prefix):
+        t = time.perf_counter()
+        result = original(path, prefix)
+        latencies.append(time.perf_counter() - t)
+        return result
+
+    scanner._scan_dir = timed_scan_dir
+    try:
+        for workers in (1, 4, 16, 32):
+            latencies.clear()
+            start = time.perf_counter()
+            entries = scanner.scan_tree(root, workers=workers)
+            elapsed = time.perf_counter() - start
+            q = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [0] * 99
+            print(
+                f"scan_tree workers={workers:2}: {len(entries)} files in {elapsed:.2f}s, "
+                f"per dir p50={q[49] * 1e3:.2f}ms p99={q[98] * 1e3:.2f}ms "
+                f"max={max(latencies) * 1e3:.2f}ms"
+            )
+    finally:
+        scanner._scan_dir = original
+
+    sizes = [e.size for e in entries]
+    workers = os.cpu_count() or 1
+    by_path = [e.size for e in sorted(entries, key=lambda e: e.rel_path)]
+    print(
+        f"pool tail with {workers} workers: directory order "
+        f"{_pool_tail(by_path, workers):.1%}, largest first {_pool_tail(sizes, workers):.1%}"
+    )
+
+
+def _encrypt_once(path: str, mode: str) -> dict:
+    """Encrypts path in one mode and discards the output, run in a fresh process."""
+    key, iv = os.urandom(32), os.urandom(16)
+    encryptor = Cipher(AES(key), modes.CBC(iv)).encryptor()
+    padder = padding.PKCS7(AES.block_size).padder()
+    out = 0
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        if mode == "read":
+            # the old path: whole file in the heap, padded copy, ciphertext copy
+            data = padder.update(f.read()) + padder.finalize()
+            out += len(encryptor.update(data) + encryptor.finalize())
+        else:
+            for chunk in encrypt._read_chunks(f, use_mmap=mode == "mmap"):
+                out += len(encryptor.update(padder.update(chunk)))
+            out += len(encryptor.update(padder.finalize()) + encryptor.finalize())
+    elapsed = time.perf_counter() - start
+    rss_mb = None
+    if resource:
+        # ru_maxrss is KiB on Linux, bytes on macOS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        rss_mb = rss / (1 << 20) if sys.platform == "darwin" else rss / 1024
+    return {"mode": mode, "seconds": elapsed, "bytes": out, "peak_rss_mb": rss_mb}
+
+
+def bench_io(path: str, size_mb: int):
+    if size_mb:
+        print(f"Creating {size_mb} MB test file {path} ...")
+        with open(path, "wb") as f:
+            for _ in range(size_mb):
+                f.write(os.urandom(1 << 20))
+
+    size = os.path.getsize(path)
+    for mode in ("read", "buffered", "mmap"):
+        result = json.loads(
+            subprocess.check_output(
+                [sys.executable, __file__, "io-run", path, mode], text=True
+            )
+        )
+        rss = result["peak_rss_mb"]
+        print(
+            f"{mode:8}: {size / (1 << 20) / result['seconds']:8.1f} MB/s, "
+            f"peak RSS {f'{rss:8.1f} MB' if rss is not None else 'n/a'}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    scan = sub.add_parser("scan", help="directory scanning and scheduling")
+    scan.add_argument("folder")
+    scan.add_argument("--create", type=int, default=0, help="create N files first")
+
+    io = sub.add_parser("io", help="read-all vs buffered vs mmap encryption")
+    io.add_argument("file")
+    io.add_argument("--size-mb", type=int, default=0, help="create the file first")
+
+    io_run = sub.add_parser("io-run")  # internal, one measurement per process
+    io_run.add_argument("file")
+    io_run.add_argument("mode", choices=("read", "buffered", "mmap"))
+
+    args = parser.parse_args()
+    if args.command == "scan":
+        bench_scan(args.folder, args.create)
+    elif args.command == "io":
+        bench_io(args.file, args.size_mb)
+    elif args.command == "io-run":
+        print(json.dumps(_encrypt_once(args.file, args.mode)))
+
+
+if __name__ == "__main__":
+    main()
@@ -64,6 +64,23 @@ class CLIManager:
             else:
                 print("Invalid choice, please try again")
                 
+        valid = False
+        while not valid and running_conf.encrypt:
+            print("Single encrypted archive (1) or encrypted file per file (2)?")
+            mode_choice = input(">> ").strip()
+            if mode_choice == "1":
+                running_conf.mirror_tree = False
+                valid = True
+            elif mode_choice == "2":
+                running_conf.mirror_tree = True
+                valid = True
+            elif mode_choice == "help":
+                self.handle_help()
+            elif mode_choice == "exit":
+                exit()
+            else:
+                print("Invalid choice, please try again")
+
         valid = False
         while not valid:
             print(f"Enter the key")
@@ -90,4 +107,5 @@ class Config:
         self.path = None
         self.key = None
         self.keep_folder = None
+        self.mirror_tree = False # True to encrypt every file on its own
         
\ No newline at end of file
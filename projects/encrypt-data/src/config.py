@@ -1,2 +1,23 @@
 # required length of key
-KEY_LEN = 16
\ No newline at end of file
+KEY_LEN = 16
+
+# key agent: keeps derived keys in memory so repeated runs skip PBKDF2
+AGENT_SOCKET = "~/.encrypt-agent/agent.sock"
+# seconds a derived key stays cached after its last use
+AGENT_KEY_TTL = 15 * 60
+# maximum number of cached keys, least recently used ones are evicted first
+AGENT_MAX_KEYS = 64
+
+# suffix of the per-file encrypted mirror tree directory
+TREE_SUFFIX = ".encdir"
+
+# files are read in chunks of this size instead of at once, the authenticated
+# suites seal fixed size chunks of their own (SEALED_CHUNK_SIZE in suites.py)
+CHUNK_SIZE = 4 * 1024 * 1024
+# files of at least this size are memory mapped instead of read
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+# cipher suite used when no calibration is available (see suites.py)
+DEFAULT_SUITE = "aes-256-gcm"
+# result of `main.py calibrate`, the fastest authenticated suite on this host
+SUITE_FILE = "~/.config/encrypt-data/suite.json"
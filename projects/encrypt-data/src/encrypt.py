@@ -1,15 +1,21 @@
 import os
+import hmac
+import mmap
+import json
 import zipfile
 import hashlib
 import logging
-from cryptography.hazmat.primitives.ciphers.algorithms import AES
-from cryptography.hazmat.primitives.ciphers import modes, Cipher
-from cryptography.hazmat.primitives import padding
+from concurrent.futures import ProcessPoolExecutor
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import hashes
 import shutil
 from pathlib import Path
 
+from config import TREE_SUFFIX, CHUNK_SIZE, MMAP_THRESHOLD
+from scanner import scan_tree
+from suites import CipherSuite, MAGIC, SUITES, SUITES_BY_ID, default_suite
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(name)s: %(asctime)s [%(levelname)s] [%(funcName)s] %(message)s",
@@ -21,9 +27,131 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+def derive_key(pwd: str, salt: bytes) -> bytes:
+    """Derives a 32 byte key from a password using PBKDF2."""
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt,
+        iterations=100000,
+    )
+    return kdf.derive(pwd.encode())
+
+
+def _read_chunks(
+    f, offset: int = 0, chunk_size: int = None, use_mmap: bool = None
+):
+    """Yields the file from offset on in chunk_size (default CHUNK_SIZE) pieces.
+
+    Large files are memory mapped and yielded as zero-copy memoryview slices,
+    small files (or where mmap is not available) use buffered reads.
+    """
+    chunk_size = chunk_size or CHUNK_SIZE
+    size = os.fstat(f.fileno()).st_size
+    if use_mmap is None:
+        use_mmap = size >= MMAP_THRESHOLD
+    if use_mmap and size > offset:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            mapped = None
+        if mapped is not None:
+            with mapped, memoryview(mapped) as view:
+                for start in range(offset, size, chunk_size):
+                    # slices must be released before the map can be closed
+                    with view[start : start + chunk_size] as chunk:
+                        yield chunk
+            return
+
+    f.seek(offset)
+    while chunk := f.read(chunk_size):
+        yield chunk
+
+
+def _name_key(key: bytes) -> bytes:
+    """Separate key for object names, so the encryption key is only used by the cipher suite."""
+    return HKDF(
+        algorithm=hashes.SHA256(), length=32, salt=None, info=b"encrypt-data tree names"
+    ).derive(key)
+
+
+def _object_name(name_key: bytes, rel_path: str) -> str:
+    """Obfuscated, deterministic file name of a tree object."""
+    return hmac.new(name_key, b"name:" + rel_path.encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def _restore_path(folder: Path, rel_path: str) -> Path:
+    """Target of an index entry, raises ValueError if it would leave the folder."""
+    path = Path(rel_path)
+    if path.is_absolute() or ".." in path.parts:
+        raise ValueError(f"Unsafe path in index: {rel_path}")
+    target = (folder / path).resolve()
+    if not target.is_relative_to(folder.resolve()):
+        raise ValueError(f"Unsafe path in index: {rel_path}")
+    return target
+
+
+def _object_ad(rel_path: str, name: str) -> bytes:
+    """Associated data of a tree object, so an object swapped with another or
+    moved to another path fails to decrypt."""
+    return json.dumps([rel_path, name]).encode()
+
+
+def _write_sealed(
+    dst, suite: CipherSuite, key: bytes, prefix: bytes, chunks, size: int, ad: bytes = b""
+):
+    """Writes prefix, a suite header (MAGIC, suite id, nonce) and the sealed
+    chunks. Everything before the chunks and ad is the associated data."""
+    nonce = os.urandom(suite.nonce_size)
+    header = prefix + MAGIC + bytes([suite.suite_id]) + nonce
+    dst.write(header)
+    for data in suite.encrypt(key, nonce, header + ad, chunks, size):
+        dst.write(data)
+
+
+def _read_sealed(src, key: bytes, prefix: bytes = b"", ad: bytes = b""):
+    """Decrypted chunks of what _write_sealed wrote, src is positioned after prefix."""
+    if src.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not sealed with a cipher suite")
+    suite = SUITES_BY_ID[src.read(1)[0]]
+    if not suite.authenticated:
+        raise ValueError(f"{suite.name} is not authenticated")
+    nonce = src.read(suite.nonce_size)
+    header = prefix + MAGIC + bytes([suite.suite_id]) + nonce
+    offset = src.tell()
+    size = os.fstat(src.fileno()).st_size - offset
+    chunks = _read_chunks(src, offset, suite.chunk_size + suite.overhead)
+    return suite.decrypt(key, nonce, header + ad, chunks, size)
+
+
+def _encrypt_object(src: str, dst: str, key: bytes, suite: CipherSuite, rel_path: str):
+    # module level so it can run in a worker process
+    with open(src, "rb") as f, open(dst, "wb") as out:
+        size = os.fstat(f.fileno()).st_size
+        chunks = _read_chunks(f, chunk_size=suite.chunk_size)
+        _write_sealed(out, suite, key, b"", chunks, size, _object_ad(rel_path, os.path.basename(dst)))
+
+
+def _decrypt_object(src: str, dst: str, key: bytes, rel_path: str):
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    with open(src, "rb") as f:
+        chunks = _read_sealed(f, key, ad=_object_ad(rel_path, os.path.basename(src)))
+        try:
+            with open(dst, "wb") as out:
+                for data in chunks:
+                    out.write(data)
+        except Exception:
+            # chunks before a modified one were written already
+            os.remove(dst)
+            raise
+
+
 class Encryptor:
-    def __init__(self):
-        pass
+    def __init__(self, agent=None, suite: str = None):
+        # optional AgentClient, caches derived keys across runs
+        self.agent = agent
+        # cipher suite for new archives, None for the calibrated default
+        self.suite_name = suite
 
     def compress_and_encrypt(self, folder_path: str, pwd: str, delete_original: bool):
         zip_file_path = self.__create_zip_archive(folder_path)
@@ -32,11 +160,13 @@ class Encryptor:
             logger.error("ZIP archive creation failed. Aborting encryption.")
             return
 
-        # Generate key, iv, and salt
-        key, iv, salt = self.__generate_key(pwd, os.urandom(16), os.urandom(16))
+        suite = SUITES[self.suite_name] if self.suite_name else default_suite()
+
+        # Generate key, iv, and salt (the agent may hand out a cached salt)
+        key, iv, salt = self.__generate_key(pwd, None, os.urandom(suite.nonce_size))
 
         # Pass all three to encrypt_file
-        self.__encrypt_file(zip_file_path, key, iv, salt)
+        self.__encrypt_file(zip_file_path, key, iv, salt, suite)
 
         if delete_original:
             shutil.rmtree(folder_path)
@@ -71,17 +201,103 @@ class Encryptor:
             # logger.error("Decryption operation failed")
             return False
 
-    def __pad(self, data: bytes) -> bytes:
-        """Pads the data using PKCS7 padding."""
-        padder = padding.PKCS7(AES.block_size).padder()
-        padded_data = padder.update(data) + padder.finalize()
-        return padded_data
+    def encrypt_tree(self, folder_path: str, pwd: str, delete_original: bool):
+        """Encrypts every file on its own into an encrypted mirror of the folder.
+
+        Layout of <folder>.encdir:
+            index.enc       salt + suite header + sealed JSON {relative path: object name}
+            objects/<name>  suite header + sealed file, name is an HMAC of the path
+
+        Both are sealed with an authenticated suite, objects with their
+        relative path and name as associated data.
+        """
+        suite = SUITES[self.suite_name] if self.suite_name else default_suite()
+        if not suite.authenticated:
+            raise ValueError(f"Mirror trees need an authenticated cipher suite, not {suite.name}")
+
+        folder_path = Path(folder_path)
+        tree_path = folder_path.parent / f"{folder_path.name}{TREE_SUFFIX}"
+        objects_path = tree_path / "objects"
+        objects_path.mkdir(parents=True, exist_ok=True)
+
+        key, _, salt = self.__generate_key(pwd, None, b"")
+        name_key = _name_key(key)
+
+        index = {}
+        with ProcessPoolExecutor() as pool:
+            futures = []
+            # largest files are submitted first so the pool drains evenly
+            for entry in scan_tree(folder_path):
+                name = _object_name(name_key, entry.rel_path)
+                index[entry.rel_path] = name
+                futures.append(
+                    pool.submit(
+                        _encrypt_object, entry.path, str(objects_path / name), key, suite, entry.rel_path
+                    )
+                )
+            for future in futures:
+                future.result()
+
+        data = json.dumps({"files": index}).encode()
+        chunks = (data[i : i + suite.chunk_size] for i in range(0, len(data), suite.chunk_size))
+        with open(tree_path / "index.enc", "wb") as f:
+            _write_sealed(f, suite, key, salt, chunks, len(data))
+
+        logger.info(f"Encrypted {len(index)} files into {tree_path}")
+        if delete_original:
+            shutil.rmtree(folder_path)
+        return str(tree_path)
+
+    def decrypt_tree(self, tree_path: str, pwd: str) -> bool:
+        """Restores the folder from an encrypted mirror tree."""
+        try:
+            tree_path = Path(tree_path)
+            with open(tree_path / "index.enc", "rb") as f:
+                salt = f.read(16)
+                key, _, _ = self.__generate_key(pwd, salt, b"")
+                index = json.loads(b"".join(_read_sealed(f, key, salt)))["files"]
+
+            folder_path = tree_path.parent / tree_path.name.removesuffix(TREE_SUFFIX)
+            # every path is checked before anything is written
+            targets = {rel_path: _restore_path(folder_path, rel_path) for rel_path in index}
+            with ProcessPoolExecutor() as pool:
+                futures = [
+                    pool.submit(
+                        _decrypt_object,
+                        str(tree_path / "objects" / Path(name).name),
+                        str(targets[rel_path]),
+                        key,
+                        rel_path,
+                    )
+                    for rel_path, name in index.items()
+                ]
+                for future in futures:
+                    future.result()
+            return True
+        except Exception as e:
+            logger.error(f"Error decrypting tree: {e}")
+            return False
+
+    def decrypt_tree_file(
+        self, tree_path: str, rel_path: str, pwd: str, out_path: str
+    ) -> bool:
+        """Decrypts a single file of a mirror tree, without reading the index.
 
-    def __unpad(self, data: bytes) -> bytes:
-        """Removes PKCS7 padding from the data."""
-        unpadder = padding.PKCS7(AES.block_size).unpadder()
-        unpadded_data = unpadder.update(data) + unpadder.finalize()
-        return unpadded_data
+        Only the salt at the start of index.enc is needed, the object name is
+        recomputed from the relative path.
+        """
+        try:
+            tree_path = Path(tree_path)
+            with open(tree_path / "index.enc", "rb") as f:
+                salt = f.read(16)
+            key, _, _ = self.__generate_key(pwd, salt, b"")
+            rel_path = Path(rel_path).as_posix()
+            name = _object_name(_name_key(key), rel_path)
+            _decrypt_object(str(tree_path / "objects" / name), out_path, key, rel_path)
+            return True
+        except Exception:
+            logger.error(f"Error decrypting {rel_path}")
+            return False
 
     def __create_zip_archive(self, folder_path: str):
         """Compress folder into a zip file"""
@@ -90,13 +306,8 @@ class Encryptor:
 
         try:
             with zipfile.ZipFile(zip_file_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-                for root, _, files in os.walk(folder_path):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        zipf.write(
-                            file_path,
-                            os.path.relpath(file_path, folder_path),
-                        )
+                for entry in scan_tree(folder_path):
+                    zipf.write(entry.path, entry.rel_path)
             logger.info(f"Created ZIP archive at {zip_file_path}")
             return str(zip_file_path)
         except Exception:
@@ -104,36 +315,38 @@ class Encryptor:
             return None
 
     def __generate_key(
-        self, pwd: str, salt: bytes, iv: bytes
+        self, pwd: str, salt: bytes | None, iv: bytes
     ) -> tuple[bytes, bytes, bytes]:
         """Generates a key, IV, and salt from a password using PBKDF2."""
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=salt,
-            iterations=100000,
-        )
+        if self.agent:
+            try:
+                key, salt = self.agent.derive(pwd, salt)
+                return key, iv, salt
+            except Exception:
+                logger.warning("Key agent not reachable, deriving key locally")
 
-        key = kdf.derive(pwd.encode())
+        salt = salt or os.urandom(16)
+        key = derive_key(pwd, salt)
 
         return key, iv, salt
 
-    def __encrypt_file(self, file_path: str, key: bytes, iv: bytes, salt: bytes):
+    def __encrypt_file(
+        self, file_path: str, key: bytes, iv: bytes, salt: bytes, suite: CipherSuite
+    ):
         encrypted_file_path = file_path + ".enc"
         try:
-            with open(file_path, "rb") as file:
-                data = file.read()
-                cipher = Cipher(AES(key), modes.CBC(iv))
-                encryptor = cipher.encryptor()
-                padded_data = self.__pad(data)
-                encrypted_data = encryptor.update(padded_data) + encryptor.finalize()
+            # header: magic, suite id, salt and nonce, authenticated by AEAD suites
+            header = MAGIC + bytes([suite.suite_id]) + salt + iv
 
-            # Write salt and IV at the beginning of the file, first bytes
-            with open(encrypted_file_path, "wb") as file:
-                file.write(salt + iv + encrypted_data)
+            with open(file_path, "rb") as src, open(encrypted_file_path, "wb") as dst:
+                dst.write(header)
+                size = os.fstat(src.fileno()).st_size
+                chunks = _read_chunks(src, chunk_size=suite.chunk_size)
+                for data in suite.encrypt(key, iv, header, chunks, size):
+                    dst.write(data)
 
             os.remove(file_path)
-            logger.info(f"Encrypted file saved at {encrypted_file_path}")
+            logger.info(f"Encrypted file saved at {encrypted_file_path} ({suite.name})")
             return encrypted_file_path
         except Exception:
             logger.error("Error encrypting file")
@@ -142,26 +355,32 @@ class Encryptor:
     def __decrypt_file(self, file_path: str, pwd: str) -> str:
         decrypted_zip_path = file_path[:-4]  # Remove .enc extension
         try:
-            with open(file_path, "rb") as f:
-                data = f.read()
-
-                salt = data[:16]
-                iv = data[16:32]
-                encrypted_data = data[32:]
+            with open(file_path, "rb") as src, open(decrypted_zip_path, "wb") as dst:
+                if src.read(len(MAGIC)) == MAGIC:
+                    suite = SUITES_BY_ID[src.read(1)[0]]
+                    salt = src.read(16)
+                    iv = src.read(suite.nonce_size)
+                    header = MAGIC + bytes([suite.suite_id]) + salt + iv
+                else:
+                    # archives from before cipher suites: salt + iv, AES-CBC
+                    suite = SUITES["aes-256-cbc"]
+                    src.seek(0)
+                    salt = src.read(16)
+                    iv = src.read(16)
+                    header = b""
+                offset = src.tell()
 
                 key, _, _ = self.__generate_key(pwd, salt, iv)
 
-                cipher = Cipher(AES(key), modes.CBC(iv))
-                decryptor = cipher.decryptor()
-                decrypted_padded_data = (
-                    decryptor.update(encrypted_data) + decryptor.finalize()
-                )
-                unpadded_data = self.__unpad(decrypted_padded_data)
-
-            with open(decrypted_zip_path, "wb") as f:
-                f.write(unpadded_data)
+                size = os.fstat(src.fileno()).st_size - offset
+                chunks = _read_chunks(src, offset, (suite.chunk_size or CHUNK_SIZE) + suite.overhead)
+                for data in suite.decrypt(key, iv, header, chunks, size):
+                    dst.write(data)
 
-            logger.info(f"Decrypted file saved at {decrypted_zip_path}")
+            logger.info(f"Decrypted file saved at {decrypted_zip_path} ({suite.name})")
             return decrypted_zip_path
         except Exception as e:
-            raise e
\ No newline at end of file
+            # wrong key or corrupted file, don't leave a half written zip behind
+            if os.path.exists(decrypted_zip_path):
+                os.remove(decrypted_zip_path)
+            raise e
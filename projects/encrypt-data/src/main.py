@@ -1,21 +1,63 @@
+import os
+import sys
+import socket
+
 from cli import CLIManager, Config
 from encrypt import Encryptor
+from config import TREE_SUFFIX
+from suites import calibrate, default_suite
+
+
+def agent_client():
+    """Client of a running key agent, None without one or without UNIX sockets.
+
+    agent.py needs AF_UNIX, so it is only imported where that exists.
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    from agent import AgentClient
+
+    return AgentClient.from_env()
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "agent":
+        if not hasattr(socket, "AF_UNIX"):
+            print("The key agent needs UNIX domain sockets, which this platform does not have")
+            return
+        from agent import KeyAgent
+
+        KeyAgent().run()
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "calibrate":
+        for name, speed in calibrate().items():
+            print(f"{name}: {speed:.0f} MB/s")
+        print(f"Using {default_suite().name} for new archives")
+        return
+
     cli = CLIManager()
     config: Config = cli.get_information()
-    enc = Encryptor()
+    enc = Encryptor(agent=agent_client())
 
     result = True
 #- 
-    if config.encrypt:
+    if config.encrypt and config.mirror_tree:
+        enc.encrypt_tree(
+            folder_path=config.path,
+            pwd=config.key,
+            delete_original=not config.keep_folder,
+        )
+
+    elif config.encrypt:
         enc.compress_and_encrypt(
             folder_path=config.path,
             pwd=config.key,
             delete_original=not config.keep_folder,
         )
 
+    elif os.path.isdir(config.path) and config.path.rstrip("/").endswith(TREE_SUFFIX):
+        result = enc.decrypt_tree(tree_path=config.path.rstrip("/"), pwd=config.key)
+
     else:
         result = enc.decrypt_and_uncompress(file_path=config.path, pwd=config.key)
 
@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import struct
+import logging
+from typing import Iterable, Iterator
+
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, modes
+from cryptography.hazmat.primitives.ciphers.algorithms import AES
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+
+from config import DEFAULT_SUITE, SUITE_FILE
+
+logger = logging.getLogger(__name__)
+
+# archives written with a suite start with MAGIC + suite id, legacy archives
+# (AES-CBC only) start directly with the salt
+MAGIC = b"ENCS"
+# plaintext bytes per sealed chunk of the AEAD suites. Decryption finds the
+# chunk boundaries with it, so it is part of the archive format and unlike
+# config.CHUNK_SIZE (the read buffer) must not change.
+SEALED_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class CipherSuite:
+    """Base class of a cipher suite, encrypts and decrypts chunk streams."""
+
+    name = ""
+    suite_id = 0
+    nonce_size = 16
+    authenticated = False
+    # plaintext bytes per chunk passed to encrypt(), None if any size works
+    chunk_size = None
+    # bytes added to every chunk of chunk_size plaintext bytes
+    overhead = 0
+
+    def encrypt(
+        self, key: bytes, nonce: bytes, header: bytes, chunks: Iterable, size: int
+    ) -> Iterator[bytes]:
+        raise NotImplementedError
+
+    def decrypt(
+        self, key: bytes, nonce: bytes, header: bytes, chunks: Iterable, size: int
+    ) -> Iterator[bytes]:
+        raise NotImplementedError
+
+
+class AesCbcSuite(CipherSuite):
+    """The original AES-256-CBC with PKCS7 padding, not authenticated."""
+
+    name = "aes-256-cbc"
+    suite_id = 1
+
+    def encrypt(self, key, nonce, header, chunks, size):
+        encryptor = Cipher(AES(key), modes.CBC(nonce)).encryptor()
+        padder = padding.PKCS7(AES.block_size).padder()
+        for chunk in chunks:
+            yield encryptor.update(padder.update(chunk))
+        yield encryptor.update(padder.finalize()) + encryptor.finalize()
+
+    def decrypt(self, key, nonce, header, chunks, size):
+        decryptor = Cipher(AES(key), modes.CBC(nonce)).decryptor()
+        unpadder = padding.PKCS7(AES.block_size).unpadder()
+        for chunk in chunks:
+            yield unpadder.update(decryptor.update(chunk))
+        yield unpadder.update(decryptor.finalize()) + unpadder.finalize()
+
+
+class AeadSuite(CipherSuite):
+    """Chunked AEAD (STREAM construction).
+
+    Every chunk is sealed on its own with the nonce
+        nonce prefix (7 bytes) | chunk counter (4 bytes) | last chunk flag (1 byte)
+    and the archive header as associated data, so reordered, truncated or
+    extended archives and a changed suite id fail to decrypt.
+    """
+
+    aead = None
+    nonce_size = 7
+    authenticated = True
+    chunk_size = SEALED_CHUNK_SIZE
+    overhead = 16
+
+    def __nonce(self, prefix: bytes, counter: int, last: bool) -> bytes:
+        return prefix + struct.pack(">IB", counter, last)
+
+    def encrypt(self, key, nonce, header, chunks, size):
+        aead = self.aead(key)
+        last_chunk = max(0, (size - 1) // self.chunk_size)
+        counter = -1
+        for counter, chunk in enumerate(chunks):
+            yield aead.encrypt(
+                self.__nonce(nonce, counter, counter == last_chunk), chunk, header
+            )
+        if counter == -1:  # empty input still gets a (last) chunk
+            yield aead.encrypt(self.__nonce(nonce, 0, True), b"", header)
+
+    def decrypt(self, key, nonce, header, chunks, size):
+        aead = self.aead(key)
+        last_chunk = max(0, (size - 1) // (self.chunk_size + self.overhead))
+        counter = -1
+        for counter, chunk in enumerate(chunks):
+            yield aead.decrypt(
+                self.__nonce(nonce, counter, counter == last_chunk), chunk, header
+            )
+        if counter == -1:  # even empty input has one chunk, so this was cut off
+            raise ValueError("Archive is truncated")
+
+
+class AesGcmSuite(AeadSuite):
+    name = "aes-256-gcm"
+    suite_id = 2
+    aead = AESGCM
+
+
+class ChaChaSuite(AeadSuite):
+    name = "chacha20-poly1305"
+    suite_id = 3
+    aead = ChaCha20Poly1305
+
+
+SUITES: dict[str, CipherSuite] = {}
+SUITES_BY_ID: dict[int, CipherSuite] = {}
+
+
+def register_suite(suite: CipherSuite):
+    SUITES[suite.name] = suite
+    SUITES_BY_ID[suite.suite_id] = suite
+
+
+for _suite in (AesCbcSuite(), AesGcmSuite(), ChaChaSuite()):
+    register_suite(_suite)
+
+
+def calibrate(size: int = 16 * 1024 * 1024) -> dict[str, float]:
+    """Measures MB/s of every authenticated suite on this host and saves the fastest."""
+    key, data = os.urandom(32), os.urandom(SEALED_CHUNK_SIZE)
+    chunks = [data] * max(1, size // SEALED_CHUNK_SIZE)
+    results = {}
+    for suite in SUITES.values():
+        if not suite.authenticated:
+            continue
+        nonce = os.urandom(suite.nonce_size)
+        start = time.perf_counter()
+        for _ in suite.encrypt(key, nonce, MAGIC, chunks, len(chunks) * SEALED_CHUNK_SIZE):
+            pass
+        results[suite.name] = len(chunks) * SEALED_CHUNK_SIZE / (1 << 20) / (
+            time.perf_counter() - start
+        )
+
+    fastest = max(results, key=results.get)
+    path = os.path.expanduser(SUITE_FILE)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"suite": fastest, "mb_per_s": results}, f, indent=2)
+    logger.info(f"Calibrated cipher suites {results}, using {fastest}")
+    return results
+
+
+def default_suite() -> CipherSuite:
+    """Suite picked by the last calibration, calibrates on first use."""
+    path = os.path.expanduser(SUITE_FILE)
+    try:
+        with open(path) as f:
+            return SUITES[json.load(f)["suite"]]
+    except (OSError, ValueError, KeyError):
+        pass
+    try:
+        results = calibrate()
+        return SUITES[max(results, key=results.get)]
+    except OSError:
+        # e.g. read-only home, fall back without saving the calibration
+        return SUITES[DEFAULT_SUITE]
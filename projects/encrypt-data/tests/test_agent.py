@@ -0,0 +1,55 @@
+import os
+import socket
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from encrypt import derive_key
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="needs UNIX sockets")
+
+
+@pytest.fixture
+def agent(tmp_path):
+    from agent import KeyAgent, AgentClient
+
+    server = KeyAgent(str(tmp_path / "agent" / "agent.sock"))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield AgentClient(server.socket_path)
+    server.shutdown()
+    server.server_close()
+
+
+def test_derive_matches_local_kdf(agent):
+    salt = os.urandom(16)
+    key, returned_salt = agent.derive("secret", salt)
+    assert returned_salt == salt
+    assert key == derive_key("secret", salt)
+
+
+def test_encryption_reuses_cached_salt_until_cleared(agent):
+    key, salt = agent.derive("secret")
+    assert agent.derive("secret") == (key, salt)
+    assert agent.derive("other")[1] != salt
+
+    agent.clear()
+    assert agent.derive("secret")[1] != salt
+
+
+def test_socket_dir_is_private(agent):
+    assert os.stat(os.path.dirname(agent.socket_path)).st_mode & 0o777 == 0o700
+
+
+def test_main_does_not_import_agent():
+    src = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+    out = subprocess.run(
+        [sys.executable, "-c", "import sys, main; print('agent' in sys.modules)"],
+        cwd=src,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert out.stdout.strip() == "False"
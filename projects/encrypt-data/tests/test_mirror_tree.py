@@ -0,0 +1,131 @@
+import json
+import os
+from pathlib import Path
+
+import pytest
+
+import suites
+from encrypt import Encryptor, _name_key, _object_name, _write_sealed, derive_key
+from suites import SUITES
+
+
+def make_tree(root: Path) -> dict:
+    files = {
+        "a.txt": b"alpha",
+        "sub/b.bin": os.urandom(5000),
+        "sub/deeper/c.txt": b"",
+    }
+    for rel_path, data in files.items():
+        (root / rel_path).parent.mkdir(parents=True, exist_ok=True)
+        (root / rel_path).write_bytes(data)
+    return files
+
+
+def read_index(tree: Path, pwd: str) -> tuple[bytes, bytes]:
+    data = (tree / "index.enc").read_bytes()
+    return data[:16], derive_key(pwd, data[:16])
+
+
+def test_round_trip(tmp_path):
+    folder = tmp_path / "docs"
+    files = make_tree(folder)
+    tree = Path(Encryptor().encrypt_tree(str(folder), "pw", delete_original=True))
+    assert not folder.exists()
+    names = os.listdir(tree / "objects")
+    assert len(names) == len(files)
+    assert not any("txt" in name or "bin" in name for name in names)
+
+    assert Encryptor().decrypt_tree(str(tree), "pw")
+    for rel_path, data in files.items():
+        assert (folder / rel_path).read_bytes() == data
+
+
+def test_wrong_password_fails(tmp_path):
+    folder = tmp_path / "docs"
+    make_tree(folder)
+    tree = Encryptor().encrypt_tree(str(folder), "pw", delete_original=True)
+    assert not Encryptor().decrypt_tree(tree, "wrong")
+
+
+def test_single_file_and_separate_name_key(tmp_path):
+    folder = tmp_path / "docs"
+    files = make_tree(folder)
+    tree = Path(Encryptor().encrypt_tree(str(folder), "pw", delete_original=False))
+
+    out = tmp_path / "b.bin"
+    assert Encryptor().decrypt_tree_file(str(tree), "sub/b.bin", "pw", str(out))
+    assert out.read_bytes() == files["sub/b.bin"]
+
+    # names are not an HMAC under the encryption key itself
+    _, key = read_index(tree, "pw")
+    assert _object_name(key, "sub/b.bin") not in os.listdir(tree / "objects")
+
+
+def test_index_paths_outside_the_folder_are_rejected(tmp_path):
+    folder = tmp_path / "docs"
+    make_tree(folder)
+    tree = Path(Encryptor().encrypt_tree(str(folder), "pw", delete_original=True))
+    salt, key = read_index(tree, "pw")
+    name = os.listdir(tree / "objects")[0]
+
+    for evil in ("../evil.txt", str(tmp_path / "abs.txt"), "sub/../../evil.txt"):
+        index = json.dumps({"files": {"ok.txt": name, evil: name}}).encode()
+        with open(tree / "index.enc", "wb") as f:
+            _write_sealed(f, SUITES["aes-256-gcm"], key, salt, [index], len(index))
+        assert not Encryptor().decrypt_tree(str(tree), "pw")
+        assert not (tmp_path / "evil.txt").exists()
+        assert not (tmp_path / "abs.txt").exists()
+        assert not (folder / "ok.txt").exists()
+
+
+@pytest.mark.parametrize("suite", ["aes-256-gcm", "chacha20-poly1305"])
+def test_objects_are_streamed_in_sealed_chunks(tmp_path, monkeypatch, suite):
+    monkeypatch.setattr(suites.AeadSuite, "chunk_size", 1024)
+    folder = tmp_path / "docs"
+    files = make_tree(folder)
+    tree = Path(Encryptor(suite=suite).encrypt_tree(str(folder), "pw", delete_original=True))
+    # 5000 bytes in 5 chunks, each with a tag, after the 12 byte header
+    _, key = read_index(tree, "pw")
+    obj = tree / "objects" / _object_name(_name_key(key), "sub/b.bin")
+    assert obj.stat().st_size == 4 + 1 + 7 + 5000 + 5 * 16
+
+    assert Encryptor().decrypt_tree(str(tree), "pw")
+    for rel_path, data in files.items():
+        assert (folder / rel_path).read_bytes() == data
+
+
+def test_swapped_and_modified_objects_are_rejected(tmp_path):
+    folder = tmp_path / "docs"
+    make_tree(folder)
+    tree = Path(Encryptor().encrypt_tree(str(folder), "pw", delete_original=True))
+    _, key = read_index(tree, "pw")
+    a = tree / "objects" / _object_name(_name_key(key), "a.txt")
+    b = tree / "objects" / _object_name(_name_key(key), "sub/b.bin")
+    original_a, original_b = a.read_bytes(), b.read_bytes()
+
+    a.write_bytes(original_b)
+    b.write_bytes(original_a)
+    assert not Encryptor().decrypt_tree(str(tree), "pw")
+    assert not (folder / "a.txt").exists() and not (folder / "sub" / "b.bin").exists()
+
+    a.write_bytes(original_a)
+    modified = bytearray(original_b)
+    modified[-1] ^= 1
+    b.write_bytes(bytes(modified))
+    out = tmp_path / "b.bin"
+    assert not Encryptor().decrypt_tree_file(str(tree), "sub/b.bin", "pw", str(out))
+    assert not out.exists()
+
+    index = bytearray((tree / "index.enc").read_bytes())
+    index[-1] ^= 1
+    (tree / "index.enc").write_bytes(bytes(index))
+    b.write_bytes(original_b)
+    assert not Encryptor().decrypt_tree(str(tree), "pw")
+
+
+def test_unauthenticated_suite_is_refused(tmp_path):
+    folder = tmp_path / "docs"
+    make_tree(folder)
+    with pytest.raises(ValueError):
+        Encryptor(suite="aes-256-cbc").encrypt_tree(str(folder), "pw", delete_original=True)
+    assert folder.exists()
@@ -0,0 +1,42 @@
+import os
+
+import scanner
+from scanner import scan_tree
+
+
+def make_tree(root):
+    for rel_path, size in {"a.txt": 10, "sub/b.txt": 300, "sub/deep/c.txt": 20, "locked/d.txt": 5}.items():
+        path = root / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"x" * size)
+
+
+def test_all_files_largest_first(tmp_path):
+    make_tree(tmp_path)
+    entries = scan_tree(tmp_path, workers=4)
+    assert [e.rel_path for e in entries] == ["sub/b.txt", "sub/deep/c.txt", "a.txt", "locked/d.txt"]
+    assert [e.size for e in entries] == [300, 20, 10, 5]
+    assert all(os.path.exists(e.path) for e in entries)
+
+
+def test_symlinks_are_not_followed_and_broken_ones_skipped(tmp_path):
+    make_tree(tmp_path)
+    os.symlink(tmp_path / "sub", tmp_path / "link_to_sub")
+    os.symlink(tmp_path / "missing", tmp_path / "broken")
+    rel_paths = {e.rel_path for e in scan_tree(tmp_path)}
+    assert rel_paths == {"a.txt", "sub/b.txt", "sub/deep/c.txt", "locked/d.txt"}
+
+
+def test_unreadable_directory_is_skipped(tmp_path, monkeypatch):
+    make_tree(tmp_path)
+    locked = str(tmp_path / "locked")
+    scandir = os.scandir
+
+    def fake_scandir(path):
+        if str(path) == locked:
+            raise PermissionError(13, "Permission denied", path)
+        return scandir(path)
+
+    monkeypatch.setattr(scanner.os, "scandir", fake_scandir)
+    rel_paths = {e.rel_path for e in scan_tree(tmp_path)}
+    assert rel_paths == {"a.txt", "sub/b.txt", "sub/deep/c.txt"}
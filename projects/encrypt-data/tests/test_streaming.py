@@ -0,0 +1,47 @@
+import io
+import os
+
+import pytest
+
+import encrypt
+import suites
+from encrypt import Encryptor, _read_chunks
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    # a few KB instead of MB so files span many chunks
+    monkeypatch.setattr(encrypt, "CHUNK_SIZE", 4096)
+    monkeypatch.setattr(suites.AeadSuite, "chunk_size", 4096)
+    return 4096
+
+
+@pytest.mark.parametrize("size", [0, 1, 4095, 4096, 4097, 3 * 4096 + 17])
+@pytest.mark.parametrize("offset", [0, 5])
+def test_mmap_and_buffered_reads_match(tmp_path, size, offset):
+    data = os.urandom(size)
+    path = tmp_path / "data"
+    path.write_bytes(data)
+    with open(path, "rb") as f:
+        buffered = [bytes(c) for c in _read_chunks(f, offset, 4096, use_mmap=False)]
+        mapped = [bytes(c) for c in _read_chunks(f, offset, 4096, use_mmap=True)]
+    assert buffered == mapped
+    assert b"".join(mapped) == data[offset:]
+    assert all(len(c) == 4096 for c in mapped[:-1])
+
+
+@pytest.mark.parametrize("threshold", [0, 1 << 40])
+def test_archive_round_trip_across_chunks(tmp_path, monkeypatch, small_chunks, threshold):
+    # threshold 0 maps every file, a huge one always reads
+    monkeypatch.setattr(encrypt, "MMAP_THRESHOLD", threshold)
+    folder = tmp_path / "docs"
+    folder.mkdir()
+    data = os.urandom(10 * small_chunks + 123)
+    (folder / "big.bin").write_bytes(data)
+
+    Encryptor(suite="aes-256-gcm").compress_and_encrypt(str(folder), "pw", delete_original=True)
+    archive = tmp_path / "docs.zip.enc"
+    assert archive.exists() and not folder.exists()
+
+    assert Encryptor().decrypt_and_uncompress(str(archive), "pw")
+    assert (folder / "big.bin").read_bytes() == data
@@ -0,0 +1,92 @@
+import json
+import os
+
+import pytest
+
+import encrypt
+import suites
+from encrypt import Encryptor, derive_key
+from suites import MAGIC, SUITES
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(encrypt, "CHUNK_SIZE", 1024)
+    monkeypatch.setattr(suites.AeadSuite, "chunk_size", 1024)
+
+
+def encrypt_folder(tmp_path, suite: str, data: bytes):
+    folder = tmp_path / "docs"
+    folder.mkdir()
+    (folder / "f.bin").write_bytes(data)
+    Encryptor(suite=suite).compress_and_encrypt(str(folder), "pw", delete_original=True)
+    return folder, tmp_path / "docs.zip.enc"
+
+
+@pytest.mark.parametrize("suite", list(SUITES))
+@pytest.mark.parametrize("size", [0, 1024, 5000])
+def test_round_trip_with_header_dispatch(tmp_path, suite, size):
+    data = os.urandom(size)
+    folder, archive = encrypt_folder(tmp_path, suite, data)
+    raw = archive.read_bytes()
+    assert raw[:4] == MAGIC and raw[4] == SUITES[suite].suite_id
+
+    # decryption picks the suite from the header, not from the Encryptor
+    assert Encryptor(suite="aes-256-cbc").decrypt_and_uncompress(str(archive), "pw")
+    assert (folder / "f.bin").read_bytes() == data
+
+
+@pytest.mark.parametrize("suite", ["aes-256-gcm", "chacha20-poly1305"])
+def test_aead_rejects_tampering(tmp_path, suite):
+    _, archive = encrypt_folder(tmp_path, suite, os.urandom(5000))
+    raw = archive.read_bytes()
+    header_size = len(MAGIC) + 1 + 16 + SUITES[suite].nonce_size
+
+    flipped = bytearray(raw)
+    flipped[-1] ^= 1
+    truncated = raw[: header_size + 1024 + 16]
+    other_suite = bytearray(raw)
+    other_suite[4] = SUITES["chacha20-poly1305" if suite == "aes-256-gcm" else "aes-256-gcm"].suite_id
+
+    for bad in (bytes(flipped), truncated, bytes(other_suite)):
+        archive.write_bytes(bad)
+        assert not Encryptor().decrypt_and_uncompress(str(archive), "pw")
+        assert not (tmp_path / "docs.zip").exists()
+
+
+@pytest.mark.parametrize("suite", list(SUITES))
+def test_read_buffer_size_does_not_change_the_format(tmp_path, monkeypatch, suite):
+    data = os.urandom(5000)
+    folder, archive = encrypt_folder(tmp_path, suite, data)
+    # CHUNK_SIZE is a tunable, archives written with another value still decrypt
+    monkeypatch.setattr(encrypt, "CHUNK_SIZE", 777)
+    assert Encryptor().decrypt_and_uncompress(str(archive), "pw")
+    assert (folder / "f.bin").read_bytes() == data
+
+
+def test_legacy_archives_without_header_still_decrypt(tmp_path):
+    import io
+    import zipfile
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zipf:
+        zipf.writestr("old.txt", "from before cipher suites")
+    salt = os.urandom(16)
+    # legacy layout: salt, iv, AES-CBC ciphertext
+    iv = os.urandom(16)
+    ciphertext = b"".join(SUITES["aes-256-cbc"].encrypt(derive_key("pw", salt), iv, b"", [buffer.getvalue()], 0))
+    (tmp_path / "old.zip.enc").write_bytes(salt + iv + ciphertext)
+
+    assert Encryptor().decrypt_and_uncompress(str(tmp_path / "old.zip.enc"), "pw")
+    assert (tmp_path / "old" / "old.txt").read_text() == "from before cipher suites"
+
+
+def test_calibration_is_saved_and_reused(tmp_path, monkeypatch):
+    suite_file = tmp_path / "suite.json"
+    monkeypatch.setattr(suites, "SUITE_FILE", str(suite_file))
+    results = suites.calibrate(size=4096)
+    assert set(results) == {"aes-256-gcm", "chacha20-poly1305"}
+    assert suites.default_suite().name == json.loads(suite_file.read_text())["suite"]
+
+    suite_file.write_text(json.dumps({"suite": "chacha20-poly1305"}))
+    assert suites.default_suite().name == "chacha20-poly1305"
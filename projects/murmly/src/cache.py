@@ -0,0 +1,88 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries also expire after a TTL.
+
+    Only used from the event loop, so no locking.
+
+    A value read from the source before an invalidation may be stale, so a
+    reader takes generation() before the read and passes it to set(), which
+    then skips the fill if the key was invalidated in between.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[Any, float]] = OrderedDict()
+        self._generation = 0
+        # generation of the latest invalidations, the oldest are forgotten
+        # and fills from before them are skipped for every key
+        self._invalidated: OrderedDict[Hashable, int] = OrderedDict()
+        self._forgotten = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def generation(self) -> int:
+        return self._generation
+
+    def set(
+        self, key: Hashable, value: Any, ttl: Optional[float] = None, generation: Optional[int] = None
+    ):
+        """Stores value, `ttl` can shorten the default TTL for this entry.
+
+        With `generation` the value is only stored if the key was not
+        invalidated since that generation was taken.
+        """
+        if generation is not None and (
+            generation < self._forgotten or self._invalidated.get(key, 0) > generation
+        ):
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        self._data[key] = (value, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        self._data.pop(key, None)
+        self._generation += 1
+        self._invalidated[key] = self._generation
+        self._invalidated.move_to_end(key)
+        while len(self._invalidated) > self.maxsize:
+            _, self._forgotten = self._invalidated.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+        self._generation += 1
+        self._invalidated.clear()
+        self._forgotten = self._generation
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -12,6 +12,7 @@ import bcrypt
 
 import crypto_utils
 from config import *
+from framing import BINARY_SUBPROTOCOL, decode_frame, encode_frame
 
 
 class ChatClient:
@@ -22,6 +23,8 @@ class ChatClient:
         self.username = None
         self.user_id = None
         self.ws = None
+        # the server accepted binary frames, see framing.py
+        self.binary = False
 
         # encryption related stuff
         self.priv_key = None
@@ -30,6 +33,12 @@ class ChatClient:
         self.message_counters = {}
         self.dh_parameters = None
         self.online_users = []
+        # username -> id of every user, seeded from /users/online
+        self.directory: dict[str, int] = {}
+        # ids of the users online now, kept up to date by presence events
+        self.online: set[int] = set()
+        # peer id -> (key version, public key, time fetched), see fetch_public_keys
+        self.peer_keys: dict[int, tuple] = {}
 
     def hash_password(self, password):
         """Hash password using SHA-256 and convert to base64, matching website implementation"""
@@ -99,15 +108,22 @@ class ChatClient:
         if response.status_code == 200:
             users = response.json()
             self.online_users = users
+            self.directory.update({u["username"]: u["id"] for u in users})
+            self.online = {u["id"] for u in users if u["is_online"]}
             return users
         else:
             print(f"Failed to get online users: {response.text}")
             return []
 
-    def get_chat_history(self, peer_id):
-        """Get chat history with a specific user"""
+    def get_chat_history(self, peer_id, limit=50, before_id=None):
+        """Get the last `limit` messages with a specific user, older ones with `before_id`"""
+        params = {"limit": limit}
+        if before_id is not None:
+            params["before_id"] = before_id
         response = requests.get(
-            f"{self.server_url}/users/{peer_id}/chat", headers=self.get_auth_header()
+            f"{self.server_url}/users/{peer_id}/chat",
+            headers=self.get_auth_header(),
+            params=params,
         )
         if response.status_code == 200:
             return response.json()
@@ -118,53 +134,98 @@ class ChatClient:
     def on_message(self, ws, message):
         """Handle incoming WebSocket messages"""
         try:
-            data = json.loads(message)
+            data = decode_frame(message) if isinstance(message, bytes) else json.loads(message)
 
             if "type" in data and data["type"] == "delivery_status":
-                status = "sent" if data["delivered"] else "not sent"
+                if data.get("queued"):
+                    status = "queued, recipient is offline"
+                else:
+                    status = "sent" if data["delivered"] else "not sent"
                 print(f"Message to {data['recipient']['username']}: {status}")
                 return
 
-            if "error" in data:
-                print(f"Error: {data['error']}")
+            if data.get("type") == "presence_snapshot":
+                self.directory.update({u["username"]: u["id"] for u in data["users"]})
+                self.online = {u["id"] for u in data["users"]}
+                # the peers we are most likely to message, their keys in one request
+                self.fetch_public_keys(self.online - {self.user_id})
                 return
 
-            # handle the message
-            sender = data.get("sender", {})
-            sender_id = sender.get("id")
-            sender_username = sender.get("username")
-            content = data.get("content")
-            timestamp = data.get("timestamp", datetime.now().isoformat())
-            message_number = data.get("message_number", 0)
-
-            # check if secure channel / key exchange already happened
-            if sender_id not in self.session_keys:
-                print(f"establishing secure channel with {sender_username}...")
-                if not self.establish_sec_channel(sender_id):
-                    print(f"Could not establish secure channel with {sender_username}")
-                    return
-
-            try:
-                encoded_bytes = base64.b64decode(content)
+            if data.get("type") == "presence":
+                for user in data["online"]:
+                    self.directory[user["username"]] = user["id"]
+                self.online |= {u["id"] for u in data["online"]}
+                self.online -= set(data["offline"])
+                # a reconnected client may have uploaded a new key
+                self.fetch_public_keys(
+                    {u["id"] for u in data["online"]} & self.peer_keys.keys() - {self.user_id}
+                )
+                return
 
-                # decrypt
-                decrypted_message = self.decrypt_message(
-                    sender_id, encoded_bytes, message_number
+            if "type" in data and data["type"] == "pending_messages":
+                # messages received while we were offline, one key request for all senders
+                self.fetch_public_keys(
+                    {
+                        m["sender"]["id"]
+                        for m in data["messages"]
+                        if m["sender"]["id"] not in self.session_keys
+                    }
                 )
+                for pending in data["messages"]:
+                    self.handle_chat_message(pending)
+                ws.send(
+                    json.dumps(
+                        {
+                            "type": "ack",
+                            "message_ids": [m["id"] for m in data["messages"]],
+                        }
+                    )
+                )
+                return
 
-                # Check if this is a new chat
-                is_new_chat = data.get("is_new_chat", False)
-                if is_new_chat:
-                    print(f"\n🔔 New chat from {sender_username}!")
+            if "error" in data:
+                print(f"Error: {data['error']}")
+                return
 
-                print(f"\n[{timestamp}] {sender_username}: {decrypted_message}")
-            except Exception as e:
-                print(f"Error decrypting message from {sender_username}: {e}")
+            self.handle_chat_message(data)
 
         except Exception as e:
             print(f"Error processing message: {e}")
             print(f"Raw message: {message}")
 
+    def handle_chat_message(self, data):
+        """Decrypts and prints one chat message"""
+        sender = data.get("sender", {})
+        sender_id = sender.get("id")
+        sender_username = sender.get("username")
+        content = data.get("content")
+        timestamp = data.get("timestamp", datetime.now().isoformat())
+        message_number = data.get("message_number", 0)
+
+        # check if secure channel / key exchange already happened
+        if sender_id not in self.session_keys:
+            print(f"establishing secure channel with {sender_username}...")
+            if not self.establish_sec_channel(sender_id):
+                print(f"Could not establish secure channel with {sender_username}")
+                return
+
+        try:
+            encoded_bytes = content if isinstance(content, bytes) else base64.b64decode(content)
+
+            # decrypt
+            decrypted_message = self.decrypt_message(
+                sender_id, encoded_bytes, message_number
+            )
+
+            # Check if this is a new chat
+            is_new_chat = data.get("is_new_chat", False)
+            if is_new_chat:
+                print(f"\n🔔 New chat from {sender_username}!")
+
+            print(f"\n[{timestamp}] {sender_username}: {decrypted_message}")
+        except Exception as e:
+            print(f"Error decrypting message from {sender_username}: {e}")
+
     def on_error(self, ws, error):
         print(f"WebSocket error: {error}")
 
@@ -172,6 +233,9 @@ class ChatClient:
         print("WebSocket connection closed")
 
     def on_open(self, ws):
+        self.binary = ws.sock.getsubprotocol() == BINARY_SUBPROTOCOL
+        # the server answers with a snapshot of online users, then pushes changes
+        ws.send(json.dumps({"type": "presence_subscribe"}))
         print("WebSocket connection established")
 
     def connect_websocket(self):
@@ -189,6 +253,7 @@ class ChatClient:
             on_error=self.on_error,
             on_close=self.on_close,
             on_open=self.on_open,
+            subprotocols=[BINARY_SUBPROTOCOL] if WS_BINARY_FRAMES else None,
         )
 
         # is a background thread
@@ -199,25 +264,25 @@ class ChatClient:
         thread.start()
         time.sleep(1)  # sleep for letting connection establish
 
+    def lookup_user(self, username):
+        """Id of a user, offline users included. Users that registered after
+        the directory was loaded are found by loading it again."""
+        if username not in self.directory:
+            self.get_online_users()
+        return self.directory.get(username)
+
     def send_message(self, recipient_username, content):
         """Send a message to a recipient"""
         if not self.ws:
             print("WebSocket not connected")
             return False
 
-        # Find recipient's user ID from online users
-        online_users = self.get_online_users()
-        recipient = next(
-            (user for user in online_users if user["username"] == recipient_username),
-            None,
-        )
-
-        if not recipient:
-            print(f"User {recipient_username} not found or not online")
+        # no request per message, offline users get it when they connect
+        recipient_id = self.lookup_user(recipient_username)
+        if recipient_id is None:
+            print(f"User {recipient_username} not found")
             return False
 
-        recipient_id = recipient["id"]
-
         if recipient_id not in self.session_keys:
             print(f"Establishing secure channel with {recipient_username}...")
             if not self.establish_sec_channel(recipient_id):
@@ -228,14 +293,16 @@ class ChatClient:
             encrypted_content, message_number = self.encrypt_message(
                 recipient_id, content
             )
-            encrypted_b64 = base64.b64encode(encrypted_content).decode("ascii")
-
             message = {
                 "recipient": {"id": recipient_id, "username": recipient_username},
-                "content": encrypted_b64,
                 "timestamp": datetime.now(timezone.utc).isoformat(),
             }
-            self.ws.send(json.dumps(message))
+            if self.binary:
+                message["content"] = encrypted_content
+                self.ws.send(encode_frame(message), opcode=websocket.ABNF.OPCODE_BINARY)
+            else:
+                message["content"] = base64.b64encode(encrypted_content).decode("ascii")
+                self.ws.send(json.dumps(message))
             return True
         except Exception as e:
             print(f"Error encrypting/sending message: {e}")
@@ -266,6 +333,8 @@ class ChatClient:
         self.pub_key = k_pair[1]
         self.update_public_key()
 
+        # every user once, online flags follow from the pushed presence events
+        self.get_online_users()
         self.connect_websocket()
         return True
 
@@ -303,30 +372,69 @@ class ChatClient:
             print(f"Failed to upload public key: {response.text}")
             return False
 
-    def get_public_key_user(self, peer_id):
+    def fetch_public_keys(self, peer_ids):
+        """Fetches the public keys of several peers, PUBLIC_KEY_BATCH_MAX per
+        request. Keys we already have are sent as known versions and only come
+        back if they changed, a changed key ends the secure channel with that peer."""
         if not self.auth_token:
             print("Not authenticated")
             return False
+        peer_ids = list(peer_ids)
+        for start in range(0, len(peer_ids), PUBLIC_KEY_BATCH_MAX):
+            if not self._fetch_public_keys(peer_ids[start:start + PUBLIC_KEY_BATCH_MAX]):
+                return False
+        return True
 
+    def _fetch_public_keys(self, peer_ids):
+        params = [("ids", peer_id) for peer_id in peer_ids]
+        params += [
+            ("known", f"{peer_id}:{self.peer_keys[peer_id][0]}")
+            for peer_id in peer_ids
+            if peer_id in self.peer_keys
+        ]
         response = requests.get(
-            url=f"{self.server_url}/users/{peer_id}/public_key",
+            url=f"{self.server_url}/users/public_keys",
+            params=params,
             headers=self.get_auth_header(),
         )
+        if response.status_code != 200:
+            print(f"Failed to get public keys: {response.text}")
+            return False
 
-        if response.status_code == 200:
-            public_key_data = response.json()
-            public_key_serialized = public_key_data["public_key"].encode("utf-8")
+        data = response.json()
+        now = time.monotonic()
+        for item in data["keys"]:
+            peer_id = item["id"]
+            if "public_key" not in item:
+                # unchanged, valid for another PEER_KEY_MAX_AGE
+                self.peer_keys[peer_id] = (item["version"], self.peer_keys[peer_id][1], now)
+                continue
             try:
                 public_key = crypto_utils.deserialize_pub_key(
-                    public_key_serialized, self.dh_parameters
+                    item["public_key"].encode("utf-8"), self.dh_parameters
                 )
-                return public_key
             except Exception as e:
                 print(f"Error deserializing public key: {e}")
-                return None
-        else:
-            print(f"Failed to get public key: {response.text}")
-            return None
+                continue
+            if peer_id in self.peer_keys:
+                self.end_sec_channel(peer_id)
+            self.peer_keys[peer_id] = (item["version"], public_key, now)
+        for peer_id in data["missing"]:
+            self.peer_keys.pop(peer_id, None)
+            self.end_sec_channel(peer_id)
+        return True
+
+    def get_public_key_user(self, peer_id):
+        entry = self.peer_keys.get(peer_id)
+        if entry is None or time.monotonic() - entry[2] > PEER_KEY_MAX_AGE:
+            self.fetch_public_keys([peer_id])
+        entry = self.peer_keys.get(peer_id)
+        return entry[1] if entry else None
+
+    def end_sec_channel(self, peer_id):
+        """Forgets the session key, the next message re-establishes the channel."""
+        self.session_keys.pop(peer_id, None)
+        self.message_counters.pop(peer_id, None)
 
     def establish_sec_channel(self, peer_id):
         if not self.auth_token:
@@ -461,20 +569,19 @@ def chat_interface(client: ChatClient):
                         continue
 
                     username = parts[1][1:]  # Remove @
-                    users = client.get_online_users()
-                    user = next((u for u in users if u["username"] == username), None)
+                    user_id = client.lookup_user(username)
 
-                    if not user:
+                    if user_id is None:
                         print(f"User {username} not found")
                         continue
 
-                    history = client.get_chat_history(user["id"])
+                    history = client.get_chat_history(user_id)
                     if history:
                         print(f"\nChat history with {username}:")
                         for msg in history:
                             sender = (
                                 "You"
-                                if msg["sender_id"] == client.user_id
+                                if msg["isMine"]
                                 else username
                             )
                             print(f"[{msg['timestamp']}] {sender}: {msg['content']}")
@@ -1,8 +1,20 @@
+import os
+
 # length for galios filed in crypto
 # obviously this should be larger for production, but it takes really long 
 # small bit size for testing
 PRIME_BITS = 1024
 
+# Diffie-Hellman group served at /dh_params, see dh_params.py: "ffdhe2048" or
+# "ffdhe3072" from RFC 7919, or "generated" for PRIME_BITS parameters
+# generated once on this host and cached in DH_PARAMS_FILE
+DH_GROUP = "ffdhe2048"
+DH_PARAMS_FILE = "dh_params.pem"
+# regenerate "generated" parameters after this many seconds, 0 never does.
+# they are served from the next restart, clients have to fetch /dh_params
+# and upload a new public key then
+DH_ROTATE_SECONDS = 0
+
 # only for testing, in production this should not be used
 #pregenerated prime number, as running on separate clients leads to new params
 # this should be changed, is only temporary workaround
@@ -10,17 +22,91 @@ PRIME_BITS = 1024
 # DH_G = 2  #generator element of galios field
 
 
+# logging, see logger.py. LOG_FORMAT is "text" or "json"
+LOG_LEVEL = os.environ.get("MURMLY_LOG_LEVEL", "INFO")
+LOG_FORMAT = os.environ.get("MURMLY_LOG_FORMAT", "text")
+LOG_FILE = "murmly.log"
+# fraction of per message debug/info logs that are kept, and at most
+# this many per second for each log line
+LOG_SAMPLE_RATE = 0.01
+LOG_RATE_LIMIT = 10
+
 # jwt related stuff
 SECRET_KEY = "your-secret-key-here"  
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
 
+# caches of decoded tokens and user rows, entries per cache and seconds to live
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 300
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 300
+# public keys, see key_directory.py, and how many one request may ask for
+KEY_CACHE_SIZE = 10000
+KEY_CACHE_TTL = 300
+PUBLIC_KEY_BATCH_MAX = 100
+
 # db stuff
 DATABASE_FILE = "murmly.db"
 DATABASE_URL = f"sqlite+aiosqlite:///{DATABASE_FILE}"  # Use aiosqlite driver
 
+# pragmas run on every sqlite connection, see Database
+SQLITE_PRAGMAS = {
+    # readers see the last commit while the writer appends to the log
+    "journal_mode": "WAL",
+    # with WAL, fsync at checkpoints only: a power loss can lose the last
+    # commits but never corrupts the database
+    "synchronous": "NORMAL",
+    "cache_size": -64000,  # negative is KiB, 64 MB page cache per connection
+    "mmap_size": 256 * 1024 * 1024,
+    "busy_timeout": 5000,  # ms to wait for a lock instead of failing
+}
+# read only connections for history and user queries, writes go through
+# a single writer connection
+SQLITE_READ_POOL_SIZE = 4
+
 
 SERVER_URL = "http://localhost:8000"
 
+# presence: online state is kept in memory and written to the db in batches
+PRESENCE_FLUSH_SECONDS = 5
+# users without websocket are marked offline after this long without a request
+PRESENCE_TIMEOUT_SECONDS = 60
+# presence changes within this many seconds are pushed as one websocket frame
+PRESENCE_PUSH_SECONDS = 0.25
+
+# group commit: websocket messages are written in one transaction per batch,
+# a batch is flushed after this many milliseconds or this many messages
+WRITE_BATCH_WINDOW_MS = 5
+WRITE_BATCH_MAX_MESSAGES = 200
+
+# store and forward: messages to offline users wait in pending_deliveries
+# until acknowledged, they are sent this many per websocket frame
+PENDING_BATCH_SIZE = 100
+
+# messages waiting for one websocket, see socket_manager.py. When the queue is
+# full: "drop" the message, "disconnect" the slow client, or "spill" the
+# message to pending_deliveries so it is resent once the queue drained
+SEND_QUEUE_SIZE = 256
+SEND_QUEUE_POLICY = "spill"
+
+# pub/sub between uvicorn workers, e.g. redis://localhost:6379/0 (needs
+# `pip install redis`), unset runs everything in a single process
+FANOUT_URL = os.environ.get("MURMLY_FANOUT_URL")
+
+# bcrypt runs in a thread pool of this size, one core is left for the event loop
+HASH_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+# logins and registrations waiting for a worker beyond this get a 503
+HASH_MAX_QUEUE = 64
+
+# client.py asks for binary websocket frames (raw ciphertext instead of base64 in JSON)
+WS_BINARY_FRAMES = True
+# client.py uses a peer's public key this many seconds before asking the
+# server whether it changed
+PEER_KEY_MAX_AGE = 60
+
+# seconds between event loop lag samples for /metrics
+LOOP_LAG_INTERVAL = 0.5
+
 # how many bytes for nonce to generate
 NONCE_SIZE = 12
\ No newline at end of file
@@ -0,0 +1,648 @@
+"""Database benchmarks on a throwaway SQLite file, run from `src`:
+
+    python db_bench.py online [--users 10000 100000 1000000]
+    python db_bench.py messages [--messages 2000] [--senders 1 20] [--windows 1 5 20]
+    python db_bench.py reads [--seconds 5] [--readers 8]
+    python db_bench.py history [--messages 10000000]
+    python db_bench.py chat [--messages 100000]
+    python db_bench.py pending [--history 100000] [--pending 1000]
+    python db_bench.py logins [--logins 50] [--workers 1 4] [--max-queue 16]
+    python db_bench.py logging [--messages 20000]
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import queue
+import logging
+import logging.handlers
+import statistics
+from datetime import datetime
+
+from sqlalchemy import insert, select, and_, or_, text
+from sqlalchemy.orm import selectinload
+
+from config import SQLITE_PRAGMAS
+from db_utils import Database, get_password_hash, verify_password
+from hasher import PasswordHasher, HasherBusy
+from logger import TEXT_FORMAT, JsonFormatter, SampleFilter, RateLimitFilter
+from models import User, Message, UserChat
+
+
+def _timed(label: str, start: float, extra: str = ""):
+    print(f"  {label:<32} {(time.perf_counter() - start) * 1e3:10.1f} ms {extra}")
+
+
+async def _seed_users(db: Database, n_users: int, n_chats: int):
+    """n_users users, user 1 has chatted with the first n_chats of them."""
+    now = datetime.utcnow()
+    async with db.async_session_factory() as session:
+        async with session.begin():
+            batch = 50_000
+            for first in range(1, n_users + 1, batch):
+                await session.execute(
+                    insert(User),
+                    [
+                        {
+                            "id": i,
+                            "username": f"user{i}",
+                            "password_hash": "x",
+                            "is_online": i % 10 == 0,
+                            "last_seen": now,
+                        }
+                        for i in range(first, min(first + batch, n_users + 1))
+                    ],
+                )
+            peers = range(2, min(n_chats + 2, n_users + 1))
+            if not peers:
+                return
+            await session.execute(
+                insert(Message),
+                [
+                    {"id": p, "sender_id": 1, "recipient_id": p, "content": "hi", "timestamp": now}
+                    for p in peers
+                ],
+            )
+            await session.execute(
+                insert(UserChat),
+                [
+                    {"user_id": 1, "peer_id": p, "last_message_id": p, "last_interaction": now}
+                    for p in peers
+                ],
+            )
+
+
+async def _online_old(db: Database, user_id: int) -> int:
+    """The previous GET /users/online: all users x linear scan over chats."""
+    user_chats = await db.get_user_chats(user_id)
+    all_users = await db.get_all_users()
+    result = []
+    for user in all_users:
+        if user.id == user_id:
+            continue
+        chat_info = next((chat for chat in user_chats if chat.peer_id == user.id), None)
+        result.append((user, chat_info.last_message if chat_info else None))
+    return len(result)
+
+
+async def bench_online(sizes: list[int], n_chats: int, skip_old_above: int):
+    for n_users in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = Database(f"sqlite+aiosqlite:///{os.path.join(tmp, 'bench.db')}")
+            await db.init_db()
+            start = time.perf_counter()
+            await _seed_users(db, n_users, n_chats)
+            print(f"{n_users} users, {n_chats} chats")
+            _timed("seed", start)
+
+            if n_users <= skip_old_above:
+                start = time.perf_counter()
+                count = await _online_old(db, 1)
+                _timed("old: users x chats scan", start, f"({count} rows)")
+
+            start = time.perf_counter()
+            rows = await db.get_users_with_last_message(1, limit=100)
+            _timed("joined query, first page", start, f"({len(rows)} rows)")
+
+            start = time.perf_counter()
+            rows = await db.get_users_with_last_message(1, limit=100, cursor=n_users // 2)
+            _timed("joined query, middle page", start, f"({len(rows)} rows)")
+
+            start = time.perf_counter()
+            rows = await db.get_users_with_last_message(1)
+            _timed("joined query, all users", start, f"({len(rows)} rows)")
+            del rows
+            await db.close()
+
+
+async def _store_old(db: Database, sender: User, recipient_id: int, content: str):
+    """The previous websocket path: SELECT user, INSERT message, 2x SELECT+UPSERT chat."""
+    async with db.async_session_factory() as session:
+        recipient = (await session.execute(select(User).where(User.id == recipient_id))).scalars().first()
+    message = await db.create_message(sender, recipient, content)
+    for user_id, peer_id in ((sender.id, recipient.id), (recipient.id, sender.id)):
+        async with db.async_session_factory() as session:
+            chat = (
+                await session.execute(
+                    select(UserChat).where(and_(UserChat.user_id == user_id, UserChat.peer_id == peer_id))
+                )
+            ).scalar_one_or_none()
+            if chat:
+                chat.last_message_id = message.id
+                chat.last_interaction = datetime.utcnow()
+            else:
+                session.add(
+                    UserChat(user_id=user_id, peer_id=peer_id, last_message_id=message.id, last_interaction=datetime.utcnow())
+                )
+            await session.commit()
+
+
+async def _store_new(db: Database, sender: User, recipient_id: int, content: str):
+    recipient = await db.get_user_by_id(recipient_id)
+    await db.store_message(sender, recipient, content)
+
+
+async def _store_queued(db: Database, sender: User, recipient_id: int, content: str):
+    recipient = await db.get_user_by_id(recipient_id)
+    await db.enqueue_message(sender, recipient, content)
+
+
+async def bench_messages(n_messages: int, sender_counts: list[int], windows: list[float]):
+    variants = [("old (4+ commits)", _store_old, None), ("store_message (1 commit)", _store_new, None)]
+    variants += [(f"group commit {w:g} ms", _store_queued, w) for w in windows]
+    for label, store, window in variants:
+        for n_senders in sender_counts:
+            with tempfile.TemporaryDirectory() as tmp:
+                db = Database(f"sqlite+aiosqlite:///{os.path.join(tmp, 'bench.db')}")
+                await db.init_db()
+                await _seed_users(db, 2 * n_senders, 0)
+                senders = [await db.get_user_by_id(i) for i in range(1, n_senders + 1)]
+                if window is not None:
+                    db.start_writer(window_ms=window)
+                latencies = []
+
+                async def send_all(sender: User):
+                    for i in range(n_messages // n_senders):
+                        t = time.perf_counter()
+                        await store(db, sender, sender.id + n_senders, "x" * 100)
+                        latencies.append(time.perf_counter() - t)
+
+                start = time.perf_counter()
+                await asyncio.gather(*(send_all(sender) for sender in senders))
+                elapsed = time.perf_counter() - start
+                await db.stop_writer()
+                q = statistics.quantiles(latencies, n=100)
+                print(
+                    f"{label:<26} senders={n_senders:<3} {len(latencies) / elapsed:8.0f} messages/s"
+                    f"  p50={q[49] * 1e3:6.1f} ms  p99={q[98] * 1e3:6.1f} ms"
+                )
+                await db.close()
+
+
+# a second process committing one message at a time, like another server
+# worker or a maintenance script: the lock contention an in-process group
+# commit writer never causes
+_WRITER_PROCESS = """
+import sqlite3, sys, time
+path, seconds = sys.argv[1], float(sys.argv[2])
+conn = sqlite3.connect(path, timeout=5)
+for pragma in sys.argv[3:]:
+    conn.execute(f"PRAGMA {pragma}")
+stop, writes = time.perf_counter() + seconds, 0
+while time.perf_counter() < stop:
+    conn.execute(
+        "INSERT INTO messages (sender_id, recipient_id, content, conversation_key) "
+        "VALUES (1, 2, ?, '1:2')", ("x" * 100,)
+    )
+    conn.commit()
+    writes += 1
+print(writes)
+"""
+
+
+async def _read_load(
+    db: Database, seconds: float, n_readers: int, load: str, pragmas: dict, n_senders: int = 50
+) -> str:
+    """Readers look up users for `seconds` next to `load`: "idle", "senders"
+    (group commit in this process) or "process" (a separate writer)."""
+    stop = time.perf_counter() + seconds
+    latencies, writes, errors = [], 0, 0
+
+    async def reader(i: int):
+        nonlocal errors
+        while time.perf_counter() < stop:
+            t = time.perf_counter()
+            # uncached primary key lookup, mostly time spent waiting for the db
+            try:
+                async with db.read_session_factory() as session:
+                    await session.get(User, i + 1)
+            except Exception:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - t)
+
+    async def sender(user_id: int):
+        nonlocal writes
+        sender, recipient = await db.get_user_by_id(user_id), await db.get_user_by_id(user_id + 1)
+        while time.perf_counter() < stop:
+            await db.enqueue_message(sender, recipient, "x" * 100)
+            writes += 1
+
+    # sustained load like the websocket path: many senders, group commit
+    tasks = [reader(i) for i in range(n_readers)]
+    writer = None
+    if load == "senders":
+        db.start_writer()
+        tasks += [sender(user_id) for user_id in range(3, 3 + 2 * n_senders, 2)]
+    elif load == "process":
+        writer = await asyncio.create_subprocess_exec(
+            sys.executable, "-c", _WRITER_PROCESS, db.engine.url.database, str(seconds),
+            *(f"{k}={v}" for k, v in pragmas.items() if k != "journal_mode"),
+            stdout=asyncio.subprocess.PIPE,
+        )
+    await asyncio.gather(*tasks)
+    await db.stop_writer()
+    if writer:
+        out, _ = await writer.communicate()
+        writes = int(out or 0)
+    q = statistics.quantiles(latencies, n=100)
+    return (
+        f"{len(latencies) / seconds:7.0f} reads/s  p50={q[49] * 1e3:6.1f} ms  "
+        f"p99={q[98] * 1e3:7.1f} ms  {writes / seconds:5.0f} writes/s  {errors} errors"
+    )
+
+
+async def bench_reads(seconds: float, n_readers: int, n_users: int):
+    profiles = (
+        ("default", dict(pragmas={}, read_pool_size=0)),
+        ("WAL, 1 writer + readers", dict(pragmas=SQLITE_PRAGMAS)),
+    )
+    for label, kwargs in profiles:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = Database(f"sqlite+aiosqlite:///{os.path.join(tmp, 'bench.db')}", **kwargs)
+            await db.init_db()
+            await _seed_users(db, n_users, 100)
+            sender, recipient = await db.get_user_by_id(1), await db.get_user_by_id(2)
+            for i in range(50):
+                await db.store_message(sender, recipient, "x" * 100)
+            for load in ("idle", "senders", "process"):
+                result = await _read_load(db, seconds, n_readers, load, kwargs["pragmas"])
+                print(f"{label:<24} {load:<8} {result}")
+            await db.close()
+
+
+# the schema before migrations.py: no conversation key, no composite indexes
+_OLD_SCHEMA = [
+    "CREATE TABLE messages (id INTEGER PRIMARY KEY, sender_id INTEGER, recipient_id INTEGER, "
+    "content TEXT, timestamp DATETIME, is_read BOOLEAN, message_number INTEGER)",
+    "CREATE TABLE user_chats (id INTEGER PRIMARY KEY, user_id INTEGER, peer_id INTEGER, "
+    "last_message_id INTEGER, last_interaction DATETIME)",
+]
+_HISTORY_OLD = (
+    "SELECT * FROM messages WHERE (sender_id = 1 AND recipient_id = 2) "
+    "OR (sender_id = 2 AND recipient_id = 1) ORDER BY timestamp"
+)
+_HISTORY_NEW = "SELECT * FROM messages WHERE conversation_key = '1:2' ORDER BY id"
+_CHAT_LOOKUP = "SELECT * FROM user_chats WHERE user_id = 1 AND peer_id = 2"
+
+
+async def _query(db: Database, label: str, sql: str):
+    async with db.engine.connect() as conn:
+        plan = (await conn.execute(text(f"EXPLAIN QUERY PLAN {sql}"))).all()
+        start = time.perf_counter()
+        rows = (await conn.execute(text(sql))).all()
+        _timed(label, start, f"({len(rows)} rows) {' / '.join(row[-1] for row in plan)}")
+
+
+async def bench_history(n_messages: int, n_users: int):
+    """Old schema with n_messages, then the migration, then the same queries."""
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(f"sqlite+aiosqlite:///{os.path.join(tmp, 'bench.db')}")
+        async with db.engine.begin() as conn:
+            for stmt in _OLD_SCHEMA:
+                await conn.execute(text(stmt))
+            start = time.perf_counter()
+            # every ordered pair of users gets the same number of messages
+            await conn.execute(
+                text(
+                    "WITH RECURSIVE n(x) AS (SELECT 0 UNION ALL SELECT x + 1 FROM n WHERE x < :last) "
+                    "INSERT INTO messages (sender_id, recipient_id, content, timestamp, is_read, message_number) "
+                    "SELECT x % :users + 1, (x / :users) % :users + 1, 'x', "
+                    "datetime('2024-01-01', '+' || x || ' seconds'), 0, 0 FROM n"
+                ),
+                {"last": n_messages - 1, "users": n_users},
+            )
+            await conn.execute(
+                text(
+                    "WITH RECURSIVE n(x) AS (SELECT 0 UNION ALL SELECT x + 1 FROM n WHERE x < :last) "
+                    "INSERT INTO user_chats (user_id, peer_id, last_message_id, last_interaction) "
+                    "SELECT x % :users + 1, x / :users + 1, x + 1, datetime('2024-01-01') FROM n"
+                ),
+                {"last": n_users * n_users - 1, "users": n_users},
+            )
+        print(f"{n_messages} messages, {n_users * n_users} chats")
+        _timed("seed", start)
+
+        await _query(db, "old: history (OR)", _HISTORY_OLD)
+        await _query(db, "old: chat lookup", _CHAT_LOOKUP)
+
+        start = time.perf_counter()
+        await db.init_db()
+        _timed("init_db (migrations)", start)
+
+        await _query(db, "new: history (OR)", _HISTORY_OLD)
+        await _query(db, "new: history (conversation key)", _HISTORY_NEW)
+        await _query(db, "new: chat lookup", _CHAT_LOOKUP)
+        for run in ("cold", "warm"):
+            start = time.perf_counter()
+            rows = await db.get_chat_history(1, 2)
+            _timed(f"new: get_chat_history(1, 2) {run}", start, f"({len(rows)} rows)")
+        await db.close()
+
+
+async def _chat_old(db: Database, user_id: int, peer_id: int) -> list[dict]:
+    """The previous GET /users/{id}/chat: full history, ORM objects and both users."""
+    async with db.read_session_factory() as session:
+        result = await session.execute(
+            select(Message)
+            .options(selectinload(Message.sender))
+            .options(selectinload(Message.recipient))
+            .where(
+                or_(
+                    and_(Message.sender_id == user_id, Message.recipient_id == peer_id),
+                    and_(Message.sender_id == peer_id, Message.recipient_id == user_id),
+                )
+            )
+            .order_by(Message.timestamp.asc())
+        )
+        messages = result.scalars().all()
+    return [
+        {"id": m.id, "sender": m.sender.username, "recipient": m.recipient.username}
+        for m in messages
+    ]
+
+
+async def bench_chat(n_messages: int):
+    """One long conversation between users 1 and 2."""
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(f"sqlite+aiosqlite:///{os.path.join(tmp, 'bench.db')}")
+        await db.init_db()
+        await _seed_users(db, 10, 0)
+        now = datetime.utcnow()
+        async with db.async_session_factory() as session:
+            async with session.begin():
+                await session.execute(
+                    insert(Message),
+                    [
+                        {"sender_id": 1 + i % 2, "recipient_id": 2 - i % 2, "content": "x" * 100, "timestamp": now}
+                        for i in range(n_messages)
+                    ],
+                )
+        print(f"{n_messages} messages in one chat")
+
+        start = time.perf_counter()
+        rows = await _chat_old(db, 1, 2)
+        _timed("old: full history + users", start, f"({len(rows)} rows)")
+        start = time.perf_counter()
+        rows = await db.get_chat_history(1, 2)
+        _timed("full history, columns only", start, f"({len(rows)} rows)")
+        start = time.perf_counter()
+        rows = await db.get_chat_history(1, 2, limit=50)
+        _timed("newest page of 50", start, f"({len(rows)} rows)")
+        start = time.perf_counter()
+        rows = await db.get_chat_history(1, 2, limit=50, before_id=n_messages // 2)
+        _timed("page of 50 in the middle", start, f"({len(rows)} rows)")
+        start = time.perf_counter()
+        count = 0
+        async for rows in db.iter_chat_history(1, 2):
+            count += len(rows)
+        _timed("export in batches of 1000", start, f"({count} rows)")
+        await db.close()
+
+
+async def bench_pending(n_history: int, n_pending: int):
+    """Reconnect after missing n_pending messages of a chat with n_history messages."""
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(f"sqlite+aiosqlite:///{os.path.join(tmp, 'bench.db')}")
+        await db.init_db()
+        await _seed_users(db, 10, 0)
+        now = datetime.utcnow()
+        async with db.async_session_factory() as session:
+            async with session.begin():
+                await session.execute(
+                    insert(Message),
+                    [
+                        {"sender_id": 1 + i % 2, "recipient_id": 2 - i % 2, "content": "x" * 100, "timestamp": now}
+                        for i in range(n_history)
+                    ],
+                )
+        sender, recipient = await db.get_user_by_id(1), await db.get_user_by_id(2)
+        db.start_writer()
+        for _ in range(n_pending):
+            message = await db.enqueue_message(sender, recipient, "x" * 100)
+            await db.enqueue_pending_delivery(recipient.id, message.id)
+        print(f"{n_history} messages in the chat, {n_pending} missed")
+
+        start = time.perf_counter()
+        rows = await db.get_chat_history(2, 1)
+        _timed("reload full history", start, f"({len(rows)} rows)")
+
+        start = time.perf_counter()
+        after_id, frames, count = 0, 0, 0
+        while True:
+            rows = await db.get_pending_deliveries(2, after_id)
+            if not rows:
+                break
+            frames += 1
+            count += len(rows)
+            await db.delete_pending_deliveries(2, [row.id for row in rows])
+            after_id = rows[-1].pending_id
+        _timed("drain pending + ack", start, f"({count} rows, {frames} frames)")
+        await db.stop_writer()
+        await db.close()
+
+
+async def _login_old(db: Database, username: str, password: str):
+    """The previous login: bcrypt on the event loop."""
+    async with db.read_session_factory() as session:
+        user = (await session.execute(select(User).where(User.username == username))).scalars().first()
+        return user if user and verify_password(password, user.password_hash) else None
+
+
+async def _login_storm(db: Database, n_logins: int, login) -> str:
+    """n_logins concurrent logins while a ticker measures how late the event loop is."""
+    lags, latencies, rejected, done = [], [], 0, False
+
+    async def ticker():
+        while not done:
+            start = time.perf_counter()
+            await asyncio.sleep(0.005)
+            lags.append((time.perf_counter() - start - 0.005) * 1e3)
+
+    async def one(i: int):
+        nonlocal rejected
+        start = time.perf_counter()
+        try:
+            assert await login(db, f"user{i % 100 + 1}", "password")
+            latencies.append((time.perf_counter() - start) * 1e3)
+        except HasherBusy:
+            rejected += 1
+
+    tick = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(n_logins)))
+    elapsed = time.perf_counter() - start
+    done = True
+    await tick
+    latencies.sort()
+    lags.sort()
+    return (
+        f"{len(latencies) / elapsed:7.1f} logins/s  "
+        f"p50={latencies[len(latencies) // 2]:7.1f} ms  p99={latencies[int(len(latencies) * 0.99)]:7.1f} ms  "
+        f"loop lag p99={lags[int(len(lags) * 0.99)]:6.1f} ms max={lags[-1]:6.1f} ms  "
+        f"rejected={rejected}"
+    )
+
+
+async def bench_logins(n_logins: int, worker_counts: list[int], max_queue: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(f"sqlite+aiosqlite:///{os.path.join(tmp, 'bench.db')}")
+        await db.init_db()
+        await _seed_users(db, 100, 0)
+        async with db.async_session_factory() as session:
+            async with session.begin():
+                await session.execute(
+                    text("UPDATE users SET password_hash = :h"), {"h": get_password_hash("password")}
+                )
+        print(f"{n_logins} concurrent logins")
+        print(f"{'bcrypt on the loop':<28} {await _login_storm(db, n_logins, _login_old)}")
+        db.hasher.shutdown()
+        for workers in worker_counts:
+            for queue in (n_logins, max_queue):
+                db.hasher = PasswordHasher(workers, queue)
+                label = f"pool workers={workers} queue={queue}"
+                result = await _login_storm(
+                    db, n_logins, lambda db, u, p: db.get_user_by_username_and_password(u, p)
+                )
+                print(f"{label:<28} {result}")
+                db.hasher.shutdown()
+        await db.close()
+
+
+def _bench_logger(name: str, handlers: list, filters: list = ()) -> logging.Logger:
+    log = logging.getLogger(f"bench.{name}")
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    log.handlers = handlers
+    for f in filters:
+        log.addFilter(f)
+    return log
+
+
+def bench_logging(n_messages: int):
+    """Time spent on the event loop per websocket message for its log lines."""
+    message = {
+        "id": 1, "sender": {"id": 1, "username": "alice"}, "recipient": {"id": 2, "username": "bob"},
+        "content": "x" * 300, "timestamp": datetime.utcnow().isoformat(), "message_number": 1,
+    }
+
+    def old(log):
+        # the five INFO lines the websocket handler used to write per message
+        log.info(f"Recipient ID: {2}")
+        log.info(f"Getting recipient user by ID: {2}")
+        log.info(f"Message created: {message}")
+        log.info(f"Message JSON: {message}")
+        log.info(f"Message sent status: {True}")
+
+    def new(log):
+        log.info("Message %s from %s to %s delivered=%s", 1, 1, 2, True,
+                 extra={"message_id": 1, "sender_id": 1, "recipient_id": 2})
+
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, "w") as devnull:
+        def sync_handlers(formatter):
+            handlers = [
+                logging.StreamHandler(devnull),
+                logging.FileHandler(os.path.join(tmp, f"{len(os.listdir(tmp))}.log")),
+            ]
+            for handler in handlers:
+                handler.setFormatter(formatter)
+            return handlers
+
+        def queued(formatter):
+            q = queue.SimpleQueue()
+            listener = logging.handlers.QueueListener(q, *sync_handlers(formatter))
+            return [logging.handlers.QueueHandler(q)], listener
+
+        text_fmt = logging.Formatter(TEXT_FORMAT)
+        cases = [
+            ("off", lambda: (None, None), lambda log: None),
+            ("old: 5 f-strings, sync", lambda: (sync_handlers(text_fmt), None), old),
+            ("1 line, sync", lambda: (sync_handlers(text_fmt), None), new),
+            ("1 line, queue", lambda: queued(text_fmt), new),
+            ("1 line, queue, json", lambda: queued(JsonFormatter()), new),
+            ("1 line, queue, sampled 1%", lambda: queued(JsonFormatter()), new),
+        ]
+        for label, make, emit in cases:
+            handlers, listener = make()
+            filters = [SampleFilter(0.01), RateLimitFilter(10)] if "sampled" in label else []
+            log = _bench_logger(label, handlers or [], filters)
+            if listener:
+                listener.start()
+            start = time.perf_counter()
+            for _ in range(n_messages):
+                emit(log)
+            on_loop = time.perf_counter() - start
+            if listener:
+                # waits until the listener thread has written everything
+                listener.stop()
+            written = time.perf_counter() - start
+            print(
+                f"{label:<28} {on_loop / n_messages * 1e6:8.2f} us/message on the loop"
+                f"  {written / n_messages * 1e6:8.2f} us/message until written"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    online = sub.add_parser("online", help="GET /users/online query")
+    online.add_argument("--users", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    online.add_argument("--chats", type=int, default=100)
+    online.add_argument("--skip-old-above", type=int, default=100_000)
+
+    messages = sub.add_parser("messages", help="websocket message persistence")
+    messages.add_argument("--messages", type=int, default=2000)
+    messages.add_argument("--senders", type=int, nargs="+", default=[1, 20])
+    messages.add_argument(
+        "--windows", type=float, nargs="+", default=[1, 5, 20], help="group commit windows in ms"
+    )
+
+    reads = sub.add_parser("reads", help="read latency under write load")
+    reads.add_argument("--seconds", type=float, default=5)
+    reads.add_argument("--readers", type=int, default=8)
+    reads.add_argument("--users", type=int, default=10_000)
+
+    history = sub.add_parser("history", help="chat history indexes and migration")
+    history.add_argument("--messages", type=int, default=10_000_000)
+    history.add_argument("--users", type=int, default=1000)
+
+    chat = sub.add_parser("chat", help="chat history pages and export")
+    chat.add_argument("--messages", type=int, default=100_000)
+
+    pending = sub.add_parser("pending", help="backlog of a reconnecting user")
+    pending.add_argument("--history", type=int, default=100_000)
+    pending.add_argument("--pending", type=int, default=1000)
+
+    logins = sub.add_parser("logins", help="bcrypt during a login storm")
+    logins.add_argument("--logins", type=int, default=50)
+    logins.add_argument("--workers", type=int, nargs="+", default=[1, 4])
+    logins.add_argument("--max-queue", type=int, default=16)
+
+    logging_ = sub.add_parser("logging", help="log overhead per websocket message")
+    logging_.add_argument("--messages", type=int, default=20_000)
+
+    args = parser.parse_args()
+    if args.command == "online":
+        asyncio.run(bench_online(args.users, args.chats, args.skip_old_above))
+    elif args.command == "messages":
+        asyncio.run(bench_messages(args.messages, args.senders, args.windows))
+    elif args.command == "reads":
+        asyncio.run(bench_reads(args.seconds, args.readers, args.users))
+    elif args.command == "history":
+        asyncio.run(bench_history(args.messages, args.users))
+    elif args.command == "chat":
+        asyncio.run(bench_chat(args.messages))
+    elif args.command == "pending":
+        asyncio.run(bench_pending(args.history, args.pending))
+    elif args.command == "logins":
+        asyncio.run(bench_logins(args.logins, args.workers, args.max_queue))
+    elif args.command == "logging":
+        bench_logging(args.messages)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,8 @@
+import os
+import asyncio
+from urllib.parse import quote
 from datetime import datetime
-from typing import List, Optional
+from typing import List, Optional, Union
 from passlib.context import CryptContext
 
 from sqlalchemy import (
@@ -11,13 +14,39 @@ from sqlalchemy import (
     String,
     select,
     update,
+    delete,
     or_,
     and_,
+    text,
+    event,
 )
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.sql.dml import Delete
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, selectinload
-from models import Base, User, Message, UserChat
+from models import (
+    Base,
+    User,
+    Message,
+    UserChat,
+    PendingDelivery,
+    conversation_key,
+    message_content,
+)
+from migrations import migrate
+from cache import TTLCache
+from hasher import PasswordHasher
+from config import (
+    USER_CACHE_SIZE,
+    USER_CACHE_TTL,
+    WRITE_BATCH_WINDOW_MS,
+    WRITE_BATCH_MAX_MESSAGES,
+    SQLITE_PRAGMAS,
+    SQLITE_READ_POOL_SIZE,
+    PENDING_BATCH_SIZE,
+)
 
 
 # --- logger Setup ---
@@ -31,28 +60,126 @@ def get_password_hash(password: str) -> str:
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    logger.debug(f"Verifying password: {plain_password}")
-    logger.debug(f"Hashed password: {hashed_password}")
     return pwd_context.verify(plain_password, hashed_password)
 
 # --- Database Interaction Class ---
+def _set_pragmas(engine, pragmas: dict):
+    """Runs the pragmas on every new connection of the engine."""
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
 class Database:
-    def __init__(self, db_url="sqlite+aiosqlite:///murmly.db"):
-        # echo=False is usually preferred for production/less verbose logs
-        self.engine = create_async_engine(db_url, echo=False)
+    """Database access.
+
+    For a SQLite file all writes go through one connection (SQLite allows a
+    single writer anyway, this way writers queue in the pool instead of
+    retrying on SQLITE_BUSY) and reads use a pool of read only connections,
+    which WAL mode lets run next to the writer. Other URLs use one engine.
+    """
+
+    def __init__(
+        self,
+        db_url="sqlite+aiosqlite:///murmly.db",
+        pragmas: dict = SQLITE_PRAGMAS,
+        read_pool_size: int = SQLITE_READ_POOL_SIZE,
+        hasher: Optional[PasswordHasher] = None,
+    ):
+        url = make_url(db_url)
+        is_sqlite = url.get_backend_name() == "sqlite"
+        is_file = (
+            is_sqlite
+            and url.database not in (None, "", ":memory:")
+            and not url.database.startswith("file:")
+        )
+
+        if is_file and read_pool_size:
+            # echo=False is usually preferred for production/less verbose logs
+            self.engine = create_async_engine(
+                db_url, echo=False, pool_size=1, max_overflow=0
+            )
+            # the path goes into a file: URI, so "#", "?" and "%" must be escaped
+            read_url = URL.create(
+                url.drivername,
+                database=f"file:{quote(os.path.abspath(url.database))}",
+                query={"mode": "ro", "uri": "true"},
+            )
+            self.read_engine = create_async_engine(
+                read_url, echo=False, pool_size=read_pool_size, max_overflow=0
+            )
+            # journal mode is stored in the file, set by the writer
+            _set_pragmas(self.engine, pragmas)
+            _set_pragmas(
+                self.read_engine,
+                {k: v for k, v in pragmas.items() if k != "journal_mode"},
+            )
+        else:
+            self.engine = create_async_engine(db_url, echo=False)
+            self.read_engine = self.engine
+            if is_sqlite:
+                _set_pragmas(self.engine, pragmas)
+
         self.async_session_factory = sessionmaker(
             self.engine, class_=AsyncSession, expire_on_commit=False
         )
+        self.read_session_factory = sessionmaker(
+            self.read_engine, class_=AsyncSession, expire_on_commit=False
+        )
         logger.info(f"Async database engine created for {db_url}")
+        # detached user rows, is_online/last_seen may be stale (see PresenceTracker)
+        self.users_by_id = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+        self.users_by_name = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+        # bcrypt off the event loop
+        self.hasher = hasher or PasswordHasher()
+        # group commit queue of (row, future), see start_writer
+        self._write_queue: Optional[asyncio.Queue] = None
+        self._writer_task: Optional[asyncio.Task] = None
 
     async def init_db(self):
         """Initializes the database and creates tables if they don't exist."""
         async with self.engine.begin() as conn:
             logger.info("Running metadata create_all...")
             await conn.run_sync(Base.metadata.create_all)
+            version = await migrate(conn)
+            logger.info(f"Database schema at version {version}")
             print("Database tables created.")
             logger.info("Database tables ensured.")
 
+    async def close(self):
+        self.hasher.shutdown()
+        await self.engine.dispose()
+        if self.read_engine is not self.engine:
+            await self.read_engine.dispose()
+
+    # --- User Cache ---
+    def _cache_generation(self) -> tuple[int, int]:
+        """Take before reading a user row, see TTLCache."""
+        return self.users_by_id.generation(), self.users_by_name.generation()
+
+    def _cache_user(self, user: Optional[User], generation: tuple[int, int]):
+        if user:
+            self.users_by_id.set(user.id, user, generation=generation[0])
+            self.users_by_name.set(user.username, user, generation=generation[1])
+
+    def invalidate_user(self, user: User):
+        """Drops a user from the caches, call after every write to the user row."""
+        self.users_by_id.invalidate(user.id)
+        self.users_by_name.invalidate(user.username)
+
+    def cache_stats(self) -> dict:
+        return {
+            "users_by_id": self.users_by_id.stats(),
+            "users_by_name": self.users_by_name.stats(),
+        }
+
+    def write_queue_depth(self) -> int:
+        return self._write_queue.qsize() if self._write_queue else 0
+
     # --- User Operations ---
     async def create_user(
         self,
@@ -60,6 +187,8 @@ class Database:
         password: str,
     ) -> Optional[User]:
         """Creates a new user,"""
+        # hash before the transaction, the writer connection is not held while bcrypt runs
+        hashed_password = await self.hasher.run(get_password_hash, password)
         async with self.async_session_factory() as session:
             async with session.begin():
                 stmt_exists = select(User).where((User.username == username))
@@ -72,7 +201,6 @@ class Database:
                         f"User '{username}' already exists. Please choose a different username."
                     )
 
-                hashed_password = get_password_hash(password)
                 new_user = User(
                     username=username, password_hash=hashed_password, is_online=False
                 )
@@ -84,23 +212,28 @@ class Database:
 
     async def get_user_by_username(self, username: str) -> Optional[User]:
         """Retrieves a user by their username."""
-        async with self.async_session_factory() as session:
+        user = self.users_by_name.get(username)
+        if user:
+            return user
+        generation = self._cache_generation()
+        async with self.read_session_factory() as session:
             stmt = select(User).where(User.username == username)
             result = await session.execute(stmt)
             user = result.scalars().first()
+            self._cache_user(user, generation)
             return user
 
     async def get_user_by_username_and_password(
         self, username: str, password: str
     ) -> Optional[User]:
         """Authenticates a user by checking their username and password."""
-        async with self.async_session_factory() as session:
+        async with self.read_session_factory() as session:
             stmt = select(User).where(User.username == username)
             result = await session.execute(stmt)
             user = result.scalars().first()
-            if user and verify_password(password, user.password_hash):
-                return user
-            return None
+        if user and await self.hasher.run(verify_password, password, user.password_hash):
+            return user
+        return None
 
     async def update_user_jwt(self, username: str, jwt: str) -> bool:
         """Updates the JWT for a user."""
@@ -124,29 +257,34 @@ class Database:
 
     async def update_user_public_key(self, user: User, public_key_b64: str) -> bool:
         """Updates the public key for a user."""
-        async with self.async_session_factory() as session:
-            async with session.begin():
-                stmt = (
-                    update(User)
-                    .where(User.id == user.id)
-                    .values(public_key_b64=public_key_b64)
-                    .execution_options(synchronize_session="fetch")
-                )
-                result = await session.execute(stmt)
-                if result.rowcount == 0:
-                    logger.warning(
-                        f"Attempted to update public key for non-existent user '{user.username}'"
+        try:
+            async with self.async_session_factory() as session:
+                async with session.begin():
+                    stmt = (
+                        update(User)
+                        .where(User.id == user.id)
+                        .values(public_key_b64=public_key_b64)
+                        .execution_options(synchronize_session="fetch")
                     )
-                    return False
-                else:
-                    logger.debug(
-                        f"Set user '{user.username}' public key to {public_key_b64}"
-                    )
-                    return True
+                    result = await session.execute(stmt)
+                    if result.rowcount == 0:
+                        logger.warning(
+                            f"Attempted to update public key for non-existent user '{user.username}'"
+                        )
+                        return False
+                    else:
+                        logger.debug(
+                            f"Set user '{user.username}' public key to {public_key_b64}"
+                        )
+                        return True
+        finally:
+            # after the commit, so later reads see the new key. Reads that
+            # started before it skip caching their row, see TTLCache.
+            self.invalidate_user(user)
 
     async def get_user_by_public_key(self, public_key_b64: str) -> Optional[User]:
         """Retrieves a user by their public key."""
-        async with self.async_session_factory() as session:
+        async with self.read_session_factory() as session:
             stmt = select(User).where(User.public_key_b64 == public_key_b64)
             result = await session.execute(stmt)
             user = result.scalars().first()
@@ -154,19 +292,32 @@ class Database:
 
     async def get_user_by_id(self, user_id: int) -> Optional[User]:
         """Retrieves a user by their ID."""
-        async with self.async_session_factory() as session:
+        user = self.users_by_id.get(user_id)
+        if user:
+            return user
+        generation = self._cache_generation()
+        async with self.read_session_factory() as session:
             stmt = select(User).where(User.id == user_id)
             result = await session.execute(stmt)
             user = result.scalars().first()
+            self._cache_user(user, generation)
             return user
 
+    async def get_public_keys(self, user_ids: list[int]) -> list:
+        """(id, username, public_key_b64) rows of the users that exist."""
+        async with self.read_session_factory() as session:
+            result = await session.execute(
+                select(User.id, User.username, User.public_key_b64).where(User.id.in_(user_ids))
+            )
+            return result.all()
+
     async def get_online_users(self) -> List[User]:
         """Retrieves a list of usernames for all online users."""
-        async with self.async_session_factory() as session:
+        async with self.read_session_factory() as session:
             stmt = select(User).where(User.is_online == True)
             result = await session.execute(stmt)
             online_users = result.scalars().all()
-            logger.info(f"Online users: {[user for user in online_users]}")
+            logger.debug("%d users online", len(online_users))
             return online_users
 
     async def set_user_online_status(self, user: User, is_online: bool) -> bool:
@@ -217,7 +368,7 @@ class Database:
 
     async def get_messages(self, username: str) -> List[Message]:
         """Retrieves all messages for a user."""
-        async with self.async_session_factory() as session:
+        async with self.read_session_factory() as session:
             stmt = select(Message).where(Message.sender_id == username)
             result = await session.execute(stmt)
             messages = result.scalars().all()
@@ -227,7 +378,7 @@ class Database:
         self, sender_username: User, recipient_username: User
     ) -> List[Message]:
         """Retrieves all messages between two users."""
-        async with self.async_session_factory() as session:
+        async with self.read_session_factory() as session:
             stmt = select(Message).where(
                 (Message.sender_id == sender_username.id)
                 & (Message.recipient_id == recipient_username.id)
@@ -238,7 +389,7 @@ class Database:
 
     async def get_user_chats(self, user_id: int) -> List[UserChat]:
         """Get all chats for a user"""
-        async with self.async_session_factory() as session:
+        async with self.read_session_factory() as session:
             result = await session.execute(
                 select(UserChat)
                 .options(selectinload(UserChat.last_message))
@@ -247,47 +398,287 @@ class Database:
             )
             return result.scalars().all()
 
-    async def get_chat_history(self, user_id: int, peer_id: int) -> List[Message]:
-        """Get chat history between two users"""
+    def _chat_history_stmt(self, user_id: int, peer_id: int):
+        # plain columns, the two users of a chat are known to the caller
+        return select(
+            Message.id,
+            Message.sender_id,
+            Message.recipient_id,
+            Message.content,
+            Message.ciphertext,
+            Message.timestamp,
+            Message.message_number,
+        ).where(Message.conversation_key == conversation_key(user_id, peer_id))
+
+    async def get_chat_history(
+        self,
+        user_id: int,
+        peer_id: int,
+        limit: Optional[int] = None,
+        before_id: Optional[int] = None,
+    ) -> list:
+        """Get chat history between two users, oldest first.
+
+        With `limit` only the newest `limit` messages older than `before_id`
+        are returned, pass the smallest id of a page to get the one before it.
+        """
+        stmt = self._chat_history_stmt(user_id, peer_id)
+        if before_id is not None:
+            stmt = stmt.where(Message.id < before_id)
+        # newest first so the limit keeps the latest messages, one range of
+        # ix_messages_conversation_id read backwards
+        stmt = stmt.order_by(Message.id.desc())
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        async with self.read_session_factory() as session:
+            result = await session.execute(stmt)
+            rows = result.all()
+        rows.reverse()
+        return rows
+
+    async def iter_chat_history(self, user_id: int, peer_id: int, batch: int = 1000):
+        """Yields the whole chat history oldest first, in batches of rows.
+
+        Every batch is its own short query, so a slow reader does not keep a
+        connection of the read pool busy.
+        """
+        last_id = 0
+        while True:
+            stmt = (
+                self._chat_history_stmt(user_id, peer_id)
+                .where(Message.id > last_id)
+                .order_by(Message.id)
+                .limit(batch)
+            )
+            async with self.read_session_factory() as session:
+                rows = (await session.execute(stmt)).all()
+            if not rows:
+                return
+            yield rows
+            if len(rows) < batch:
+                return
+            last_id = rows[-1].id
+
+    async def _upsert_user_chats(
+        self, session: AsyncSession, rows: List[tuple[int, int, int]]
+    ):
+        """INSERT ... ON CONFLICT DO UPDATE of (user_id, peer_id, message_id) rows."""
+        now = datetime.utcnow()
+        stmt = sqlite_insert(UserChat).values(
+            [
+                {
+                    "user_id": user_id,
+                    "peer_id": peer_id,
+                    "last_message_id": message_id,
+                    "last_interaction": now,
+                }
+                for user_id, peer_id, message_id in rows
+            ]
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[UserChat.user_id, UserChat.peer_id],
+            set_={
+                "last_message_id": stmt.excluded.last_message_id,
+                "last_interaction": stmt.excluded.last_interaction,
+            },
+        )
+        await session.execute(stmt)
+
+    async def store_message(
+        self, sender: User, recipient: User, content: Union[str, bytes], message_number: int = 0
+    ) -> Message:
+        """Stores a message and updates the chat records of both users.
+
+        One transaction, one commit per message.
+        """
         async with self.async_session_factory() as session:
-            result = await session.execute(
-                select(Message)
-                .options(selectinload(Message.sender))
-                .options(selectinload(Message.recipient))
-                .where(
-                    or_(
-                        and_(Message.sender_id == user_id, Message.recipient_id == peer_id),
-                        and_(Message.sender_id == peer_id, Message.recipient_id == user_id)
-                    )
+            async with session.begin():
+                message = Message(
+                    sender_id=sender.id,
+                    recipient_id=recipient.id,
+                    message_number=message_number,
+                    **message_content(content),
                 )
-                .order_by(Message.timestamp.asc())
+                session.add(message)
+                await session.flush()
+                await self._upsert_user_chats(
+                    session,
+                    [
+                        (sender.id, recipient.id, message.id),
+                        (recipient.id, sender.id, message.id),
+                    ],
+                )
+            logger.debug("Stored message from %s to %s", sender.username, recipient.username)
+            return message
+
+    # --- Group Commit ---
+    def start_writer(
+        self,
+        window_ms: float = WRITE_BATCH_WINDOW_MS,
+        max_messages: int = WRITE_BATCH_MAX_MESSAGES,
+    ):
+        """Starts the background task that writes queued messages in batches.
+
+        A batch is committed `window_ms` after its first message or as soon as
+        it holds `max_messages`, so all messages of a batch share one fsync.
+        """
+        self._write_queue = asyncio.Queue()
+        self._writer_task = asyncio.create_task(
+            self._writer_loop(window_ms / 1000, max_messages)
+        )
+
+    async def stop_writer(self):
+        """Writes what is still queued and stops the writer task."""
+        if not self._writer_task:
+            return
+        self._write_queue.put_nowait(None)
+        await self._writer_task
+        self._writer_task = None
+        self._write_queue = None
+
+    async def enqueue_message(
+        self, sender: User, recipient: User, content: Union[str, bytes], message_number: int = 0
+    ) -> Message:
+        """Like store_message, but shares the commit with other queued messages.
+
+        Returns once the batch containing the message is committed. Without a
+        running writer the message is stored on its own.
+        """
+        if self._write_queue is None:
+            return await self.store_message(sender, recipient, content, message_number)
+        message = Message(
+            sender_id=sender.id,
+            recipient_id=recipient.id,
+            message_number=message_number,
+            **message_content(content),
+        )
+        return await self._submit(message)
+
+    async def _submit(self, row):
+        """Queues an ORM row to insert or a DELETE statement for the next batch."""
+        future = asyncio.get_running_loop().create_future()
+        self._write_queue.put_nowait((row, future))
+        return await future
+
+    async def _writer_loop(self, window: float, max_messages: int):
+        loop = asyncio.get_running_loop()
+        queue = self._write_queue
+        stopping = False
+        while not stopping:
+            item = await queue.get()
+            if item is None:  # stop_writer, everything before it is written
+                return
+            batch = [item]
+            deadline = loop.time() + window
+            while len(batch) < max_messages:
+                timeout = deadline - loop.time()
+                try:
+                    # take what is already queued without waiting
+                    if queue.empty() and timeout > 0:
+                        item = await asyncio.wait_for(queue.get(), timeout)
+                    else:
+                        item = queue.get_nowait()
+                except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._write_batch(batch)
+
+    async def _write_batch(self, batch: list[tuple[object, asyncio.Future]]):
+        """Inserts a batch of rows and the chat records of its messages in one transaction."""
+        rows = [row for row, _ in batch]
+        messages = [row for row in rows if isinstance(row, Message)]
+        # delete statements are executed after the inserts, their result is the rowcount
+        results = {}
+        try:
+            async with self.async_session_factory() as session:
+                async with session.begin():
+                    session.add_all([row for row in rows if not isinstance(row, Delete)])
+                    await session.flush()
+                    for row in rows:
+                        if isinstance(row, Delete):
+                            results[id(row)] = (await session.execute(row)).rowcount
+                    # one row per (user, peer), the newest message wins
+                    chats = {}
+                    for message in messages:
+                        chats[(message.sender_id, message.recipient_id)] = message.id
+                        chats[(message.recipient_id, message.sender_id)] = message.id
+                    if chats:
+                        await self._upsert_user_chats(
+                            session, [(u, p, m) for (u, p), m in chats.items()]
+                        )
+        except Exception as e:
+            logger.error(f"Failed to write batch of {len(batch)} rows: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        logger.debug("Committed batch of %d rows", len(batch))
+        for row, future in batch:
+            # the sender may have disconnected and cancelled its wait
+            if not future.done():
+                future.set_result(results.get(id(row), row))
+
+    # --- Store and Forward ---
+    async def enqueue_pending_delivery(self, recipient_id: int, message_id: int):
+        """Keeps a message for a recipient that is offline, see get_pending_deliveries."""
+        delivery = PendingDelivery(recipient_id=recipient_id, message_id=message_id)
+        if self._write_queue is not None:
+            await self._submit(delivery)
+            return
+        async with self.async_session_factory() as session:
+            async with session.begin():
+                session.add(delivery)
+
+    async def get_pending_deliveries(
+        self, recipient_id: int, after_id: int = 0, limit: int = PENDING_BATCH_SIZE
+    ) -> list:
+        """Unacknowledged messages of a user, oldest first.
+
+        Rows have the pending delivery id as `pending_id`, pass the last one as
+        `after_id` to get the next batch.
+        """
+        stmt = (
+            select(
+                PendingDelivery.id.label("pending_id"),
+                Message.id,
+                Message.sender_id,
+                User.username.label("sender_username"),
+                Message.content,
+                Message.ciphertext,
+                Message.timestamp,
+                Message.message_number,
             )
-            return result.scalars().all()
+            .join(Message, Message.id == PendingDelivery.message_id)
+            .join(User, User.id == Message.sender_id)
+            .where(PendingDelivery.recipient_id == recipient_id, PendingDelivery.id > after_id)
+            .order_by(PendingDelivery.id)
+            .limit(limit)
+        )
+        async with self.read_session_factory() as session:
+            result = await session.execute(stmt)
+            return result.all()
+
+    async def delete_pending_deliveries(self, recipient_id: int, message_ids: List[int]) -> int:
+        """Deletes acknowledged messages of a user in one statement."""
+        stmt = delete(PendingDelivery).where(
+            PendingDelivery.recipient_id == recipient_id,
+            PendingDelivery.message_id.in_(message_ids),
+        )
+        if self._write_queue is not None:
+            return await self._submit(stmt)
+        async with self.async_session_factory() as session:
+            async with session.begin():
+                result = await session.execute(stmt)
+        return result.rowcount
 
     async def update_user_chat(self, user_id: int, peer_id: int, message_id: int):
         """Update or create a chat record between two users"""
         async with self.async_session_factory() as session:
-            chat = await session.execute(
-                select(UserChat)
-                .where(
-                    and_(UserChat.user_id == user_id, UserChat.peer_id == peer_id)
-                )
-            )
-            chat = chat.scalar_one_or_none()
-            
-            if chat:
-                chat.last_message_id = message_id
-                chat.last_interaction = datetime.utcnow()
-            else:
-                chat = UserChat(
-                    user_id=user_id,
-                    peer_id=peer_id,
-                    last_message_id=message_id,
-                    last_interaction=datetime.utcnow()
-                )
-                session.add(chat)
-            
-            await session.commit()
+            async with session.begin():
+                await self._upsert_user_chats(session, [(user_id, peer_id, message_id)])
 
     async def update_user_status(self, user_id: int, is_online: bool):
         """Update user's online status and last seen timestamp"""
@@ -298,8 +689,54 @@ class Database:
                 user.last_seen = datetime.utcnow()
                 await session.commit()
 
+    async def get_users_with_last_message(
+        self, user_id: int, limit: Optional[int] = None, cursor: Optional[int] = None
+    ) -> List[tuple[User, Optional[Message]]]:
+        """Get all other users with the last message exchanged with user_id.
+
+        One query joining users, user_chats and messages, ordered by user id.
+        `cursor` is the last user id of the previous page.
+        """
+        async with self.read_session_factory() as session:
+            stmt = (
+                select(User, Message)
+                .outerjoin(
+                    UserChat,
+                    and_(UserChat.user_id == user_id, UserChat.peer_id == User.id),
+                )
+                .outerjoin(Message, Message.id == UserChat.last_message_id)
+                # a range on the primary key lets SQLite stop after `limit` rows
+                .where(User.id > (cursor or 0), User.id != user_id)
+                .order_by(User.id)
+            )
+            if limit is not None:
+                stmt = stmt.limit(limit)
+            result = await session.execute(stmt)
+            return result.all()
+
+    async def bulk_update_presence(self, rows: List[tuple[int, bool, datetime]]):
+        """Writes (user_id, is_online, last_seen) for many users in one transaction."""
+        async with self.async_session_factory() as session:
+            async with session.begin():
+                await session.execute(
+                    update(User),
+                    [
+                        {"id": user_id, "is_online": is_online, "last_seen": last_seen}
+                        for user_id, is_online, last_seen in rows
+                    ],
+                )
+        logger.debug(f"Flushed presence of {len(rows)} users")
+
+    async def reset_online_status(self):
+        """Marks every user offline, used at startup to clear stale state."""
+        async with self.async_session_factory() as session:
+            async with session.begin():
+                await session.execute(
+                    update(User).where(User.is_online == True).values(is_online=False)
+                )
+
     async def get_all_users(self) -> List[User]:
         """Get all users"""
-        async with self.async_session_factory() as session:
+        async with self.read_session_factory() as session:
             result = await session.execute(select(User))
             return result.scalars().all()
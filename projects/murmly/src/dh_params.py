@@ -0,0 +1,244 @@
+"""Diffie-Hellman parameters served at /dh_params.
+
+Generating safe prime parameters takes seconds to minutes, so the server
+either uses a fixed group from RFC 7919 or parameters generated once and
+cached on disk. A process serves the same parameters until it exits, so
+clients that fetched them never hold a group the server has replaced.
+"""
+
+import os
+import json
+import time
+import hashlib
+import random
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from cryptography.hazmat.primitives.asymmetric import dh
+from cryptography.hazmat.primitives.asymmetric.dh import DHParameters
+
+import crypto_utils
+from config import PRIME_BITS, DH_GROUP, DH_PARAMS_FILE, DH_ROTATE_SECONDS
+from logger import logger
+
+# RFC 7919 appendix A, generator 2
+FFDHE_PRIMES = {
+    "ffdhe2048": int(
+        "FFFFFFFFFFFFFFFFADF85458A2BB4A9AAFDC5620273D3CF1D8B9C583CE2D3695"
+        "A9E13641146433FBCC939DCE249B3EF97D2FE363630C75D8F681B202AEC4617A"
+        "D3DF1ED5D5FD65612433F51F5F066ED0856365553DED1AF3B557135E7F57C935"
+        "984F0C70E0E68B77E2A689DAF3EFE8721DF158A136ADE73530ACCA4F483A797A"
+        "BC0AB182B324FB61D108A94BB2C8E3FBB96ADAB760D7F4681D4F42A3DE394DF4"
+        "AE56EDE76372BB190B07A7C8EE0A6D709E02FCE1CDF7E2ECC03404CD28342F61"
+        "9172FE9CE98583FF8E4F1232EEF28183C3FE3B1B4C6FAD733BB5FCBC2EC22005"
+        "C58EF1837D1683B2C6F34A26C1B2EFFA886B423861285C97FFFFFFFFFFFFFFFF",
+        16,
+    ),
+    "ffdhe3072": int(
+        "FFFFFFFFFFFFFFFFADF85458A2BB4A9AAFDC5620273D3CF1D8B9C583CE2D3695"
+        "A9E13641146433FBCC939DCE249B3EF97D2FE363630C75D8F681B202AEC4617A"
+        "D3DF1ED5D5FD65612433F51F5F066ED0856365553DED1AF3B557135E7F57C935"
+        "984F0C70E0E68B77E2A689DAF3EFE8721DF158A136ADE73530ACCA4F483A797A"
+        "BC0AB182B324FB61D108A94BB2C8E3FBB96ADAB760D7F4681D4F42A3DE394DF4"
+        "AE56EDE76372BB190B07A7C8EE0A6D709E02FCE1CDF7E2ECC03404CD28342F61"
+        "9172FE9CE98583FF8E4F1232EEF28183C3FE3B1B4C6FAD733BB5FCBC2EC22005"
+        "C58EF1837D1683B2C6F34A26C1B2EFFA886B4238611FCFDCDE355B3B6519035B"
+        "BC34F4DEF99C023861B46FC9D6E6C9077AD91D2691F7F7EE598CB0FAC186D91C"
+        "AEFE130985139270B4130C93BC437944F4FD4452E2D74DD364F2E21E71F54BFF"
+        "5CAE82AB9C9DF69EE86D2BC522363A0DABC521979B0DEADA1DBF9A42D5C4484E"
+        "0ABCD06BFA53DDEF3C1B20EE3FD59D7C25E41D2B66C62E37FFFFFFFFFFFFFFFF",
+        16,
+    ),
+}
+
+# p = 2^b - 2^(b-64) + (floor(2^(b-130) * e) + X) * 2^64 - 1, (b - 130, X) per group
+_RFC7919_CONSTANTS = {"ffdhe2048": (1918, 560316), "ffdhe3072": (2942, 2625351)}
+
+# seconds between checks whether the cached parameters are due for rotation
+_CHECK_SECONDS = 30
+# a generation lock older than this was left by a killed worker
+_STALE_LOCK_SECONDS = 600
+
+
+def _floor_e_times_pow2(n: int) -> int:
+    """floor(2^n * e), with the series of e in integer arithmetic."""
+    guard = 64
+    term, total, k = 1 << (n + guard), 0, 0
+    while term:
+        total += term
+        k += 1
+        term //= k
+    return total >> guard
+
+
+def rfc7919_prime(name: str) -> int:
+    """Computes the prime of a group from the construction in RFC 7919."""
+    shift, offset = _RFC7919_CONSTANTS[name]
+    bits = shift + 130
+    return 2**bits - 2 ** (bits - 64) + (_floor_e_times_pow2(shift) + offset) * 2**64 - 1
+
+
+def is_safe_prime(p: int, rounds: int = 8) -> bool:
+    """Miller-Rabin on p and (p - 1) / 2, for parameters read from disk."""
+
+    def probable_prime(n: int) -> bool:
+        if n < 4:
+            return n in (2, 3)
+        d, r = n - 1, 0
+        while d % 2 == 0:
+            d //= 2
+            r += 1
+        for _ in range(rounds):
+            x = pow(random.randrange(2, n - 1), d, n)
+            if x in (1, n - 1):
+                continue
+            for _ in range(r - 1):
+                x = pow(x, 2, n)
+                if x == n - 1:
+                    break
+            else:
+                return False
+        return True
+
+    return p % 2 == 1 and probable_prime((p - 1) // 2) and probable_prime(p)
+
+
+def ffdhe_parameters(name: str) -> DHParameters:
+    p = FFDHE_PRIMES[name]
+    # the embedded hex must be exactly the RFC prime, cheaper than a primality test
+    if p != rfc7919_prime(name):
+        raise ValueError(f"Built-in {name} prime does not match RFC 7919")
+    return dh.DHParameterNumbers(p, 2).parameters()
+
+
+class EncodedResponse:
+    """JSON body encoded once, with a strong ETag of its bytes."""
+
+    def __init__(self, content: dict):
+        self.body = json.dumps(content).encode()
+        self.etag = f'"{hashlib.sha256(self.body).hexdigest()[:16]}"'
+
+
+def _generate_pem(bits: int) -> bytes:
+    """Runs in a worker process, returns PEM so the result can be pickled."""
+    return crypto_utils.serialize_parameters(dh.generate_parameters(generator=2, key_size=bits))
+
+
+class DHParamsManager:
+    """Holds the current DH parameters.
+
+    `group` is an RFC 7919 group name or "generated". Generated parameters
+    are read from `cache_file` at startup. If it is missing, or older than
+    `rotate_seconds` (0 never rotates), one worker generates new ones in a
+    process pool and writes them to the file. They are served from the
+    next restart, until then ffdhe2048 or the old parameters stay.
+    """
+
+    def __init__(
+        self,
+        group: str = DH_GROUP,
+        cache_file: str = DH_PARAMS_FILE,
+        rotate_seconds: float = DH_ROTATE_SECONDS,
+        bits: int = PRIME_BITS,
+    ):
+        self.group = group
+        self.cache_file = cache_file
+        self.rotate_seconds = rotate_seconds
+        self.bits = bits
+        self.params: Optional[DHParameters] = None
+        # bodies of /dh_params and /dh_params_js, rebuilt when the parameters change
+        self.pem_response: Optional[EncodedResponse] = None
+        self.hex_response: Optional[EncodedResponse] = None
+        self._task: Optional[asyncio.Task] = None
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def load(self):
+        """Loads the parameters without generating any, fast enough for startup."""
+        if self.group != "generated":
+            self._use(ffdhe_parameters(self.group))
+            logger.info(f"Using DH group {self.group}")
+            return
+        if not self._load_cache():
+            self._use(ffdhe_parameters("ffdhe2048"))
+            logger.info("No cached DH parameters yet, using ffdhe2048 until the next restart")
+
+    def _use(self, params: DHParameters):
+        self.params = params
+        pem = crypto_utils.serialize_parameters(params).decode("utf-8")
+        self.pem_response = EncodedResponse({"params": pem})
+        self.hex_response = EncodedResponse(crypto_utils.get_dh_params_as_hex(params))
+
+    def _load_cache(self) -> bool:
+        try:
+            with open(self.cache_file, "rb") as f:
+                params = crypto_utils.deserialize_parameters(f.read())
+        except (OSError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logger.error(f"Could not read DH parameters from {self.cache_file}: {e}")
+            return False
+        if not is_safe_prime(params.parameter_numbers().p):
+            logger.error(f"DH parameters in {self.cache_file} are not a safe prime group")
+            return False
+        self._use(params)
+        logger.info(f"Loaded DH parameters from {self.cache_file}")
+        return True
+
+    def _needs_generation(self) -> bool:
+        if not os.path.exists(self.cache_file):
+            return True
+        age = time.time() - os.path.getmtime(self.cache_file)
+        return bool(self.rotate_seconds) and age > self.rotate_seconds
+
+    def start(self):
+        if self.group == "generated":
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+    async def _run(self):
+        while True:
+            if self._needs_generation():
+                await self._generate()
+            await asyncio.sleep(_CHECK_SECONDS)
+
+    async def _generate(self):
+        lock = self.cache_file + ".lock"
+        try:
+            if time.time() - os.path.getmtime(lock) > _STALE_LOCK_SECONDS:
+                os.remove(lock)
+        except OSError:
+            pass
+        try:
+            # only one worker generates
+            os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return
+        try:
+            logger.info(f"Generating {self.bits} bit DH parameters in the background")
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=1)
+            start = time.perf_counter()
+            pem = await asyncio.get_running_loop().run_in_executor(
+                self._pool, _generate_pem, self.bits
+            )
+            tmp = f"{self.cache_file}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(pem)
+            os.replace(tmp, self.cache_file)
+            logger.info(
+                f"Generated DH parameters in {time.perf_counter() - start:.1f}s, "
+                "served after the next restart"
+            )
+        except Exception as e:
+            logger.error(f"DH parameter generation failed: {e}")
+        finally:
+            os.remove(lock)
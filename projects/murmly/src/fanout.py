@@ -0,0 +1,202 @@
+import json
+import uuid
+import asyncio
+from typing import Awaitable, Callable, Optional
+
+from framing import to_json
+from logger import logger
+
+# delivers a message to a websocket of this process, False if the user has none
+Deliver = Callable[[int, dict], Awaitable[bool]]
+# handles an event another worker broadcast, see FanoutBackend.broadcast
+OnEvent = Callable[[dict], None]
+# stores a chat message as a pending delivery of a user
+Enqueue = Callable[[int, dict], Awaitable[None]]
+
+
+class FanoutBackend:
+    """Routes a message to the process that holds the recipient's websocket.
+
+    Every process subscribes the users connected to it. publish() returns
+    False if no process has the recipient, the caller then queues the
+    message as a pending delivery. A message published to another process
+    that cannot deliver it there is queued by that process with `enqueue`.
+    broadcast() sends an event, e.g. a cache invalidation, to every other
+    process.
+    """
+
+    def __init__(self):
+        self.deliver: Optional[Deliver] = None
+        self.on_event: Optional[OnEvent] = None
+        self.enqueue: Optional[Enqueue] = None
+        self.local: set[int] = set()  # users with a websocket in this process
+
+    async def start(
+        self, deliver: Deliver, on_event: Optional[OnEvent] = None, enqueue: Optional[Enqueue] = None
+    ):
+        self.deliver = deliver
+        self.on_event = on_event
+        self.enqueue = enqueue
+
+    async def stop(self):
+        pass
+
+    async def subscribe(self, user_id: int):
+        self.local.add(user_id)
+
+    async def unsubscribe(self, user_id: int):
+        self.local.discard(user_id)
+
+    async def publish(self, user_id: int, message: dict) -> bool:
+        raise NotImplementedError
+
+    def broadcast(self, event: dict):
+        """Hands `event` to on_event of the other processes, in order, without
+        waiting. This process has already applied it."""
+
+    async def connected_elsewhere(self, user_ids: list[int]) -> set[int]:
+        """The users of `user_ids` with a websocket in another process."""
+        return set()
+
+
+class InProcessFanout(FanoutBackend):
+    """Single worker, every connected user is local."""
+
+    async def publish(self, user_id: int, message: dict) -> bool:
+        if user_id not in self.local:
+            return False
+        return await self.deliver(user_id, message)
+
+
+class RedisFanout(FanoutBackend):
+    """Redis pub/sub (or a compatible server like Valkey or KeyDB), one channel per user.
+
+    Lets uvicorn run with several workers. PUBLISH returns the number of
+    subscribers, so 0 means the recipient is not connected to any worker.
+    Broadcast events go to a channel every worker subscribes, tagged with
+    the sending worker so it skips its own.
+    """
+
+    def __init__(self, url: str, prefix: str = "murmly:user:"):
+        super().__init__()
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise RuntimeError(
+                "FANOUT_URL needs the redis package, install it with `pip install redis`"
+            ) from e
+        self.prefix = prefix
+        self.redis = redis.from_url(url)
+        self.pubsub = self.redis.pubsub()
+        self.worker_id = uuid.uuid4().hex
+        self.workers_channel = f"{prefix}workers"
+        self._events: asyncio.Queue = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+
+    def _channel(self, user_id: int) -> str:
+        return f"{self.prefix}{user_id}"
+
+    async def start(
+        self, deliver: Deliver, on_event: Optional[OnEvent] = None, enqueue: Optional[Enqueue] = None
+    ):
+        await super().start(deliver, on_event, enqueue)
+        # listen() stops when nothing is subscribed, this channel keeps it running
+        await self.pubsub.subscribe(self.workers_channel)
+        self._tasks = [asyncio.create_task(self._listen()), asyncio.create_task(self._send_events())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.pubsub.aclose()
+        await self.redis.aclose()
+
+    async def subscribe(self, user_id: int):
+        await super().subscribe(user_id)
+        await self.pubsub.subscribe(self._channel(user_id))
+
+    async def unsubscribe(self, user_id: int):
+        await super().unsubscribe(user_id)
+        await self.pubsub.unsubscribe(self._channel(user_id))
+
+    async def publish(self, user_id: int, message: dict) -> bool:
+        if user_id in self.local:
+            # skip the round trip through redis
+            return await self.deliver(user_id, message)
+        receivers = await self.redis.publish(self._channel(user_id), json.dumps(to_json(message)))
+        return receivers > 0
+
+    async def connected_elsewhere(self, user_ids: list[int]) -> set[int]:
+        if not user_ids:
+            return set()
+        # every worker with a websocket of the user subscribes its channel,
+        # and a worker that stops drops its subscriptions with its connection
+        counts = await self.redis.pubsub_numsub(*(self._channel(user_id) for user_id in user_ids))
+        return {
+            user_id
+            for user_id, (_, count) in zip(user_ids, counts)
+            if count > (user_id in self.local)
+        }
+
+    def broadcast(self, event: dict):
+        self._events.put_nowait(event)
+
+    async def _send_events(self):
+        # one sender keeps the events of this worker in order
+        while True:
+            event = await self._events.get()
+            try:
+                await self.redis.publish(
+                    self.workers_channel, json.dumps({"worker": self.worker_id, "event": event})
+                )
+            except Exception as e:
+                logger.error(f"Failed to broadcast {event.get('type')} to the other workers: {e}")
+
+    def _handle_event(self, data):
+        message = json.loads(data)
+        if message["worker"] != self.worker_id and self.on_event:
+            self.on_event(message["event"])
+
+    async def _listen(self):
+        async for item in self.pubsub.listen():
+            if item["type"] != "message":
+                continue
+            channel = item["channel"]
+            if isinstance(channel, bytes):
+                channel = channel.decode()
+            if channel == self.workers_channel:
+                try:
+                    self._handle_event(item["data"])
+                except Exception as e:
+                    logger.error(f"Failed to handle a worker event: {e}")
+                continue
+            user_id = channel[len(self.prefix):]
+            if not user_id.isdigit():
+                continue
+            await self._deliver(int(user_id), json.loads(item["data"]))
+
+    async def _deliver(self, user_id: int, message: dict):
+        try:
+            delivered = await self.deliver(user_id, message)
+        except Exception as e:
+            logger.error(f"Failed to deliver fan-out message to {user_id}: {e}")
+            delivered = False
+        # e.g. the websocket closed before the channel was unsubscribed. The
+        # publisher counted this worker as a receiver and queued nothing.
+        if delivered or "id" not in message or self.enqueue is None:
+            return
+        try:
+            await self.enqueue(user_id, message)
+        except Exception as e:
+            logger.error(f"Failed to queue fan-out message {message['id']} for {user_id}: {e}")
+
+
+def create_fanout(url: Optional[str]) -> FanoutBackend:
+    """RedisFanout for a redis:// URL, else the single process backend."""
+    if url:
+        logger.info(f"Using redis fan-out at {url}")
+        return RedisFanout(url)
+    return InProcessFanout()
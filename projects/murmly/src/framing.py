@@ -0,0 +1,119 @@
+"""Websocket frame formats.
+
+JSON peers send and receive text frames with the AES-GCM ciphertext as
+base64 in `content`. A client that offers the BINARY_SUBPROTOCOL
+subprotocol gets binary frames instead:
+
+    4 byte big endian header length | JSON header | ciphertexts
+
+Every message in the header whose content is bytes has `content_length`
+instead of `content`, its ciphertext follows the header in the order the
+messages appear (a single message, or the `messages` of a batch). Text
+frames (acks, errors, status) stay JSON in both formats.
+
+Ciphertext is kept as bytes from the binary sender to the BLOB column
+`messages.ciphertext` to the binary recipient, only JSON peers pay for
+base64.
+"""
+
+import json
+import base64
+import binascii
+import struct
+from typing import Optional, Union
+
+BINARY_SUBPROTOCOL = "murmly.binary.v1"
+
+_HEADER_LENGTH = struct.Struct(">I")
+
+Content = Union[str, bytes]
+
+
+def parse_content(content: Optional[str]) -> Optional[Content]:
+    """Content of a chat message from a JSON peer: canonical base64 as bytes,
+    anything else is kept as text. json_content() gives back the same string."""
+    if not content:
+        return content
+    try:
+        data = base64.b64decode(content, validate=True)
+    except (binascii.Error, ValueError):
+        return content
+    # "QQ" or "QR==" decode too, but would be sent on as "QQ=="
+    if base64.b64encode(data).decode("ascii") != content:
+        return content
+    return data
+
+
+def stored_content(content: Optional[str], ciphertext: Optional[bytes]) -> Optional[Content]:
+    """Body of a message row, messages stored before the BLOB column have text."""
+    return ciphertext if ciphertext is not None else content
+
+
+def json_content(content: Optional[Content]) -> Optional[str]:
+    if isinstance(content, bytes):
+        return base64.b64encode(content).decode("ascii")
+    return content
+
+
+def _messages(message: dict) -> list:
+    return message["messages"] if isinstance(message.get("messages"), list) else [message]
+
+
+def has_bytes(message: dict) -> bool:
+    return any(isinstance(m.get("content"), bytes) for m in _messages(message))
+
+
+def to_json(message: dict) -> dict:
+    """Copy of a message (or batch) with base64 instead of bytes content."""
+    if not has_bytes(message):
+        return message
+    if "messages" in message:
+        return {**message, "messages": [to_json(m) for m in message["messages"]]}
+    return {**message, "content": json_content(message["content"])}
+
+
+def encode_frame(message: dict) -> bytes:
+    payloads = []
+
+    def strip(m: dict) -> dict:
+        content = m.get("content")
+        if not isinstance(content, bytes):
+            return m
+        payloads.append(content)
+        m = {k: v for k, v in m.items() if k != "content"}
+        m["content_length"] = len(content)
+        return m
+
+    if isinstance(message.get("messages"), list):
+        header = {**message, "messages": [strip(m) for m in message["messages"]]}
+    else:
+        header = strip(message)
+    header_bytes = json.dumps(header, separators=(",", ":")).encode()
+    return b"".join([_HEADER_LENGTH.pack(len(header_bytes)), header_bytes, *payloads])
+
+
+def decode_frame(data: bytes) -> dict:
+    """Inverse of encode_frame, raises ValueError on a malformed frame."""
+    if len(data) < _HEADER_LENGTH.size:
+        raise ValueError("Frame too short")
+    (length,) = _HEADER_LENGTH.unpack_from(data)
+    offset = _HEADER_LENGTH.size + length
+    if offset > len(data):
+        raise ValueError("Header longer than frame")
+    message = json.loads(data[_HEADER_LENGTH.size:offset])
+    if not isinstance(message, dict) or not all(isinstance(m, dict) for m in _messages(message)):
+        raise ValueError("Header is not a message or batch")
+    for m in _messages(message):
+        size = m.pop("content_length", None)
+        if size is None:
+            continue
+        # bool is an int too
+        if type(size) is not int or size < 0:
+            raise ValueError("content_length is not a non-negative integer")
+        if offset + size > len(data):
+            raise ValueError("Content longer than frame")
+        m["content"] = data[offset:offset + size]
+        offset += size
+    if offset != len(data):
+        raise ValueError("Trailing bytes after the last content")
+    return message
@@ -0,0 +1,107 @@
+import time
+import asyncio
+import functools
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from config import HASH_WORKERS, HASH_MAX_QUEUE
+from logger import logger
+
+
+class HasherBusy(Exception):
+    """More password hashes are queued than HASH_MAX_QUEUE."""
+
+
+class PasswordHasher:
+    """Runs bcrypt hashing and verification in a bounded thread pool.
+
+    bcrypt takes tens to hundreds of milliseconds of CPU and releases the
+    GIL, so in threads it runs in parallel and does not block the event
+    loop. At most `workers` run at once and at most `max_queue` wait,
+    further calls raise HasherBusy instead of queueing without bound.
+    """
+
+    def __init__(self, workers: int = HASH_WORKERS, max_queue: int = HASH_MAX_QUEUE):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        # changed on the event loop only, never from the worker threads
+        self.in_flight = 0  # running + waiting
+        self.peak_queue = 0
+        self.completed = 0
+        self.failed = 0  # raised or cancelled
+        self.rejected = 0
+        self.wait_seconds = 0.0
+        self.run_seconds = 0.0
+
+    @staticmethod
+    def _timed(fn, args) -> tuple:
+        """Runs in a worker thread, returns (started, finished, result, error)."""
+        started = time.perf_counter()
+        try:
+            result, error = fn(*args), None
+        except Exception as e:
+            result, error = None, e
+        return started, time.perf_counter(), result, error
+
+    def _done(self, queued_at: float, future: Future):
+        self.in_flight -= 1
+        if future.cancelled() or future.exception():
+            self.failed += 1
+            return
+        started, finished, _, error = future.result()
+        if error:
+            self.failed += 1
+            return
+        self.completed += 1
+        self.wait_seconds += started - queued_at
+        self.run_seconds += finished - started
+
+    async def run(self, fn, *args):
+        if self.in_flight >= self.workers + self.max_queue:
+            self.rejected += 1
+            logger.warning(f"Password hasher busy, {self.in_flight} hashes in flight")
+            raise HasherBusy()
+        self.in_flight += 1
+        self.peak_queue = max(self.peak_queue, self.in_flight - self.workers)
+        queued_at = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        future = self._executor.submit(self._timed, fn, args)
+        # counted out when the thread is done, not when the caller is
+        # cancelled: a running hash cannot be stopped and still holds a worker
+        future.add_done_callback(
+            lambda f: self._call_soon(loop, functools.partial(self._done, queued_at, f))
+        )
+        _, _, result, error = await asyncio.wrap_future(future)
+        if error:
+            raise error
+        return result
+
+    @staticmethod
+    def _call_soon(loop: asyncio.AbstractEventLoop, callback):
+        # done callbacks run in the worker thread
+        try:
+            loop.call_soon_threadsafe(callback)
+        except RuntimeError:
+            pass  # the loop is closed, nobody reads the counters anymore
+
+    @property
+    def queued(self) -> int:
+        return max(0, self.in_flight - self.workers)
+
+    def stats(self) -> dict:
+        done = self.completed or 1
+        return {
+            "workers": self.workers,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "max_queue": self.max_queue,
+            "peak_queue": self.peak_queue,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "avg_wait_ms": self.wait_seconds / done * 1000,
+            "avg_run_ms": self.run_seconds / done * 1000,
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,50 @@
+import hashlib
+from typing import Iterable, Optional
+
+from cache import TTLCache
+from config import KEY_CACHE_SIZE, KEY_CACHE_TTL
+from db_utils import Database
+
+
+def key_version(public_key_b64: str) -> str:
+    """Hash of the key, the same in every worker and after restarts."""
+    return hashlib.sha256(public_key_b64.encode()).hexdigest()[:16]
+
+
+class KeyDirectory:
+    """Public keys by user id, cached in memory.
+
+    Entries are (username, public key, version) and are dropped by
+    invalidate() when the user uploads a new key, in the other workers
+    through a broadcast of the fan-out backend. The TTL bounds how long a
+    worker serves a replaced key if that broadcast is lost.
+    """
+
+    def __init__(self, db: Database, maxsize: int = KEY_CACHE_SIZE, ttl: float = KEY_CACHE_TTL):
+        self.db = db
+        self.cache = TTLCache(maxsize, ttl)
+
+    async def get_many(self, user_ids: Iterable[int]) -> dict[int, Optional[tuple[str, str, str]]]:
+        """Entry per id, None for unknown users or users without a key. Misses
+        are loaded with one query."""
+        entries, missing = {}, []
+        for user_id in user_ids:
+            entry = self.cache.get(user_id)
+            if entry is None:
+                missing.append(user_id)
+            entries[user_id] = entry
+        if missing:
+            # a key replaced during the query is not cached
+            generation = self.cache.generation()
+            for row in await self.db.get_public_keys(missing):
+                if row.public_key_b64:
+                    entry = (row.username, row.public_key_b64, key_version(row.public_key_b64))
+                    self.cache.set(row.id, entry, generation=generation)
+                    entries[row.id] = entry
+        return entries
+
+    async def get(self, user_id: int) -> Optional[tuple[str, str, str]]:
+        return (await self.get_many([user_id]))[user_id]
+
+    def invalidate(self, user_id: int):
+        self.cache.invalidate(user_id)
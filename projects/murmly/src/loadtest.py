@@ -0,0 +1,325 @@
+"""Load test of the websocket chat path, run from `src`:
+
+    python loadtest.py [--users 50] [--rate 1] [--seconds 20] [--url http://host:8000]
+
+Without --url a uvicorn server is started in a temporary directory, so it
+gets an empty murmly.db. Every simulated user registers, logs in, fetches
+the DH parameters, uploads a public key, derives a key with its partner
+(user 2k chats with 2k+1, with an odd count the last user sends to user 0)
+and then sends `--rate` AES-GCM encrypted messages per second over its
+websocket. Delivery latency is measured from send to receipt on the
+partner's websocket, matched by sender and message_number.
+The report is printed as JSON so runs of different versions can be
+compared, `--label` tags it.
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import httpx
+import websockets
+
+import crypto_utils
+
+# statuses worth retrying, 503 is the bcrypt pool being full
+_RETRY_STATUS = {429, 503}
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+class Stats:
+    def __init__(self):
+        self.setup_seconds: list[float] = []
+        self.latencies: list[float] = []
+        self.sent = 0
+        self.delivered = 0
+        self.errors: dict[str, int] = {}
+
+    def error(self, kind: str):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+class SimUser:
+    def __init__(self, index: int, run_id: str, http: httpx.AsyncClient, ws_url: str, stats: Stats):
+        self.username = f"load{run_id}_{index}"
+        self.password = f"pw-{run_id}-{index}"
+        self.http = http
+        self.ws_url = ws_url
+        self.stats = stats
+        self.id = None
+        self.token = None
+        self.params = None
+        self.priv_key = None
+        self.peer: "SimUser" = None  # receives the messages of this user
+        self.senders: dict[int, "SimUser"] = {}  # user id -> user sending to this one
+        self.keys: dict[int, bytes] = {}  # user id -> key shared with peer and senders
+        self.ws = None
+        # message_number -> perf_counter at send, shared with the receiving partner
+        self.sent_at: dict[int, float] = {}
+
+    async def _request(self, method: str, path: str, retries: int = 20, **kwargs) -> httpx.Response:
+        for _ in range(retries):
+            response = await self.http.request(method, path, **kwargs)
+            if response.status_code not in _RETRY_STATUS:
+                return response
+            await asyncio.sleep(float(response.headers.get("Retry-After", 1)) * random.uniform(0.5, 1.5))
+        return response
+
+    def _auth(self) -> dict:
+        return {"Authorization": f"Bearer {self.token}"}
+
+    async def setup(self):
+        """Register, log in, fetch DH parameters and upload a public key."""
+        response = await self._request(
+            "POST", "/register", json={"username": self.username, "password": self.password}
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"register: {response.status_code}")
+        response = await self._request(
+            "POST", "/token", data={"username": self.username, "password": self.password}
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"login: {response.status_code}")
+        self.token = response.json()["access_token"]
+        response = await self._request("GET", "/users/me", headers=self._auth())
+        self.id = response.json()["id"]
+
+        response = await self._request("GET", "/dh_params")
+        self.params = crypto_utils.deserialize_parameters(response.json()["params"].encode())
+        self.priv_key, pub_key = crypto_utils.generate_pair(self.params)
+        response = await self._request(
+            "PUT",
+            "/update_public_key",
+            json={"public_key": crypto_utils.serialize_pub_key(pub_key).decode()},
+            headers=self._auth(),
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"public key: {response.status_code}")
+
+    async def exchange_keys(self):
+        for other in {self.peer.id: self.peer, **self.senders}.values():
+            response = await self._request("GET", f"/users/{other.id}/public_key", headers=self._auth())
+            if response.status_code != 200:
+                raise RuntimeError(f"peer key: {response.status_code}")
+            peer_pub = crypto_utils.deserialize_pub_key(response.json()["public_key"].encode(), self.params)
+            self.keys[other.id] = crypto_utils.exchange_and_derive(self.priv_key, peer_pub)
+
+    async def connect(self):
+        self.ws = await websockets.connect(f"{self.ws_url}/ws/{self.token}", max_size=None)
+
+    async def receive(self):
+        try:
+            async for frame in self.ws:
+                data = json.loads(frame)
+                sender = self.senders.get(data.get("sender", {}).get("id"))
+                if "content" not in data or sender is None:
+                    continue
+                sent = sender.sent_at.pop(data.get("message_number"), None)
+                if sent is None:
+                    continue
+                self.stats.latencies.append(time.perf_counter() - sent)
+                self.stats.delivered += 1
+                try:
+                    crypto_utils.decrypt(self.keys[sender.id], base64.b64decode(data["content"]))
+                except Exception:
+                    self.stats.error("decrypt")
+        except websockets.ConnectionClosed:
+            pass
+
+    async def send_loop(self, rate: float, until: float):
+        number = 0
+        await asyncio.sleep(random.uniform(0, 1 / rate))
+        while time.perf_counter() < until:
+            number += 1
+            content = base64.b64encode(crypto_utils.encrypt(self.keys[self.peer.id], f"message {number}")).decode()
+            self.sent_at[number] = time.perf_counter()
+            try:
+                await self.ws.send(
+                    json.dumps(
+                        {
+                            "recipient": {"id": self.peer.id, "username": self.peer.username},
+                            "content": content,
+                            "message_number": number,
+                        }
+                    )
+                )
+                self.stats.sent += 1
+            except websockets.ConnectionClosed:
+                self.stats.error("send")
+                return
+            await asyncio.sleep(1 / rate)
+
+
+def pair_users(users: list[SimUser]):
+    """User 2k sends to 2k+1 and 2k+1 back to 2k. With an odd count the last
+    user sends to user 0, which then receives from two users."""
+    for user in users:
+        user.senders = {}
+    for i, user in enumerate(users):
+        user.peer = users[i ^ 1] if i ^ 1 < len(users) else users[0]
+        user.peer.senders[user.id] = user
+
+
+async def run(url: str, n_users: int, rate: float, seconds: float, setup_concurrency: int, label: str) -> dict:
+    stats = Stats()
+    run_id = f"{random.randrange(16**6):06x}"
+    ws_url = url.replace("http", "ws", 1)
+    limits = httpx.Limits(max_connections=setup_concurrency * 2)
+    async with httpx.AsyncClient(base_url=url, timeout=60, limits=limits) as http:
+        users = [SimUser(i, run_id, http, ws_url, stats) for i in range(n_users)]
+
+        slots = asyncio.Semaphore(setup_concurrency)
+
+        async def setup(user: SimUser) -> bool:
+            async with slots:
+                start = time.perf_counter()
+                try:
+                    await user.setup()
+                except Exception as e:
+                    stats.error(str(e).split(":")[0] if isinstance(e, RuntimeError) else "setup")
+                    return False
+                stats.setup_seconds.append(time.perf_counter() - start)
+                return True
+
+        setup_start = time.perf_counter()
+        ok = await asyncio.gather(*(setup(user) for user in users))
+        # partners are chosen among the users that have an id and a public key
+        users = [user for user, good in zip(users, ok) if good]
+        pair_users(users)
+
+        async def connect(user: SimUser) -> bool:
+            try:
+                await user.exchange_keys()
+                await user.connect()
+                return True
+            except Exception:
+                stats.error("connect")
+                return False
+
+        ok = await asyncio.gather(*(connect(user) for user in users))
+        users = [user for user, good in zip(users, ok) if good]
+        # only send to partners that are connected, everyone connected receives
+        senders = [user for user in users if user.peer in users]
+        setup_elapsed = time.perf_counter() - setup_start
+
+        receivers = [asyncio.create_task(user.receive()) for user in users]
+        start = time.perf_counter()
+        await asyncio.gather(*(user.send_loop(rate, start + seconds) for user in senders))
+        send_elapsed = time.perf_counter() - start
+        # let messages still in flight arrive
+        deadline = time.perf_counter() + 5
+        while stats.delivered < stats.sent and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        for user in users:
+            await user.ws.close()
+        for task in receivers:
+            task.cancel()
+        await asyncio.gather(*receivers, return_exceptions=True)
+
+    lost = stats.sent - stats.delivered
+    attempts = stats.sent + sum(stats.errors.values())
+    return {
+        "label": label,
+        "users": n_users,
+        "connected": len(users),
+        "rate_per_user": rate,
+        "seconds": seconds,
+        "setup": {
+            "seconds": round(setup_elapsed, 2),
+            "p50_ms": round(_percentile(stats.setup_seconds, 0.5) * 1000, 1),
+            "p99_ms": round(_percentile(stats.setup_seconds, 0.99) * 1000, 1),
+        },
+        "sent": stats.sent,
+        "delivered": stats.delivered,
+        "lost": lost,
+        "throughput_per_s": round(stats.delivered / send_elapsed, 1),
+        "latency_ms": {
+            "p50": round(_percentile(stats.latencies, 0.5) * 1000, 2),
+            "p90": round(_percentile(stats.latencies, 0.9) * 1000, 2),
+            "p99": round(_percentile(stats.latencies, 0.99) * 1000, 2),
+            "max": round(max(stats.latencies, default=0) * 1000, 2),
+        },
+        "errors": stats.errors,
+        "error_rate": round((sum(stats.errors.values()) + lost) / attempts, 4) if attempts else 0.0,
+    }
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _start_server(tmp: str) -> tuple[subprocess.Popen, str]:
+    """uvicorn in `tmp`, so the server creates a fresh murmly.db there."""
+    port = _free_port()
+    src = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=src)
+    log = open(os.path.join(tmp, "server.out"), "w")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--port", str(port), "--log-level", "warning"],
+        cwd=tmp,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(300):
+        if server.poll() is not None:
+            break
+        try:
+            if httpx.get(f"{url}/metrics").status_code == 200:
+                return server, url
+        except httpx.TransportError:
+            pass
+        time.sleep(0.1)
+    server.kill()
+    with open(os.path.join(tmp, "server.out")) as f:
+        raise RuntimeError(f"Server did not start:\n{f.read()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--rate", type=float, default=1, help="messages per second per user")
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--url", help="existing server, default starts one")
+    parser.add_argument("--setup-concurrency", type=int, default=16)
+    parser.add_argument("--label", default="", help="tag for the report, e.g. a commit")
+    args = parser.parse_args()
+    if args.users < 2:
+        parser.error("--users must be at least 2")
+
+    if args.url:
+        report = asyncio.run(
+            run(args.url, args.users, args.rate, args.seconds, args.setup_concurrency, args.label)
+        )
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            server, url = _start_server(tmp)
+            try:
+                report = asyncio.run(
+                    run(url, args.users, args.rate, args.seconds, args.setup_concurrency, args.label)
+                )
+            finally:
+                server.terminate()
+                server.wait()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,119 @@
+"""Logging setup.
+
+Records are put on a queue by the calling code and written to the console
+and murmly.log by a QueueListener thread, so disk writes never block the
+event loop. Per message logs go to `ws_logger`, which is sampled and rate
+limited. With LOG_FORMAT = "json" every line is a JSON object, fields
+passed with `extra={...}` become keys of it.
+"""
+
+import json
+import time
+import queue
+import atexit
+import random
 import logging
 import logging.handlers
 
-logger = logging.getLogger(__name__)
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
+from config import (
+    LOG_LEVEL,
+    LOG_FORMAT,
+    LOG_FILE,
+    LOG_SAMPLE_RATE,
+    LOG_RATE_LIMIT,
+)
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# attributes every LogRecord has, anything else came from `extra`
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SampleFilter(logging.Filter):
+    """Keeps a `rate` fraction of records below WARNING."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+class RateLimitFilter(logging.Filter):
+    """At most `per_second` records per message template, excess ones are counted
+    and reported on the next record that passes."""
+
+    def __init__(self, per_second: float):
+        super().__init__()
+        self.per_second = per_second
+        self._windows: dict[str, list] = {}  # msg -> [window start, count, dropped]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        now = time.monotonic()
+        window = self._windows.setdefault(record.msg, [now, 0, 0])
+        if now - window[0] >= 1:
+            window[0], window[1] = now, 0
+        if window[1] >= self.per_second:
+            window[2] += 1
+            return False
+        window[1] += 1
+        if window[2]:
+            record.dropped = window[2]
+            window[2] = 0
+        return True
+
+
+def _handlers(fmt: str, log_file: str) -> list[logging.Handler]:
+    formatter = JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT)
+    handlers = [
         logging.StreamHandler(),
-        logging.handlers.RotatingFileHandler(
-            "murmly.log", maxBytes=1000000, backupCount=5
-        ),
-    ],
-)
\ No newline at end of file
+        logging.handlers.RotatingFileHandler(log_file, maxBytes=1000000, backupCount=5),
+    ]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    return handlers
+
+
+def setup_logging(
+    level: str = LOG_LEVEL, fmt: str = LOG_FORMAT, log_file: str = LOG_FILE
+) -> logging.handlers.QueueListener:
+    """Routes the root logger through a queue, returns the started listener."""
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        log_queue, *_handlers(fmt, log_file), respect_handler_level=True
+    )
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level)
+    listener.start()
+    # flushes what is still queued on exit
+    atexit.register(listener.stop)
+    return listener
+
+
+logger = logging.getLogger(__name__)
+# per message logs of the websocket path
+ws_logger = logger.getChild("ws")
+ws_logger.addFilter(SampleFilter(LOG_SAMPLE_RATE))
+ws_logger.addFilter(RateLimitFilter(LOG_RATE_LIMIT))
+
+listener = setup_logging()
@@ -0,0 +1,210 @@
+"""Prometheus metrics served at /metrics.
+
+Small replacement for prometheus_client: every metric is only updated
+from the event loop thread, so counters are plain floats in a dict keyed
+by the label values, without locks. Values of other objects (caches, the
+bcrypt pool) are read when /metrics is scraped.
+"""
+
+import time
+import asyncio
+from bisect import bisect_left
+from typing import Callable, Iterable, Optional
+
+from sqlalchemy import event
+
+from config import LOOP_LAG_INTERVAL
+
+# seconds, from a cached lookup to a slow bcrypt login
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+_registry: list["_Metric"] = []
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, values)) + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        _registry.append(self)
+
+    def lines(self) -> Iterable[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Incremented from the code, or read from `fn` at scrape time for a
+    count kept elsewhere that only ever increases."""
+
+    kind = "counter"
+
+    def __init__(
+        self, name: str, help: str, labelnames: tuple = (), fn: Optional[Callable] = None
+    ):
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+        # unlabelled counters are exported as 0 before the first inc()
+        self.values: dict[tuple, float] = {} if labelnames else {(): 0}
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def lines(self):
+        if self.fn:
+            yield f"{self.name} {self.fn()}"
+            return
+        for labels, value in self.values.items():
+            yield f"{self.name}{_labels(self.labelnames, labels)} {value}"
+
+
+class Gauge(_Metric):
+    """Set from the code, or read from `fn` at scrape time. With labelnames
+    `fn` returns a dict of label values -> value."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, fn: Optional[Callable] = None, labelnames: tuple = ()):
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def lines(self):
+        if self.labelnames:
+            for labels, value in self.fn().items():
+                yield f"{self.name}{_labels(self.labelnames, labels)} {value}"
+            return
+        yield f"{self.name} {self.fn() if self.fn else self.value}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = buckets
+        # label values -> counts per bucket (last is +Inf), then sum
+        self.values: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def lines(self):
+        for labels, counts in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = _labels(self.labelnames + ("le",), labels + (bound,))
+                yield f"{self.name}_bucket{le} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {counts[-1]}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}"
+
+
+def render() -> str:
+    """All metrics in the Prometheus text format."""
+    out = []
+    for metric in _registry:
+        out.append(f"# HELP {metric.name} {metric.help}")
+        out.append(f"# TYPE {metric.name} {metric.kind}")
+        out.extend(metric.lines())
+    out.append("")
+    return "\n".join(out)
+
+
+http_latency = Histogram(
+    "murmly_http_request_duration_seconds", "HTTP request latency by route", ("route", "method")
+)
+ws_connections = Gauge("murmly_websocket_connections", "Open websocket connections")
+messages_in = Counter("murmly_messages_received_total", "Chat messages received over websockets")
+messages_out = Counter("murmly_messages_sent_total", "Messages sent to websockets of this process")
+send_failures = Counter("murmly_send_failures_total", "Websocket sends that raised")
+send_overflows = Counter(
+    "murmly_send_queue_overflows_total", "Messages to a websocket whose send queue was full", ("policy",)
+)
+messages_queued = Counter(
+    "murmly_messages_queued_total", "Messages stored as pending deliveries for offline users"
+)
+db_latency = Histogram(
+    "murmly_db_query_duration_seconds", "SQL statement latency by engine", ("engine",)
+)
+loop_lag = Histogram(
+    "murmly_event_loop_lag_seconds", "How late the event loop ran a timer",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing HTTP requests, labelled by endpoint function name
+    so path parameters do not create new series."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            # the router stores the matched endpoint in the scope
+            endpoint = scope.get("endpoint")
+            route = endpoint.__name__ if endpoint else "other"
+            http_latency.observe(time.perf_counter() - start, route, scope["method"])
+
+
+def instrument_engine(engine, label: str):
+    """Records the latency of every statement run on an (async) engine."""
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info["query_start"] = time.perf_counter()
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        db_latency.observe(time.perf_counter() - conn.info.pop("query_start"), label)
+
+
+class LoopLagMonitor:
+    """Sleeps `interval` seconds in a loop and records how late it woke up."""
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            loop_lag.observe(max(0.0, time.perf_counter() - start - self.interval))
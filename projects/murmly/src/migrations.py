@@ -0,0 +1,99 @@
+"""Schema migrations for existing databases.
+
+`Base.metadata.create_all` only creates missing tables, it does not add
+columns or indexes to tables that already exist. Every migration below
+brings an older murmly.db up to the current models and is written so it
+also runs on a fresh database. The last applied migration is stored in
+SQLite's `PRAGMA user_version`.
+"""
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from logger import logger
+
+
+async def _columns(conn: AsyncConnection, table: str) -> set[str]:
+    result = await conn.execute(text(f"PRAGMA table_info({table})"))
+    return {row[1] for row in result}
+
+
+async def _unique_user_chats(conn: AsyncConnection):
+    # databases created before the unique (user_id, peer_id) index
+    # may contain duplicates, keep the newest row of each pair
+    await conn.execute(
+        text(
+            "DELETE FROM user_chats WHERE id NOT IN "
+            "(SELECT MAX(id) FROM user_chats GROUP BY user_id, peer_id)"
+        )
+    )
+    await conn.execute(
+        text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_user_chats_user_peer "
+            "ON user_chats (user_id, peer_id)"
+        )
+    )
+
+
+async def _message_conversation_key(conn: AsyncConnection):
+    if "conversation_key" not in await _columns(conn, "messages"):
+        await conn.execute(
+            text("ALTER TABLE messages ADD COLUMN conversation_key VARCHAR")
+        )
+    # same format as models.conversation_key
+    await conn.execute(
+        text(
+            "UPDATE messages SET conversation_key = "
+            "min(sender_id, recipient_id) || ':' || max(sender_id, recipient_id) "
+            "WHERE conversation_key IS NULL"
+        )
+    )
+    await conn.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_messages_conversation_time "
+            "ON messages (conversation_key, timestamp)"
+        )
+    )
+
+
+async def _message_conversation_id(conn: AsyncConnection):
+    # keyset pagination of the chat history by id, replaces the timestamp index
+    await conn.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_messages_conversation_id "
+            "ON messages (conversation_key, id)"
+        )
+    )
+    await conn.execute(text("DROP INDEX IF EXISTS ix_messages_conversation_time"))
+
+
+async def _message_ciphertext(conn: AsyncConnection):
+    # new messages keep the raw ciphertext, older rows keep their base64 content
+    if "ciphertext" not in await _columns(conn, "messages"):
+        await conn.execute(text("ALTER TABLE messages ADD COLUMN ciphertext BLOB"))
+
+
+# (version, description, migration), applied in order
+MIGRATIONS = [
+    (1, "unique (user_id, peer_id) on user_chats", _unique_user_chats),
+    (2, "messages.conversation_key and its index", _message_conversation_key),
+    (3, "index messages by (conversation_key, id)", _message_conversation_id),
+    (4, "messages.ciphertext BLOB", _message_ciphertext),
+]
+
+
+async def migrate(conn: AsyncConnection) -> int:
+    """Applies all migrations newer than the database, returns its new version."""
+    if conn.dialect.name != "sqlite":
+        logger.warning(f"Migrations are written for SQLite, skipped on {conn.dialect.name}")
+        return 0
+    version = (await conn.execute(text("PRAGMA user_version"))).scalar()
+    for number, description, migration in MIGRATIONS:
+        if number <= version:
+            continue
+        logger.info(f"Applying migration {number}: {description}")
+        await migration(conn)
+        # PRAGMA does not take bound parameters
+        await conn.execute(text(f"PRAGMA user_version = {int(number)}"))
+        version = number
+    return version
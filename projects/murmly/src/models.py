@@ -7,12 +7,14 @@ from sqlalchemy import (
     ForeignKey,
     DateTime,
     Text,
+    Index,
+    LargeBinary,
 )
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
 
-from typing import Optional
+from typing import Optional, Union
 
 Base = declarative_base()
 
@@ -40,16 +42,45 @@ class User(Base):
     )
 
 
+def conversation_key(user_id: int, peer_id: int) -> str:
+    """Same key for both directions of a chat, "<smaller id>:<larger id>"."""
+    low, high = sorted((user_id, peer_id))
+    return f"{low}:{high}"
+
+
+def _message_conversation_key(context) -> str:
+    params = context.get_current_parameters()
+    if params.get("sender_id") is None or params.get("recipient_id") is None:
+        return None
+    return conversation_key(params["sender_id"], params["recipient_id"])
+
+
+def message_content(content: Union[str, bytes, None]) -> dict:
+    """Column values of a message body, ciphertext goes to the BLOB column."""
+    if isinstance(content, bytes):
+        return {"content": None, "ciphertext": content}
+    return {"content": content, "ciphertext": None}
+
+
 class Message(Base):
     __tablename__ = "messages"
+    # chat history is read by conversation in id (= insertion) order, see migrations.py
+    __table_args__ = (
+        Index("ix_messages_conversation_id", "conversation_key", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     sender_id = Column(Integer, ForeignKey("users.id"))
     recipient_id = Column(Integer, ForeignKey("users.id"))
+    # text, the base64 ciphertext of messages stored before migration 4
+    # (see framing.py) or content that is not base64
     content = Column(Text)
+    # raw AES-GCM ciphertext
+    ciphertext = Column(LargeBinary)
     timestamp = Column(DateTime, default=datetime.utcnow)
     is_read = Column(Boolean, default=False)
     message_number = Column(Integer, default=0)
+    conversation_key = Column(String, default=_message_conversation_key)
 
     # Relationships
     sender = relationship(
@@ -60,8 +91,26 @@ class Message(Base):
     )
 
 
+class PendingDelivery(Base):
+    """A message to a user who was offline, deleted when the user acknowledges it."""
+
+    __tablename__ = "pending_deliveries"
+    __table_args__ = (
+        Index("ix_pending_deliveries_recipient", "recipient_id", "id"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    recipient_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    message_id = Column(Integer, ForeignKey("messages.id"), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
 class UserChat(Base):
     __tablename__ = "user_chats"
+    # one row per (user, peer), needed for the upsert in Database.store_message
+    __table_args__ = (
+        Index("ix_user_chats_user_peer", "user_id", "peer_id", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
@@ -0,0 +1,245 @@
+import asyncio
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Optional
+
+from config import PRESENCE_FLUSH_SECONDS, PRESENCE_TIMEOUT_SECONDS, PRESENCE_PUSH_SECONDS
+from db_utils import Database
+from logger import logger
+
+
+class PresenceTracker:
+    """In-memory online status of users.
+
+    Requests, heartbeats and websocket (dis)connects only update memory, a
+    background task writes the changed users to the database in one batch
+    every PRESENCE_FLUSH_SECONDS and marks users offline that have no
+    websocket and were not seen for PRESENCE_TIMEOUT_SECONDS.
+
+    With several workers, `elsewhere` returns the users that have a websocket
+    on another worker. That worker owns their presence, so this one forgets
+    them instead of marking them offline.
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        elsewhere: Optional[Callable[[list[int]], Awaitable[set[int]]]] = None,
+        flush_interval: float = PRESENCE_FLUSH_SECONDS,
+        timeout: float = PRESENCE_TIMEOUT_SECONDS,
+    ):
+        self.db = db
+        self.elsewhere = elsewhere
+        self.flush_interval = flush_interval
+        self.timeout = timedelta(seconds=timeout)
+        self.state: dict[int, tuple[bool, datetime]] = {}  # user id -> (online, last seen)
+        self.sockets: dict[int, int] = {}  # user id -> open websocket count
+        self.dirty: set[int] = set()
+        # called with (user id, is_online) when a user goes on- or offline
+        self.listeners: list[Callable[[int, bool], None]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def _changed(self, user_id: int, is_online: bool):
+        for listener in self.listeners:
+            listener(user_id, is_online)
+
+    def _set(self, user_id: int, is_online: bool):
+        previous = self.state.get(user_id)
+        self.state[user_id] = (is_online, datetime.utcnow())
+        self.dirty.add(user_id)
+        if previous is None or previous[0] != is_online:
+            self._changed(user_id, is_online)
+
+    def touch(self, user_id: int):
+        """User made a request or sent a heartbeat."""
+        self._set(user_id, True)
+
+    def connect(self, user_id: int):
+        self.sockets[user_id] = self.sockets.get(user_id, 0) + 1
+        self._set(user_id, True)
+
+    async def disconnect(self, user_id: int):
+        count = self.sockets.get(user_id, 0) - 1
+        if count > 0:
+            self.sockets[user_id] = count
+            return
+        self.sockets.pop(user_id, None)
+        try:
+            elsewhere = await self._elsewhere([user_id])
+        except Exception as e:
+            # stays online, the sweep asks again once the session expired
+            logger.error(f"Failed to look up the websockets of user {user_id}: {e}")
+            return
+        # or it connected again meanwhile
+        if user_id in elsewhere or user_id in self.sockets:
+            return
+        self._set(user_id, False)
+
+    def set_offline(self, user_id: int):
+        """Explicit logout."""
+        self.sockets.pop(user_id, None)
+        self._set(user_id, False)
+
+    def get(self, user_id: int) -> Optional[tuple[bool, datetime]]:
+        """(is_online, last_seen) if this process knows the user, else None."""
+        return self.state.get(user_id)
+
+    async def _elsewhere(self, user_ids: list[int]) -> set[int]:
+        """Users with a websocket on another worker, forgotten by this one."""
+        if self.elsewhere is None:
+            return set()
+        elsewhere = await self.elsewhere(user_ids)
+        for user_id in elsewhere:
+            if user_id not in self.sockets:
+                self.state.pop(user_id, None)
+                self.dirty.discard(user_id)
+        return elsewhere
+
+    def _expired(self, deadline: datetime) -> list[int]:
+        return [
+            user_id
+            for user_id, (is_online, last_seen) in self.state.items()
+            if is_online and last_seen < deadline and user_id not in self.sockets
+        ]
+
+    async def sweep(self):
+        """Marks users offline whose session expired."""
+        deadline = datetime.utcnow() - self.timeout
+        expired = self._expired(deadline)
+        if not expired:
+            return
+        try:
+            await self._elsewhere(expired)
+        except Exception as e:
+            # unknown if another worker holds their websocket, retried next time
+            logger.error(f"Failed to look up the websockets of {len(expired)} users: {e}")
+            return
+        # a request or websocket may have arrived meanwhile
+        still_expired = set(self._expired(deadline))
+        for user_id in expired:
+            if user_id not in still_expired:
+                continue
+            _, last_seen = self.state[user_id]
+            self.state[user_id] = (False, last_seen)
+            self.dirty.add(user_id)
+            self._changed(user_id, False)
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, set()
+        rows = [(user_id, *self.state[user_id]) for user_id in dirty]
+        try:
+            await self.db.bulk_update_presence(rows)
+        except Exception as e:
+            logger.error(f"Failed to flush presence of {len(rows)} users: {e}")
+            self.dirty |= dirty
+            return
+        # forget offline users, the database has their final state
+        for user_id, is_online, _ in rows:
+            if not is_online and user_id not in self.dirty:
+                self.state.pop(user_id, None)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.sweep()
+            await self.flush()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+
+class PresenceFeed:
+    """Pushes presence changes to the websockets that subscribed to them.
+
+    A client sends {"type": "presence_subscribe"} and gets a snapshot of the
+    online users, then deltas {"type": "presence", "online": [{"id",
+    "username"}], "offline": [ids]}. Changes are collected for `interval`
+    seconds so a burst of (dis)connects becomes one frame per subscriber.
+    """
+
+    def __init__(
+        self,
+        tracker: PresenceTracker,
+        db: Database,
+        send: Callable[[int, dict], Awaitable[bool]],
+        interval: float = PRESENCE_PUSH_SECONDS,
+    ):
+        self.tracker = tracker
+        self.db = db
+        self.send = send
+        self.interval = interval
+        self.subscribers: set[int] = set()
+        self.changes: dict[int, bool] = {}  # user id -> latest status since the last push
+        self._scheduled: Optional[asyncio.TimerHandle] = None
+        self._pushes: set[asyncio.Task] = set()
+        tracker.listeners.append(self.changed)
+
+    def changed(self, user_id: int, is_online: bool):
+        if not self.subscribers:
+            return
+        self.changes[user_id] = is_online
+        if self._scheduled is None:
+            self._scheduled = asyncio.get_running_loop().call_later(self.interval, self._start_push)
+
+    def _start_push(self):
+        self._scheduled = None
+        task = asyncio.create_task(self.push())
+        self._pushes.add(task)
+        task.add_done_callback(self._pushes.discard)
+
+    async def _users(self, user_ids) -> list[dict]:
+        users = []
+        for user_id in user_ids:
+            # cached by the database, one query per user at most
+            user = await self.db.get_user_by_id(user_id)
+            if user:
+                users.append({"id": user.id, "username": user.username})
+        return users
+
+    async def snapshot(self, user_id: int) -> dict:
+        """Online users right now, subscribes `user_id` to the following deltas."""
+        online = {user.id: user.username for user in await self.db.get_online_users()}
+        # in-memory presence is newer than the flushed database state
+        for other_id, (is_online, _) in list(self.tracker.state.items()):
+            if not is_online:
+                online.pop(other_id, None)
+            elif other_id not in online:
+                online[other_id] = None
+        missing = [i for i, name in online.items() if name is None]
+        for user in await self._users(missing):
+            online[user["id"]] = user["username"]
+        self.subscribers.add(user_id)
+        return {
+            "type": "presence_snapshot",
+            "users": [{"id": i, "username": name} for i, name in online.items() if name],
+        }
+
+    def unsubscribe(self, user_id: int):
+        self.subscribers.discard(user_id)
+
+    async def push(self):
+        changes, self.changes = self.changes, {}
+        if not changes or not self.subscribers:
+            return
+        frame = {
+            "type": "presence",
+            "online": await self._users(i for i, online in changes.items() if online),
+            "offline": [i for i, online in changes.items() if not online],
+        }
+        await asyncio.gather(*(self.send(user_id, frame) for user_id in list(self.subscribers)))
+
+    async def stop(self):
+        if self._scheduled:
+            self._scheduled.cancel()
+        for task in list(self._pushes):
+            task.cancel()
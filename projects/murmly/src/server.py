@@ -5,6 +5,9 @@ from fastapi import (
     status,
     WebSocket,
     WebSocketDisconnect,
+    Query,
+    Request,
+    Response,
 )
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
@@ -13,6 +16,14 @@ from typing import Optional
 from datetime import datetime, timedelta
 from socket_manager import SocketManager
 from db_utils import Database, User
+from presence import PresenceTracker, PresenceFeed
+from fanout import create_fanout
+from dh_params import DHParamsManager, EncodedResponse
+from hasher import HasherBusy
+from key_directory import KeyDirectory
+from framing import parse_content, stored_content, json_content
+import metrics
+from metrics import MetricsMiddleware, LoopLagMonitor, Counter, Gauge
 from models import (
     UserBase,
     UserCreate,
@@ -24,28 +35,67 @@ from models import (
     MessageSchema,
 )
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 import os
-
-from config import PRIME_BITS, SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES
+import json
+import time
+import hashlib
+
+from config import (
+    PRIME_BITS,
+    SECRET_KEY,
+    ALGORITHM,
+    ACCESS_TOKEN_EXPIRE_MINUTES,
+    TOKEN_CACHE_SIZE,
+    TOKEN_CACHE_TTL,
+    PENDING_BATCH_SIZE,
+    FANOUT_URL,
+    PUBLIC_KEY_BATCH_MAX,
+)
+from cache import TTLCache
 
 import crypto_utils
 import jwt
 
 # =============================================================================
-from logger import logger
+from logger import logger, ws_logger
 
 # =============================================================================
 # database setup
 DATABASE_URL = "sqlite+aiosqlite:///murmly.db"
 db = Database(DATABASE_URL)
+# routes messages to the worker that holds the recipient's websocket
+fanout = create_fanout(FANOUT_URL)
+presence = PresenceTracker(db, fanout.connected_elsewhere)
+key_directory = KeyDirectory(db)
+loop_monitor = LoopLagMonitor()
+metrics.instrument_engine(db.engine, "write")
+if db.read_engine is not db.engine:
+    metrics.instrument_engine(db.read_engine, "read")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await db.init_db()
+    if not FANOUT_URL:
+        # the only worker, nobody is connected yet. With several workers the
+        # others may already have users online.
+        await db.reset_online_status()
     print("Database initialized during startup!")
+    presence.start()
+    db.start_writer()
+    await fanout.start(socket_manager.send, worker_event, spill_to_pending)
+    socket_manager.start(spill_to_pending, send_pending_messages)
+    dh_manager.start()
+    loop_monitor.start()
     yield
+    await loop_monitor.stop()
+    await presence_feed.stop()
+    await socket_manager.stop()
+    await dh_manager.stop()
+    await fanout.stop()
+    await db.stop_writer()
+    await presence.stop()
 
 
 app = FastAPI(title="Murmly Chat API", lifespan=lifespan)
@@ -58,10 +108,33 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # paging cursor of /users/online and /users/{id}/chat
+    expose_headers=["X-Next-Cursor"],
 )
+app.add_middleware(MetricsMiddleware)
 
 socket_manager = SocketManager()
-dh_params = crypto_utils.generate_dh_parameters()
+# pushes presence changes to websockets that sent presence_subscribe
+presence_feed = PresenceFeed(presence, db, socket_manager.send)
+# other workers push the changes of this one to their subscribers, see worker_event
+presence.listeners.append(
+    lambda user_id, is_online: fanout.broadcast(
+        {"type": "presence", "user_id": user_id, "online": is_online}
+    )
+)
+# fixed RFC 7919 group or cached parameters, nothing is generated at import
+dh_manager = DHParamsManager()
+dh_manager.load()
+
+
+def worker_event(event: dict):
+    """Applies a change another worker broadcast through the fan-out backend."""
+    if event["type"] == "key_changed":
+        # the caches of this worker still hold the replaced key
+        db.invalidate_user(User(id=event["user_id"], username=event["username"]))
+        key_directory.invalidate(event["user_id"])
+    elif event["type"] == "presence":
+        presence_feed.changed(event["user_id"], event["online"])
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -76,6 +149,31 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+# token -> username, so a token's signature is only checked once
+token_cache = TTLCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+
+
+def get_username_from_token(token: str) -> Optional[str]:
+    """Decodes a JWT, raises jwt.PyJWTError if it is invalid or expired"""
+    username = token_cache.get(token)
+    if username:
+        return username
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    username = payload.get("sub")
+    # never cache a token beyond its expiry
+    ttl = payload.get("exp", 0) - time.time()
+    if username and ttl > 0:
+        token_cache.set(token, username, ttl=ttl)
+    return username
+
+
+def _hasher_busy() -> HTTPException:
+    # login storm, let the client retry instead of queueing without bound
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Server busy, try again",
+        headers={"Retry-After": "1"},
+    )
 
 
 @app.post("/register")
@@ -93,6 +191,8 @@ async def register_user(user: UserCreate):
     try:
         user = await db.create_user(user.username, user.password)
 
+    except HasherBusy:
+        raise _hasher_busy()
     except Exception as e:
         logger.error(f"Error creating user: {e}")
         raise HTTPException(
@@ -113,13 +213,13 @@ async def register_user(user: UserCreate):
 @app.post("/token", response_model=Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
     """Login and return access token"""
-    logger.info(
-        f"Logging in user: {form_data.username}, password: {form_data.password}"
-    )
+    logger.info("Logging in user: %s", form_data.username)
     try:
         user = await db.get_user_by_username_and_password(
             form_data.username, form_data.password
         )
+    except HasherBusy:
+        raise _hasher_busy()
     except Exception as e:
         logger.error(f"Error logging in user: {e}")
         raise HTTPException(
@@ -151,18 +251,17 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
     )
 
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         # TODO Refresh token if expired
-        username: str = payload.get("sub")
+        username = get_username_from_token(token)
         if username is None:
             raise credentials_exception
         token_data = TokenData(username=username)
     except jwt.PyJWTError:
         raise credentials_exception
     user = await db.get_user_by_username(token_data.username)
-    await db.set_user_online_status(user, True)
     if user is None:
         raise credentials_exception
+    presence.touch(user.id)
     return user
 
 
@@ -174,63 +273,154 @@ async def update_public_key(
     """Update the public key of the current user"""
     logger.info(f"Updating public key for user: {current_user.username}")
     await db.update_user_public_key(current_user, public_key_update.public_key)
+    key_directory.invalidate(current_user.id)
+    fanout.broadcast(
+        {"type": "key_changed", "user_id": current_user.id, "username": current_user.username}
+    )
     return {"status": "success"}
 
 
+@app.get("/users/public_keys")
+async def get_public_keys(
+    request: Request,
+    response: Response,
+    ids: list[int] = Query(...),
+    known: list[str] = Query([]),
+    current_user: User = Depends(get_current_user),
+):
+    """Public keys of several users, `?ids=1&ids=2`.
+
+    Every key has a `version`. Keys the client passes as `known=<id>:<version>`
+    come back without `public_key` if they did not change. The ETag covers
+    the versions of all requested keys, If-None-Match gets a 304 if none changed.
+    Like the single key endpoint, the caller's own id is forbidden.
+    """
+    if len(ids) > PUBLIC_KEY_BATCH_MAX:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {PUBLIC_KEY_BATCH_MAX} ids per request",
+        )
+    if current_user.id in ids:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Cannot retrieve own public key",
+        )
+    entries = await key_directory.get_many(dict.fromkeys(ids))
+    tag = ";".join(f"{i}:{e[2] if e else '-'}" for i, e in entries.items())
+    etag = f'"{hashlib.sha256(tag.encode()).hexdigest()[:16]}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+    known_versions = dict(k.partition(":")[::2] for k in known)
+    keys, missing = [], []
+    for user_id, entry in entries.items():
+        if entry is None:
+            missing.append(user_id)
+            continue
+        username, public_key, version = entry
+        item = {"id": user_id, "username": username, "version": version}
+        if known_versions.get(str(user_id)) != version:
+            item["public_key"] = public_key
+        keys.append(item)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, no-cache"
+    return {"keys": keys, "missing": missing}
+
+
 @app.get("/users/{userId}/public_key", response_model=PublicKeyResponse)
 async def get_user_public_key(
     userId: int,
+    request: Request,
+    response: Response,
     current_user=Depends(get_current_user),
 ):
-    """Get the public key of a user"""
-    logger.info(f"Retrieving public key for user: {userId}")
-    user = await db.get_user_by_id(user_id=userId)
-
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="User not found"
-        )
-    if user.username == current_user.username:
+    """Get the public key of a user, with the key version as ETag"""
+    if userId == current_user.id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Cannot retrieve own public key",
         )
-
-    if not user.public_key_b64:
+    entry = await key_directory.get(userId)
+    if entry is None:
+        user = await db.get_user_by_id(user_id=userId)
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail="Public key not found for user",
+            detail="Public key not found for user" if user else "User not found",
         )
+    username, public_key, version = entry
+
+    etag = f'"{version}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, no-cache"
+    return {"username": username, "public_key": public_key}
+
+
+@app.get("/stats/cache")
+def get_cache_stats():
+    """Hit rates of the token and user caches"""
+    return {"tokens": token_cache.stats(), **db.cache_stats()}
+
+
+# read when /metrics is scraped
+Gauge("murmly_hasher_in_flight", "Password hashes running or waiting", lambda: db.hasher.in_flight)
+Gauge("murmly_hasher_queued", "Password hashes waiting for a worker", lambda: db.hasher.queued)
+Counter("murmly_hasher_rejected_total", "Logins and registrations rejected with 503", fn=lambda: db.hasher.rejected)
+Counter("murmly_hasher_failed_total", "Password hashes that raised", fn=lambda: db.hasher.failed)
+Gauge("murmly_write_queue_depth", "Rows waiting for the group commit writer", db.write_queue_depth)
+Gauge("murmly_token_cache_hit_rate", "Hit rate of the decoded token cache", lambda: token_cache.stats()["hit_rate"])
+Gauge("murmly_user_cache_hit_rate", "Hit rate of the user by id cache", lambda: db.users_by_id.stats()["hit_rate"])
+Gauge(
+    "murmly_send_queue_depth_max", "Messages waiting in the fullest websocket send queue",
+    lambda: max(socket_manager.queue_depths(), default=0),
+)
+Gauge(
+    "murmly_send_queue_depth_total", "Messages waiting in all websocket send queues",
+    lambda: sum(socket_manager.queue_depths()),
+)
+Gauge(
+    "murmly_send_queue_spilled", "Websockets whose new messages wait as pending deliveries",
+    socket_manager.spilled_count,
+)
 
-    return {"username": user.username, "public_key": user.public_key_b64}
 
+@app.get("/metrics")
+def get_metrics():
+    """Prometheus text format"""
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
 
-@app.get("/dh_params")
-def get_dh_params():
-    """Diffie hellman parameters for exchange"""
-    if not dh_params:
+
+@app.get("/stats/hasher")
+def get_hasher_stats():
+    """Queue depth and wait times of the bcrypt thread pool"""
+    return db.hasher.stats()
+
+
+def _dh_response(request: Request, encoded: Optional[EncodedResponse]) -> Response:
+    if encoded is None:
         logger.error("DH params not available")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="DH params not available",
         )
+    # revalidated on every use, the parameters change on a restart in "generated" mode
+    headers = {"ETag": encoded.etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == encoded.etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=encoded.body, media_type="application/json", headers=headers)
 
-    serialized_params = crypto_utils.serialize_parameters(dh_params)
-    serialized_params_str = serialized_params.decode("utf-8")
-    logger.info(f"Serialized DH params: {serialized_params_str}")
-    return {"params": serialized_params_str}
+
+@app.get("/dh_params")
+def get_dh_params(request: Request):
+    """Diffie hellman parameters for exchange, as PEM"""
+    return _dh_response(request, dh_manager.pem_response)
 
 
 @app.get("/dh_params_js")
-async def get_dh_params_for_js():
-    """Diffie hellman parameters for exchange"""
-    if not dh_params:
-        logger.error("DH params not available")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="DH params not available",
-        )
-    return crypto_utils.get_dh_params_as_hex(dh_params)
+def get_dh_params_for_js(request: Request):
+    """Diffie hellman parameters for exchange, as hex for the web client"""
+    return _dh_response(request, dh_manager.hex_response)
 
 
 # inspiration for messaging app from:
@@ -239,8 +429,10 @@ async def get_dh_params_for_js():
 async def websocket_endpoint(token: str, websocket: WebSocket):
     user = None
 
-    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-    user_name = payload.get("sub")
+    try:
+        user_name = get_username_from_token(token)
+    except jwt.PyJWTError:
+        user_name = None
     if user_name is None:
         await websocket.close()
         return
@@ -250,58 +442,86 @@ async def websocket_endpoint(token: str, websocket: WebSocket):
         await websocket.close()
         return
 
-    await db.set_user_online_status(user, True)
-    await socket_manager.connect(websocket, user)
+    presence.connect(user.id)
+    connection = await socket_manager.connect(websocket, user)
+    metrics.ws_connections.inc()
+    await fanout.subscribe(user.id)
 
     try:
+        await connection.redeliver()
         while True:
             try:
-                data = await websocket.receive_json()
+                data = await socket_manager.receive(websocket)
             except WebSocketDisconnect as e:
                 print(f"WebSocket disconnected: {e}")
                 break
 
+            if data.get("type") == "presence_subscribe":
+                # snapshot first, deltas follow on this socket
+                await socket_manager.send_to(websocket, await presence_feed.snapshot(user.id))
+                continue
+
+            if data.get("type") == "ack":
+                # the client stored these pending messages, stop redelivering them
+                message_ids = [int(i) for i in data.get("message_ids", [])]
+                if message_ids:
+                    await db.delete_pending_deliveries(user.id, message_ids)
+                continue
+
+            if data.get("type") is not None:
+                # chat messages have no type, content of anything else is not parsed
+                await websocket.send_json({"error": f"Unknown message type {data['type']!r}"})
+                continue
+
+            metrics.messages_in.inc()
             recipient = UserBase(**data.get("recipient"))
-            logger.info(f"Recipient ID: {recipient.id}")
             content = data.get("content")
+            if isinstance(content, str):
+                # base64 from a JSON peer, stored and forwarded as bytes
+                content = parse_content(content)
             message_number = data.get("message_number", 0)  # Get message number, default to 0
 
-            logger.info(f"Getting recipient user by ID: {recipient.id}") 
             recipient_user = await db.get_user_by_id(recipient.id)
-            logger.info(f"Recipient user: {recipient_user}")
             if not recipient_user:
                 await websocket.send_json({"error": "Recipient not found"})
                 continue
 
-            # Create message in database with message number
-            message = await db.create_message(user, recipient_user, content, message_number)
-            logger.info(f"Message created: {message}")
-            # Update or create chat records for both users
-            await db.update_user_chat(user.id, recipient_user.id, message.id)
-            await db.update_user_chat(recipient_user.id, user.id, message.id)
-
-            message_json = {
-                "sender": {"id": user.id, "username": user.username},
-                "recipient": {
-                    "id": recipient_user.id,
-                    "username": recipient_user.username,
-                },
-                "content": content,
-                "timestamp": message.timestamp.isoformat(),
-                "message_number": message_number,  # Include message number in response
-                "is_new_chat": True,
-            }
-
-            logger.info(f"Message JSON: {message_json}")
-            logger.info(f"Sending message to {recipient_user.username}: {message_json}")
-
-            message_sent = await socket_manager.send_message(
-                message=message_json, user=recipient_user
+            # Store the message and update both users' chat records, one commit
+            message = await db.enqueue_message(user, recipient_user, content, message_number)
+
+            message_json = _ws_message(
+                message.id,
+                user.id,
+                user.username,
+                recipient_user,
+                content,
+                message.timestamp,
+                message_number,
+            )
+
+            message_sent = await fanout.publish(recipient_user.id, message_json)
+            # no content, it is ciphertext and the volume would swamp the log
+            ws_logger.info(
+                "Message %s from %s to %s delivered=%s",
+                message.id,
+                user.id,
+                recipient_user.id,
+                message_sent,
+                extra={"message_id": message.id, "sender_id": user.id, "recipient_id": recipient_user.id},
             )
-            logger.info(f"Message sent status: {message_sent}")
 
             if not message_sent:
-                await websocket.send_json({"error": "Message not sent"})
+                # recipient is offline, delivered when it connects again
+                await db.enqueue_pending_delivery(recipient_user.id, message.id)
+                metrics.messages_queued.inc()
+                await websocket.send_json({
+                    "type": "delivery_status",
+                    "delivered": False,
+                    "queued": True,
+                    "message_id": message.id,
+                    "recipient": {"id": recipient_user.id, "username": recipient_user.username},
+                    "timestamp": message.timestamp.isoformat(),
+                })
                 continue
 
     except Exception as e:
@@ -309,76 +529,169 @@ async def websocket_endpoint(token: str, websocket: WebSocket):
         await socket_manager.disconnect(user)
         await websocket.close()
     finally:
-        await db.set_user_online_status(user, False)
+        metrics.ws_connections.dec()
+        await socket_manager.remove(user, websocket)
+        if not socket_manager.is_connected(user.id):
+            presence_feed.unsubscribe(user.id)
+            await fanout.unsubscribe(user.id)
+        await presence.disconnect(user.id)
+
+
+def _ws_message(
+    message_id: int,
+    sender_id: int,
+    sender_username: str,
+    recipient: User,
+    content: str | bytes,
+    timestamp: datetime,
+    message_number: int,
+) -> dict:
+    return {
+        "id": message_id,
+        "sender": {"id": sender_id, "username": sender_username},
+        "recipient": {"id": recipient.id, "username": recipient.username},
+        "content": content,
+        "timestamp": timestamp.isoformat(),
+        "message_number": message_number,  # Include message number in response
+        "is_new_chat": True,
+    }
+
+
+async def spill_to_pending(user_id: int, message: dict):
+    """Stores a message the send queue of a websocket had no room for, or
+    that reached this worker after the websocket closed. It is resent as a
+    pending message."""
+    await db.enqueue_pending_delivery(user_id, message["id"])
+    metrics.messages_queued.inc()
+
+
+async def send_pending_messages(websocket: WebSocket, user: User, after_id: int = 0) -> int:
+    """Sends the messages that arrived while the user was offline, or were
+    spilled, after the pending delivery after_id. Returns the last one sent.
+
+    PENDING_BATCH_SIZE messages per frame, they stay queued until the client
+    acknowledges them with {"type": "ack", "message_ids": [...]}.
+    """
+    while True:
+        rows = await db.get_pending_deliveries(user.id, after_id)
+        if not rows:
+            return after_id
+        await socket_manager.send_to(websocket, {
+            "type": "pending_messages",
+            "messages": [
+                _ws_message(
+                    row.id,
+                    row.sender_id,
+                    row.sender_username,
+                    user,
+                    stored_content(row.content, row.ciphertext),
+                    row.timestamp,
+                    row.message_number,
+                )
+                for row in rows
+            ],
+            "more": len(rows) == PENDING_BATCH_SIZE,
+        })
+        ws_logger.debug("Sent %d pending messages to %s", len(rows), user.username)
+        after_id = rows[-1].pending_id
+        if len(rows) < PENDING_BATCH_SIZE:
+            return after_id
 
 
 @app.get("/users/online")
-async def get_online_users(current_user: User = Depends(get_current_user)):
-    """Get all users that the current user has chatted with plus additional users"""
-    # Get all users the current user has chatted with
-    user_chats = await db.get_user_chats(current_user.id)
-    chat_peer_ids = {chat.peer_id for chat in user_chats}
-    
-    # Get all users
-    all_users = await db.get_all_users()
-    
-    # Format response with chat history info
+async def get_online_users(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    cursor: Optional[int] = None,
+    current_user: User = Depends(get_current_user),
+):
+    """Get all users with the last message exchanged with the current user.
+
+    Paginated with `limit` and `cursor`, the cursor of the next page is returned
+    in the X-Next-Cursor header.
+    """
+    rows = await db.get_users_with_last_message(current_user.id, limit, cursor)
+
     users_with_chat_info = []
-    for user in all_users:
-        if user.id == current_user.id:
-            continue
-            
-        chat_info = next((chat for chat in user_chats if chat.peer_id == user.id), None)
-        last_message = chat_info.last_message if chat_info else None
-        
-        logger.info(f"Chat info: {chat_info}")
+    for user, last_message in rows:
+        # the in-memory presence is newer than the last flushed db state
+        is_online, last_seen = presence.get(user.id) or (user.is_online, user.last_seen)
         users_with_chat_info.append({
             "id": user.id,
             "username": user.username,
-            "is_online": user.is_online,
-            "last_seen": user.last_seen.isoformat() if user.last_seen else None,
+            "is_online": is_online,
+            "last_seen": last_seen.isoformat() if last_seen else None,
             "last_message": {
-                "content": last_message.content if last_message else None,
-                "timestamp": last_message.timestamp.isoformat() if last_message else None,
-                "is_mine": last_message.sender_id == current_user.id if last_message else None
+                "content": json_content(stored_content(last_message.content, last_message.ciphertext)),
+                "timestamp": last_message.timestamp.isoformat(),
+                "is_mine": last_message.sender_id == current_user.id,
             } if last_message else None,
         })
-    
+
+    if limit is not None and len(rows) == limit:
+        response.headers["X-Next-Cursor"] = str(rows[-1][0].id)
     return users_with_chat_info
 
 
+def _chat_message(row, current_user: User, peer: User) -> dict:
+    sender, recipient = (current_user, peer) if row.sender_id == current_user.id else (peer, current_user)
+    return {
+        "id": row.id,
+        "content": json_content(stored_content(row.content, row.ciphertext)),
+        "timestamp": row.timestamp.isoformat(),
+        "sender": {"id": sender.id, "username": sender.username},
+        "recipient": {"id": recipient.id, "username": recipient.username},
+        "isMine": row.sender_id == current_user.id,
+        "message_number": row.message_number,  # Include message number in response
+    }
+
+
 @app.get("/users/{user_id}/chat")
 async def get_chat_history(
     user_id: int,
-    current_user: User = Depends(get_current_user)
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    before_id: Optional[int] = None,
+    current_user: User = Depends(get_current_user),
+):
+    """Get chat history between current user and specified user, oldest first.
+
+    Paginated from the newest message backwards with `limit` and `before_id`,
+    the `before_id` of the previous (older) page is returned in the
+    X-Next-Cursor header.
+    """
+    peer = await db.get_user_by_id(user_id)
+    if not peer:
+        raise HTTPException(status_code=404, detail="User not found")
+    rows = await db.get_chat_history(current_user.id, user_id, limit, before_id)
+    if limit is not None and len(rows) == limit:
+        response.headers["X-Next-Cursor"] = str(rows[0].id)
+    return [_chat_message(row, current_user, peer) for row in rows]
+
+
+@app.get("/users/{user_id}/chat/export")
+async def export_chat_history(
+    user_id: int,
+    current_user: User = Depends(get_current_user),
 ):
-    """Get chat history between current user and specified user"""
-    messages = await db.get_chat_history(current_user.id, user_id)
-    messages_new = [
-        {
-            "id": message.id,
-            "content": message.content,
-            "timestamp": message.timestamp.isoformat(),
-            "sender": {
-                "id": message.sender_id,
-                "username": message.sender.username
-            },
-            "recipient": {
-                "id": message.recipient_id,
-                "username": message.recipient.username
-            },
-            "isMine": message.sender_id == current_user.id,
-            "message_number": message.message_number  # Include message number in response
-        }
-        for message in messages
-    ]
-    return messages_new
+    """Whole chat history as NDJSON, one message per line, oldest first."""
+    peer = await db.get_user_by_id(user_id)
+    if not peer:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    async def lines():
+        async for rows in db.iter_chat_history(current_user.id, user_id):
+            yield "".join(
+                json.dumps(_chat_message(row, current_user, peer)) + "\n" for row in rows
+            )
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
 
 @app.post("/users/ping")
 async def ping_user(current_user: User = Depends(get_current_user)):
     """Update user's online status and last seen timestamp"""
-    await db.update_user_status(current_user.id, True)
+    presence.touch(current_user.id)
     return {"status": "ok"}
 
 
@@ -408,7 +721,7 @@ async def get_messages(username: str, current_user=Depends(get_current_user)):
 @app.post("/logout", response_model=dict)
 async def logout(current_user=Depends(get_current_user)):
     """Logout the user"""
-    await db.set_user_online_status(current_user, False)
+    presence.set_offline(current_user.id)
 
     return {"status": "success"}
 
@@ -1,9 +1,123 @@
-from fastapi import WebSocket
+import json
+import asyncio
+from typing import Awaitable, Callable, Optional
 
+from fastapi import WebSocket, WebSocketDisconnect
+
+from config import SEND_QUEUE_SIZE, SEND_QUEUE_POLICY
 from db_utils import User
+from framing import BINARY_SUBPROTOCOL, decode_frame, encode_frame, has_bytes, to_json
+
+
+from logger import logger, ws_logger
+import metrics
+
+
+# stores a chat message of a full or closed queue as a pending delivery
+Spill = Callable[[int, dict], Awaitable[None]]
+# sends the pending deliveries of a user after a pending delivery id to its
+# websocket, returns the id of the last one sent
+Redeliver = Callable[[WebSocket, User, int], Awaitable[int]]
+
+POLICIES = ("drop", "disconnect", "spill")
+
+
+class Connection:
+    """A websocket and its bounded outbound queue.
+
+    One writer task sends the queued messages, so a slow client only delays
+    its own messages and never the receive loop of the sender.
 
+    While `spilled` is set, older messages are pending deliveries that have
+    not been sent yet, so new chat messages are spilled behind them instead
+    of overtaking them in the queue. It is set from the connect until the
+    messages stored while the user was offline are sent, and after an
+    overflow until the queue has drained and the spilled ones are sent.
+    """
 
-from logger import logger
+    def __init__(self, manager: "SocketManager", websocket: WebSocket, user: User, maxsize: int):
+        self.manager = manager
+        self.websocket = websocket
+        self.user = user
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        # without a spill callback nothing can wait as a pending delivery
+        self.spilled = manager._spill is not None
+        # last pending delivery sent on this websocket, unacknowledged ones
+        # before it are only resent after a reconnect
+        self.pending_sent_id = 0
+        self.spills_in_flight = 0
+        self.spill_count = 0
+        self.redelivering = asyncio.Lock()
+        # taken from the queue but not sent yet
+        self.sending: Optional[dict] = None
+        self.task = asyncio.create_task(self._write())
+
+    async def _write(self):
+        while True:
+            self.sending = await self.queue.get()
+            # None only wakes the writer up to resend spilled messages
+            if self.sending is not None:
+                try:
+                    await self.manager.send_to(self.websocket, self.sending)
+                except Exception as e:
+                    metrics.send_failures.inc()
+                    ws_logger.warning("Error sending message to user with id: %s: %s", self.user.id, e)
+                    self.manager.forget(self)
+                    await self._spill_queued()
+                    return
+                metrics.messages_out.inc()
+                self.sending = None
+            if self.spilled and self.queue.empty():
+                await self.redeliver()
+
+    async def redeliver(self):
+        """Sends the pending deliveries not sent on this websocket yet, then
+        lets new messages through the queue again."""
+        async with self.redelivering:
+            while self.spilled:
+                spills = self.spill_count
+                try:
+                    self.pending_sent_id = await self.manager.redeliver(self, self.pending_sent_id)
+                except Exception as e:
+                    # stays spilled, retried after the next spill or on reconnect
+                    ws_logger.warning("Resending pending messages to %s failed: %s", self.user.id, e)
+                    return
+                # a message spilled meanwhile may not have been read
+                if self.spill_count == spills and not self.spills_in_flight:
+                    self.spilled = False
+
+    async def spill(self, message: dict):
+        """Stores a chat message as a pending delivery behind the older ones."""
+        self.spilled = True
+        self.spills_in_flight += 1
+        try:
+            await self.manager.spill(self.user.id, message)
+        finally:
+            self.spills_in_flight -= 1
+            self.spill_count += 1
+        if self.queue.empty():
+            # wakes the writer up to resend it
+            self.queue.put_nowait(None)
+
+    async def _spill_queued(self):
+        if self.sending is not None:
+            await self.manager.spill(self.user.id, self.sending)
+            self.sending = None
+        while not self.queue.empty():
+            message = self.queue.get_nowait()
+            if message is not None:
+                await self.manager.spill(self.user.id, message)
+
+    async def close(self):
+        """Stops the writer, messages it did not send become pending deliveries,
+        the one it was sending too as the client may not have it."""
+        if not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        await self._spill_queued()
 
 
 class SocketManager:
@@ -12,32 +126,140 @@ class SocketManager:
 
     def __init__(
         self,
+        queue_size: int = SEND_QUEUE_SIZE,
+        policy: str = SEND_QUEUE_POLICY,
     ):
-        self.connections = {}
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown send queue policy {policy!r}, expected one of {POLICIES}")
+        self.connections: dict[int, Connection] = {}
+        self.queue_size = queue_size
+        self.policy = policy
+        self._spill: Optional[Spill] = None
+        self._redeliver: Optional[Redeliver] = None
+        # connections closed by the disconnect policy, closing may wait on the slow client
+        self._closing: set[asyncio.Task] = set()
+
+    def start(self, spill: Spill, redeliver: Redeliver):
+        self._spill = spill
+        self._redeliver = redeliver
+
+    async def stop(self):
+        for connection in list(self.connections.values()):
+            await connection.close()
+        self.connections.clear()
 
-    async def connect(self, websocket: WebSocket, user: User):
-        await websocket.accept()
-        self.connections[user.id] = websocket
+    async def connect(self, websocket: WebSocket, user: User) -> Connection:
+        """Accepts a websocket, call Connection.redeliver() next to send the
+        messages that arrived while the user was offline."""
+        # clients that offer the binary subprotocol get ciphertext as raw bytes
+        binary = BINARY_SUBPROTOCOL in websocket.scope.get("subprotocols", [])
+        await websocket.accept(subprotocol=BINARY_SUBPROTOCOL if binary else None)
+        websocket.state.binary = binary
+        previous = self.connections.get(user.id)
+        if previous is not None:
+            # a second websocket of the user replaces the first. Its writer
+            # stops and what it did not send is resent on the new one.
+            await previous.close()
+        connection = self.connections[user.id] = Connection(self, websocket, user, self.queue_size)
         logger.info(f"User {user.username} connected with id: {user.id}")
+        return connection
 
     async def disconnect(self, user: User):
-        websocket = self.connections.get(user.id)
-        if websocket:
-            await websocket.close()
-            del self.connections[user.id]
+        connection = self.connections.pop(user.id, None)
+        if connection:
+            await connection.close()
+            await connection.websocket.close()
             logger.info(f"User {user.username} disconnected with id: {user.id}")
 
+    async def remove(self, user: User, websocket: WebSocket):
+        """Forgets a closed websocket, unless the user already reconnected."""
+        connection = self.connections.get(user.id)
+        if connection is not None and connection.websocket is websocket:
+            del self.connections[user.id]
+            await connection.close()
+
+    def forget(self, connection: Connection):
+        if self.connections.get(connection.user.id) is connection:
+            del self.connections[connection.user.id]
+
+    def queue_depths(self) -> list[int]:
+        """Queued messages of every connection, for /metrics."""
+        return [c.queue.qsize() for c in self.connections.values()]
+
+    def spilled_count(self) -> int:
+        return sum(c.spilled for c in self.connections.values())
+
+    async def spill(self, user_id: int, message: dict):
+        # only chat messages have an id, presence updates are dropped
+        if self._spill is not None and "id" in message:
+            await self._spill(user_id, message)
+
+    async def redeliver(self, connection: Connection, after_id: int) -> int:
+        if self._redeliver is None:
+            return after_id
+        return await self._redeliver(connection.websocket, connection.user, after_id)
+
+    def is_connected(self, user_id: int) -> bool:
+        return user_id in self.connections
+
+    async def receive(self, websocket: WebSocket) -> dict:
+        """Next message of a client, text frames are JSON, binary frames see framing.py."""
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000))
+        if message.get("bytes") is not None:
+            return decode_frame(message["bytes"])
+        return json.loads(message["text"])
+
+    async def send_to(self, websocket: WebSocket, message: dict):
+        """Binary frame if the client negotiated it and there is ciphertext, else JSON."""
+        if websocket.state.binary and has_bytes(message):
+            await websocket.send_bytes(encode_frame(message))
+        else:
+            await websocket.send_json(to_json(message))
+
     async def send_message(self, message: dict, user: User) -> bool:
+        """Sends to a connected user, False if the user is offline or the send failed."""
+        return await self.send(user.id, message)
+
+    async def send(self, user_id: int, message: dict) -> bool:
+        """Queues a message for a connected user, False if the user is offline.
+
+        A full queue is handled by the policy: "drop" discards the message,
+        "disconnect" closes the websocket and "spill" stores the message as a
+        pending delivery. Spilled and disconnected messages reach the client
+        as pending_messages, so both count as handled.
+        """
+        connection = self.connections.get(user_id)
+        if connection is None:
+            ws_logger.debug("User with id: %s is not connected", user_id)
+            return False
+        # only chat messages have an id and can wait as pending deliveries
+        if connection.spilled and "id" in message:
+            await connection.spill(message)
+            return True
+        try:
+            connection.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            pass
+
+        metrics.send_overflows.inc(self.policy)
+        ws_logger.warning("Send queue of user %s is full, policy %s", user_id, self.policy)
+        if self.policy == "disconnect":
+            self.forget(connection)
+            await self.spill(user_id, message)
+            task = asyncio.create_task(self._close_slow(connection))
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+        elif self.policy == "spill":
+            await connection.spill(message)
+        return True
+
+    async def _close_slow(self, connection: Connection):
+        await connection.close()
         try:
-            if user.id in self.connections:
-                websocket = self.connections[user.id]
-                logger.info(f"Sending message to {user.username}: {message}")
-                await websocket.send_json(message)
-                return True
-
-            raise ValueError(
-                f"User {user.username} with id: {user.id} is not connected."
-            )
-        except Exception as e:
-            print(f"Error sending message to {user.username}: {e}")
-            raise e
+            # 1013: try again later
+            await connection.websocket.close(code=1013)
+        except Exception:
+            pass
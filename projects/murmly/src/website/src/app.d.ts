@@ -69,15 +69,26 @@ declare global {
 		message_number?: number;
 	}
 
+	export interface PresenceUser {
+		id: number;
+		username: string;
+	}
+
 	export interface WebSocketPayload {
-		type?: "delivery_status";
+		type?: "delivery_status" | "pending_messages" | "presence_snapshot" | "presence";
+		id?: number;
 		sender?: User | onlineUser;
 		recipient: User | onlineUser;
 		content?: string;
 		timestamp: string;
 		delivered?: boolean;
+		queued?: boolean;
 		error?: string;
 		is_new_chat?: boolean;
+		messages?: WebSocketPayload[];
+		users?: PresenceUser[];
+		online?: PresenceUser[];
+		offline?: number[];
 	}
 
 	export interface WebSocketMessage {
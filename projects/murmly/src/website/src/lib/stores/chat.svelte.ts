@@ -125,7 +125,8 @@ function createChatStore() {
     state.isFetchingOnlineUsers = true;
     try {
       const users = await getOnlineUsers(token);
-      state.onlineUsers = users;
+      // the pushed presence is newer than the database
+      state.onlineUsers = withPresence(users);
     } catch (error) {
       console.error("Failed to fetch online users:", error);
       state.onlineUsers = [];
@@ -134,7 +135,34 @@ function createChatStore() {
     }
   }
 
+  // ids of online users pushed over the websocket, null until the first snapshot
+  let presenceOnline: Set<number> | null = null;
+
+  function withPresence(users: onlineUser[]): onlineUser[] {
+    if (!presenceOnline) return users;
+    return users.map((u) => {
+      const isOnline = presenceOnline!.has(u.id);
+      return isOnline === u.is_online ? u : { ...u, is_online: isOnline };
+    });
+  }
+
+  // a snapshot replaces the set of online users, a delta only touches the listed users
+  function applyPresence(online: PresenceUser[], offline: number[], snapshot: boolean) {
+    if (snapshot || !presenceOnline) presenceOnline = new Set();
+    for (const u of online) presenceOnline.add(u.id);
+    for (const id of offline) presenceOnline.delete(id);
+    const users = withPresence(state.onlineUsers);
+    const known = new Set(users.map((u) => u.id));
+    for (const u of online) {
+      if (!known.has(u.id) && u.id !== authStore.current.id) {
+        users.push({ id: u.id, username: u.username, is_online: true, last_seen: "", last_message: null as any });
+      }
+    }
+    state.onlineUsers = users;
+  }
+
   function reset() {
+    presenceOnline = null;
     state.onlineUsers = [];
     state.messagesByPeer = new Map();
     state.activeChatUser = null;
@@ -159,6 +187,7 @@ function createChatStore() {
 
     fetchChatHistory,
     fetchOnlineUsers,
+    applyPresence,
     setActiveChatUser,
     addMessage,
     reset,
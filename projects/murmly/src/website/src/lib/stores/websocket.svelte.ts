@@ -14,6 +14,64 @@ function createWebSocketStore() {
   const MAX_RECONNECT_ATTEMPTS = 5;
   const RECONNECT_DELAY = 3000;
 
+  async function handleChatPayload(payload: WebSocketPayload) {
+    if (!payload.sender || !payload.content) {
+      console.warn("Invalid message payload:", payload);
+      return;
+    }
+
+    // Ensure cryptography is initialized
+    if (!cryptoStore.currentDhParams || !cryptoStore.currentUserPubKey) {
+      const initialized = await cryptoStore.initializeCryptography(authStore.current.token!);
+      if (!initialized) {
+        console.error("Failed to initialize cryptography");
+        return;
+      }
+    }
+
+    // Initialize chat with sender if it's a new chat
+    if (payload.is_new_chat) {
+      const channelReady = await cryptoStore.ensureSecureChannel(authStore.current.token!, payload.sender.id);
+      if (!channelReady) {
+        console.error("Failed to establish secure channel for new chat");
+        return;
+      }
+    }
+
+    // Try to decrypt the message
+    const decryptedContent = await cryptoStore.decryptWSMessage(payload.sender.id, payload.content);
+    if (decryptedContent === null || decryptedContent.startsWith("[Decryption Failed")) {
+      console.error("Decryption failed for message:", payload);
+      return;
+    }
+
+    // Add the message to the chat store
+    const newMessage: Message = {
+      id: `${payload.timestamp}-${payload.sender.id}-${Math.random().toString(36).substring(2, 7)}`,
+      sender: payload.sender,
+      recipient: {
+        id: authStore.current.id!,
+        username: authStore.current.username!,
+        public_key_b64: '',
+        is_online: true,
+        isAuthenticated: true,
+        token: authStore.current.token!
+      },
+      content: decryptedContent,
+      timestamp: payload.timestamp,
+      isMine: false,
+      type: payload.is_new_chat ? 'incoming' : 'status',
+    };
+    chatStore.addMessage(newMessage);
+
+    // Play notification sound for new messages
+    if (payload.is_new_chat && payload.sender.id !== chatStore.current.activeChatUser?.id) {
+      const audio = new Audio('/notification.mp3');
+      alertStore.setAlert(`New message from ${payload.sender.username}`, "info");
+      audio.play().catch(e => console.error('Could not play notification sound:', e));
+    }
+  }
+
   function connect() {
     const token = authStore.current.token;
     if (!token) {
@@ -30,67 +88,40 @@ function createWebSocketStore() {
     newSocket.onopen = () => {
       socket = newSocket;
       reconnectAttempts = 0;
+      // snapshot of online users, then pushed changes instead of polling
+      newSocket.send(JSON.stringify({ type: "presence_subscribe" }));
     };
 
     newSocket.onmessage = async (event: MessageEvent) => {
       try {
         const payload: WebSocketPayload = JSON.parse(event.data as string);
 
-        if (!payload.sender || !payload.content) {
-          console.warn("Invalid message payload:", payload);
+        if (payload.type === "delivery_status") {
           return;
         }
 
-        // Ensure cryptography is initialized
-        if (!cryptoStore.currentDhParams || !cryptoStore.currentUserPubKey) {
-          const initialized = await cryptoStore.initializeCryptography(authStore.current.token!);
-          if (!initialized) {
-            console.error("Failed to initialize cryptography");
-            return;
-          }
+        if (payload.type === "presence_snapshot" || payload.type === "presence") {
+          chatStore.applyPresence(
+            payload.users ?? payload.online ?? [],
+            payload.offline ?? [],
+            payload.type === "presence_snapshot",
+          );
+          return;
         }
 
-        // Initialize chat with sender if it's a new chat
-        if (payload.is_new_chat) {
-          const channelReady = await cryptoStore.ensureSecureChannel(authStore.current.token!, payload.sender.id);
-          if (!channelReady) {
-            console.error("Failed to establish secure channel for new chat");
-            return;
+        // messages that arrived while we were offline, stay queued until acknowledged
+        if (payload.type === "pending_messages") {
+          for (const pending of payload.messages ?? []) {
+            await handleChatPayload(pending);
           }
-        }
-
-        // Try to decrypt the message
-        const decryptedContent = await cryptoStore.decryptWSMessage(payload.sender.id, payload.content);
-        if (decryptedContent === null || decryptedContent.startsWith("[Decryption Failed")) {
-          console.error("Decryption failed for message:", payload);
+          newSocket.send(JSON.stringify({
+            type: "ack",
+            message_ids: (payload.messages ?? []).map((m) => m.id),
+          }));
           return;
         }
 
-        // Add the message to the chat store
-        const newMessage: Message = {
-          id: `${payload.timestamp}-${payload.sender.id}-${Math.random().toString(36).substring(2, 7)}`,
-          sender: payload.sender,
-          recipient: {
-            id: authStore.current.id!,
-            username: authStore.current.username!,
-            public_key_b64: '',
-            is_online: true,
-            isAuthenticated: true,
-            token: authStore.current.token!
-          },
-          content: decryptedContent,
-          timestamp: payload.timestamp,
-          isMine: false,
-          type: payload.is_new_chat ? 'incoming' : 'status',
-        };
-        chatStore.addMessage(newMessage);
-
-        // Play notification sound for new messages
-        if (payload.is_new_chat && payload.sender.id !== chatStore.current.activeChatUser?.id) {
-          const audio = new Audio('/notification.mp3');
-          alertStore.setAlert(`New message from ${payload.sender.username}`, "info");
-          audio.play().catch(e => console.error('Could not play notification sound:', e));
-        }
+        await handleChatPayload(payload);
       } catch (e: any) {
         console.error("Error processing WebSocket message:", e, event.data);
         errorStore.setError(`WebSocket message processing error: ${e.message}`, "WebSocket Error");
@@ -0,0 +1,92 @@
+import os
+import sys
+import uuid
+import asyncio
+import tempfile
+from types import SimpleNamespace
+
+import pytest
+
+# the modules in src import each other as top level modules, like `uvicorn server:app` in src
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+# server.py and logger.py create murmly.db and murmly.log in the working directory
+os.chdir(tempfile.mkdtemp(prefix="murmly-tests-"))
+
+from passlib.context import CryptContext  # noqa: E402
+
+import db_utils  # noqa: E402
+import crypto_utils  # noqa: E402
+
+# the minimum bcrypt cost, registering and logging in test users is otherwise most of the run time
+db_utils.pwd_context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=4)
+
+
+@pytest.fixture(scope="session")
+def client():
+    """TestClient of the app, one server (and murmly.db) for the whole run."""
+    from fastapi.testclient import TestClient
+    import server
+
+    with TestClient(server.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def make_user(client):
+    """Registers and logs in a user with a unique name."""
+
+    def make(password: str = "pw"):
+        username = f"u{uuid.uuid4().hex[:12]}"
+        assert client.post("/register", json={"username": username, "password": password}).status_code == 200
+        response = client.post("/token", data={"username": username, "password": password})
+        token = response.json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        user_id = client.get("/users/me", headers=headers).json()["id"]
+        return SimpleNamespace(id=user_id, username=username, token=token, headers=headers)
+
+    return make
+
+
+@pytest.fixture
+def db_url(tmp_path):
+    return f"sqlite+aiosqlite:///{tmp_path / 'test.db'}"
+
+
+@pytest.fixture
+def with_db(db_url):
+    """Runs `fn(db)` on a fresh, initialized Database in its own event loop."""
+
+    def run(fn, url=None, **kwargs):
+        async def main():
+            db = db_utils.Database(url or db_url, **kwargs)
+            await db.init_db()
+            try:
+                return await fn(db)
+            finally:
+                await db.close()
+
+        return asyncio.run(main())
+
+    return run
+
+
+@pytest.fixture(scope="session")
+def dh_parameters(client):
+    return crypto_utils.deserialize_parameters(client.get("/dh_params").json()["params"].encode())
+
+
+@pytest.fixture
+def chat_client(client, monkeypatch, dh_parameters):
+    """Logged in ChatClient (client.py) whose HTTP requests go to the test app."""
+    import client as client_module
+
+    monkeypatch.setattr(client_module.requests, "get", client.get)
+
+    def make(user):
+        chat = client_module.ChatClient("http://testserver")
+        chat.auth_token, chat.token_type, chat.user_id = user.token, "Bearer", user.id
+        chat.dh_parameters = dh_parameters
+        chat.priv_key, chat.pub_key = crypto_utils.generate_pair(dh_parameters)
+        return chat
+
+    return make
@@ -0,0 +1,111 @@
+import time
+from datetime import timedelta
+
+import cache
+from cache import TTLCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, "monotonic", clock)
+    c = TTLCache(maxsize=10, ttl=5)
+    c.set("a", 1)
+    c.set("b", 2, ttl=1)
+    c.set("c", 3, ttl=60)  # cannot extend the default TTL
+    clock.now += 2
+    assert c.get("a") == 1 and c.get("b") is None
+    clock.now += 4
+    assert c.get("a") is None and c.get("c") is None
+    assert c.stats()["hits"] == 1 and c.stats()["misses"] == 3
+
+
+def test_least_recently_used_is_evicted():
+    c = TTLCache(maxsize=2, ttl=60)
+    c.set("a", 1)
+    c.set("b", 2)
+    c.get("a")
+    c.set("c", 3)
+    assert c.get("b") is None
+    assert c.get("a") == 1 and c.get("c") == 3
+    assert c.stats()["evictions"] == 1
+
+
+def test_token_is_not_cached_beyond_its_expiry(client):
+    import server
+
+    token = server.create_access_token({"sub": "someone"}, expires_delta=timedelta(seconds=30))
+    assert server.get_username_from_token(token) == "someone"
+    _, expires_at = server.token_cache._data[token]
+    assert expires_at - time.monotonic() <= 30
+
+
+def test_user_cache_sees_public_key_updates(client, make_user):
+    import server
+
+    user = make_user()
+    client.put("/update_public_key", json={"public_key": "first"}, headers=user.headers)
+    # loads the user into the cache
+    assert client.portal.call(server.db.get_user_by_username, user.username).public_key_b64 == "first"
+    client.put("/update_public_key", json={"public_key": "second"}, headers=user.headers)
+    assert client.portal.call(server.db.get_user_by_username, user.username).public_key_b64 == "second"
+    assert client.portal.call(server.db.get_user_by_id, user.id).public_key_b64 == "second"
+
+
+def test_fill_from_before_an_invalidation_is_skipped():
+    c = TTLCache(maxsize=2, ttl=60)
+    generation = c.generation()
+    c.invalidate("a")  # the row changed while it was read
+    c.set("a", "old", generation=generation)
+    c.set("b", "fresh", generation=generation)
+    assert c.get("a") is None and c.get("b") == "fresh"
+    c.set("a", "new", generation=c.generation())
+    assert c.get("a") == "new"
+
+    # once "a" is forgotten, fills that old are skipped for every key
+    generation = c.generation()
+    for key in ("a", "x", "y"):
+        c.invalidate(key)
+    c.set("a", "old", generation=generation)
+    c.set("z", "maybe old", generation=generation)
+    assert c.get("a") is None and c.get("z") is None
+
+
+def test_key_read_during_an_update_is_not_cached():
+    import asyncio
+    from types import SimpleNamespace
+
+    from key_directory import KeyDirectory
+
+    class SlowDatabase:
+        def __init__(self):
+            self.key = "old"
+            self.read = asyncio.Event()
+            self.updated = asyncio.Event()
+
+        async def get_public_keys(self, user_ids):
+            rows = [SimpleNamespace(id=1, username="u", public_key_b64=self.key)]
+            self.read.set()
+            await self.updated.wait()
+            return rows
+
+    async def main():
+        db = SlowDatabase()
+        directory = KeyDirectory(db)
+        reader = asyncio.create_task(directory.get(1))
+        await db.read.wait()
+        # the update commits and invalidates while the old row is in flight
+        db.key = "new"
+        directory.invalidate(1)
+        db.updated.set()
+        assert (await reader)[1] == "old"
+        assert (await directory.get(1))[1] == "new"
+
+    asyncio.run(main())
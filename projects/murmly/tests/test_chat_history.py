@@ -0,0 +1,53 @@
+import json
+
+
+def _send(client, sender, recipient, texts):
+    with client.websocket_connect(f"/ws/{sender.token}") as ws:
+        for text in texts:
+            ws.send_json({"recipient": {"id": recipient.id, "username": recipient.username}, "content": text})
+            # pending messages to the sender may arrive first
+            while ws.receive_json().get("type") != "delivery_status":
+                pass
+
+
+def test_pages_go_backwards_from_the_newest_message(client, make_user):
+    me, peer = make_user(), make_user()
+    _send(client, me, peer, [f"m{i}" for i in range(5)])
+
+    response = client.get(f"/users/{peer.id}/chat", params={"limit": 2}, headers=me.headers)
+    assert [m["content"] for m in response.json()] == ["m3", "m4"]
+    cursor = response.headers["X-Next-Cursor"]
+    assert cursor == str(response.json()[0]["id"])
+
+    response = client.get(f"/users/{peer.id}/chat", params={"limit": 2, "before_id": cursor}, headers=me.headers)
+    assert [m["content"] for m in response.json()] == ["m1", "m2"]
+    response = client.get(
+        f"/users/{peer.id}/chat", params={"limit": 2, "before_id": response.headers["X-Next-Cursor"]},
+        headers=me.headers,
+    )
+    assert [m["content"] for m in response.json()] == ["m0"]
+    assert "X-Next-Cursor" not in response.headers
+
+    # the peer sees the same conversation
+    messages = client.get(f"/users/{me.id}/chat", headers=peer.headers).json()
+    assert [m["content"] for m in messages] == [f"m{i}" for i in range(5)]
+    assert not any(m["isMine"] for m in messages)
+    assert messages[0]["sender"] == {"id": me.id, "username": me.username}
+
+
+def test_export_streams_the_whole_history(client, make_user):
+    me, peer = make_user(), make_user()
+    _send(client, me, peer, ["a", "b"])
+    _send(client, peer, me, ["c"])
+
+    response = client.get(f"/users/{peer.id}/chat/export", headers=me.headers)
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [(m["content"], m["isMine"]) for m in lines] == [("a", True), ("b", True), ("c", False)]
+    assert lines == client.get(f"/users/{peer.id}/chat", headers=me.headers).json()
+
+
+def test_unknown_peer_is_not_found(client, make_user):
+    me = make_user()
+    assert client.get("/users/999999/chat", headers=me.headers).status_code == 404
+    assert client.get("/users/999999/chat/export", headers=me.headers).status_code == 404
@@ -0,0 +1,39 @@
+import json
+
+
+def test_directory_knows_offline_users(client, chat_client, make_user):
+    me, offline = make_user(), make_user()
+    client.post("/logout", headers=offline.headers)
+    chat = chat_client(me)
+    chat.get_online_users()
+    assert chat.lookup_user(offline.username) == offline.id
+    assert offline.id not in chat.online
+
+
+def test_users_registered_later_are_looked_up(chat_client, make_user):
+    chat = chat_client(make_user())
+    chat.get_online_users()
+    newcomer = make_user()
+    assert chat.lookup_user(newcomer.username) == newcomer.id
+    assert chat.lookup_user("nobody-has-this-name") is None
+
+
+def test_presence_events_update_online_flags_only(chat_client, make_user):
+    me, alice, bob = make_user(), make_user(), make_user()
+    chat = chat_client(me)
+    chat.get_online_users()
+
+    chat.on_message(None, json.dumps({
+        "type": "presence_snapshot",
+        "users": [{"id": alice.id, "username": alice.username}],
+    }))
+    assert chat.online == {alice.id}
+
+    chat.on_message(None, json.dumps({
+        "type": "presence",
+        "online": [{"id": bob.id, "username": bob.username}],
+        "offline": [alice.id],
+    }))
+    assert chat.online == {bob.id}
+    # going offline keeps the user in the directory
+    assert chat.lookup_user(alice.username) == alice.id
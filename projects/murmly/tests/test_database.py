@@ -0,0 +1,40 @@
+import pytest
+from sqlalchemy import select, text
+
+from db_utils import Database
+from models import User
+
+
+@pytest.mark.parametrize("dirname", ["with#hash", "with%20escape", "with space"])
+def test_read_engine_opens_paths_that_need_escaping(tmp_path, with_db, dirname):
+    path = tmp_path / dirname / "murmly.db"
+    path.parent.mkdir()
+
+    async def check(db):
+        await db.create_user("alice", "pw")
+        async with db.read_session_factory() as session:
+            names = (await session.execute(select(User.username))).scalars().all()
+            assert names == ["alice"]
+            # the read pool opened the same file read only
+            with pytest.raises(Exception, match="readonly"):
+                await session.execute(text("DELETE FROM users"))
+
+    with_db(check, url=f"sqlite+aiosqlite:///{path}")
+    assert path.exists()
+
+
+def test_writer_uses_wal(with_db):
+    async def check(db):
+        async with db.engine.connect() as conn:
+            mode = (await conn.execute(text("PRAGMA journal_mode"))).scalar()
+        assert mode.lower() == "wal"
+        assert db.read_engine is not db.engine
+
+    with_db(check)
+
+
+def test_memory_database_shares_one_engine(with_db):
+    async def check(db):
+        assert db.read_engine is db.engine
+
+    with_db(check, url="sqlite+aiosqlite:///:memory:")
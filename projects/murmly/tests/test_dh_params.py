@@ -0,0 +1,69 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from cryptography.hazmat.primitives.asymmetric import dh
+
+import crypto_utils
+import dh_params
+from dh_params import DHParamsManager, FFDHE_PRIMES, ffdhe_parameters, rfc7919_prime
+
+
+@pytest.mark.parametrize("name", sorted(FFDHE_PRIMES))
+def test_builtin_primes_match_rfc7919(name):
+    assert FFDHE_PRIMES[name] == rfc7919_prime(name)
+
+
+def _prime(manager):
+    return manager.params.parameter_numbers().p
+
+
+def test_generated_parameters_are_served_after_a_restart(tmp_path, monkeypatch):
+    cache_file = str(tmp_path / "dh_params.pem")
+    # a known safe prime group instead of minutes of generation
+    pem = crypto_utils.serialize_parameters(ffdhe_parameters("ffdhe3072"))
+    monkeypatch.setattr(dh_params, "_generate_pem", lambda bits: pem)
+
+    manager = DHParamsManager(group="generated", cache_file=cache_file)
+    manager.load()
+    assert _prime(manager) == FFDHE_PRIMES["ffdhe2048"]
+    served = manager.pem_response
+
+    async def generate():
+        manager._pool = ThreadPoolExecutor(max_workers=1)
+        assert manager._needs_generation()
+        await manager._generate()
+        assert not manager._needs_generation()
+        await manager.stop()
+
+    asyncio.run(generate())
+    # clients of this process keep the group they fetched
+    assert manager.pem_response is served
+    assert _prime(manager) == FFDHE_PRIMES["ffdhe2048"]
+
+    restarted = DHParamsManager(group="generated", cache_file=cache_file)
+    restarted.load()
+    assert _prime(restarted) == FFDHE_PRIMES["ffdhe3072"]
+    assert restarted.pem_response.etag != served.etag
+
+
+def test_cached_parameters_that_are_not_a_safe_prime_are_ignored(tmp_path):
+    cache_file = tmp_path / "dh_params.pem"
+    # odd, but not a safe prime
+    params = dh.DHParameterNumbers(FFDHE_PRIMES["ffdhe2048"] + 2**65, 2).parameters()
+    cache_file.write_bytes(crypto_utils.serialize_parameters(params))
+    manager = DHParamsManager(group="generated", cache_file=str(cache_file))
+    manager.load()
+    assert _prime(manager) == FFDHE_PRIMES["ffdhe2048"]
+
+
+@pytest.mark.parametrize("path", ["/dh_params", "/dh_params_js"])
+def test_endpoints_are_revalidated_with_the_etag(client, path):
+    response = client.get(path)
+    assert response.headers["Cache-Control"] == "no-cache"
+    etag = response.headers["ETag"]
+    assert etag.startswith('"')  # strong
+    cached = client.get(path, headers={"If-None-Match": etag})
+    assert cached.status_code == 304 and cached.content == b""
+    assert cached.headers["ETag"] == etag
+    assert client.get(path, headers={"If-None-Match": '"other"'}).json() == response.json()
@@ -0,0 +1,206 @@
+import sys
+import types
+import asyncio
+from collections import defaultdict
+
+import pytest
+
+from fanout import InProcessFanout, RedisFanout
+
+
+class FakeBroker:
+    """In-memory pub/sub with the PUBLISH semantics of redis."""
+
+    def __init__(self):
+        self.channels = defaultdict(set)
+
+
+class FakePubSub:
+    def __init__(self, broker):
+        self.broker = broker
+        self.queue = asyncio.Queue()
+
+    async def subscribe(self, *channels):
+        for channel in channels:
+            self.broker.channels[channel].add(self)
+
+    async def unsubscribe(self, *channels):
+        for channel in channels:
+            self.broker.channels[channel].discard(self)
+
+    async def listen(self):
+        while True:
+            yield await self.queue.get()
+
+    async def aclose(self):
+        for subscribers in self.broker.channels.values():
+            subscribers.discard(self)
+
+
+class FakeRedis:
+    def __init__(self, broker):
+        self.broker = broker
+
+    def pubsub(self):
+        return FakePubSub(self.broker)
+
+    async def publish(self, channel, data):
+        subscribers = self.broker.channels[channel]
+        for pubsub in subscribers:
+            pubsub.queue.put_nowait({"type": "message", "channel": channel.encode(), "data": data.encode()})
+        return len(subscribers)
+
+    async def pubsub_numsub(self, *channels):
+        return [(channel.encode(), len(self.broker.channels[channel])) for channel in channels]
+
+    async def aclose(self):
+        pass
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    broker = FakeBroker()
+    module = types.ModuleType("redis.asyncio")
+    module.from_url = lambda url: FakeRedis(broker)
+    package = types.ModuleType("redis")
+    package.asyncio = module
+    monkeypatch.setitem(sys.modules, "redis", package)
+    monkeypatch.setitem(sys.modules, "redis.asyncio", module)
+    return broker
+
+
+class Worker:
+    def __init__(self):
+        self.fanout = RedisFanout("redis://fake")
+        self.delivered, self.events = [], []
+
+    async def deliver(self, user_id, message):
+        self.delivered.append((user_id, message))
+        return True
+
+    async def start(self):
+        await self.fanout.start(self.deliver, self.events.append)
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_messages_reach_the_worker_of_the_recipient(fake_redis):
+    async def main():
+        a, b = Worker(), Worker()
+        await a.start()
+        await b.start()
+        await a.fanout.subscribe(1)
+
+        assert await b.fanout.publish(1, {"content": b"\x00\x01"}) is True
+        assert await b.fanout.publish(2, {"content": "x"}) is False
+        await _settle()
+        # bytes travel as base64, like over a JSON websocket
+        assert a.delivered == [(1, {"content": "AAE="})]
+        assert b.delivered == []
+
+        # local recipients skip redis
+        assert await a.fanout.publish(1, {"content": "y"}) is True
+        assert a.delivered[-1] == (1, {"content": "y"})
+
+        await a.fanout.unsubscribe(1)
+        assert await b.fanout.publish(1, {"content": "z"}) is False
+        await a.fanout.stop()
+        await b.fanout.stop()
+
+    asyncio.run(main())
+
+
+def test_messages_the_receiving_worker_cannot_deliver_are_queued(fake_redis):
+    async def main():
+        a, b = Worker(), Worker()
+        queued = []
+
+        async def gone(user_id, message):
+            return False  # e.g. the websocket closed, the channel is still subscribed
+
+        async def enqueue(user_id, message):
+            queued.append((user_id, message["id"]))
+
+        await a.fanout.start(gone, a.events.append, enqueue)
+        await b.start()
+        await a.fanout.subscribe(1)
+
+        assert await b.fanout.publish(1, {"id": 7, "content": "x"}) is True
+        assert await b.fanout.publish(1, {"type": "presence", "online": []}) is True
+        await _settle()
+        # only chat messages can wait as pending deliveries
+        assert queued == [(1, 7)]
+        await a.fanout.stop()
+        await b.fanout.stop()
+
+    asyncio.run(main())
+
+
+def test_broadcast_reaches_the_other_workers_in_order(fake_redis):
+    async def main():
+        a, b, c = Worker(), Worker(), Worker()
+        for worker in (a, b, c):
+            await worker.start()
+        a.fanout.broadcast({"type": "presence", "user_id": 1, "online": True})
+        a.fanout.broadcast({"type": "presence", "user_id": 1, "online": False})
+        await _settle()
+        expected = [
+            {"type": "presence", "user_id": 1, "online": True},
+            {"type": "presence", "user_id": 1, "online": False},
+        ]
+        assert b.events == c.events == expected
+        assert a.events == []
+        for worker in (a, b, c):
+            await worker.fanout.stop()
+
+    asyncio.run(main())
+
+
+def test_websockets_on_other_workers_are_found(fake_redis):
+    async def main():
+        a, b = Worker(), Worker()
+        await a.start()
+        await b.start()
+        await a.fanout.subscribe(1)
+        await a.fanout.subscribe(2)
+        await b.fanout.subscribe(2)
+        # a does not count its own subscriptions
+        assert await a.fanout.connected_elsewhere([1, 2, 3]) == {2}
+        assert await b.fanout.connected_elsewhere([1, 2, 3]) == {1, 2}
+        assert await a.fanout.connected_elsewhere([]) == set()
+        await a.fanout.stop()
+        await b.fanout.stop()
+
+    asyncio.run(main())
+
+
+def test_in_process_fanout_has_no_other_workers():
+    async def main():
+        fanout, delivered = InProcessFanout(), []
+
+        async def deliver(user_id, message):
+            delivered.append(user_id)
+            return True
+
+        await fanout.start(deliver)
+        fanout.broadcast({"type": "presence", "user_id": 1, "online": True})
+        assert await fanout.publish(1, {}) is False
+        await fanout.subscribe(1)
+        assert await fanout.publish(1, {}) is True
+        assert delivered == [1]
+        assert await fanout.connected_elsewhere([1, 2]) == set()
+
+    asyncio.run(main())
+
+
+def test_key_change_of_another_worker_drops_the_cached_key(client, make_user):
+    import server
+
+    user = make_user()
+    server.key_directory.cache.set(user.id, (user.username, "old", "v1"))
+    server.worker_event({"type": "key_changed", "user_id": user.id, "username": user.username})
+    assert server.key_directory.cache.get(user.id) is None
+    assert server.db.users_by_id.get(user.id) is None
@@ -0,0 +1,72 @@
+import json
+import struct
+
+import pytest
+
+from framing import decode_frame, encode_frame, json_content, parse_content, to_json
+
+
+def test_single_message_round_trip():
+    message = {"id": 1, "content": b"\x00\xffcipher", "message_number": 3}
+    frame = encode_frame(message)
+    assert b"content_length" in frame and b"\x00\xffcipher" in frame
+    assert decode_frame(frame) == message
+
+
+def test_batch_round_trip_with_text_and_bytes():
+    batch = {
+        "type": "pending_messages",
+        "messages": [{"id": 1, "content": b"a"}, {"id": 2, "content": "old base64 text"}, {"id": 3, "content": b""}],
+        "more": False,
+    }
+    assert decode_frame(encode_frame(batch)) == batch
+    assert to_json(batch)["messages"][0]["content"] == "YQ=="
+
+
+@pytest.mark.parametrize("text", ["AAE=", "aGVsbG8=", "YWJj"])
+def test_canonical_base64_becomes_bytes(text):
+    content = parse_content(text)
+    assert isinstance(content, bytes)
+    assert json_content(content) == text
+
+
+@pytest.mark.parametrize("text", ["", None, "hello world", "QQ", "QR==", "YW Jj", "not base64!"])
+def test_other_content_stays_text(text):
+    assert parse_content(text) == text
+
+
+def _frame(header: dict, payload: bytes = b"") -> bytes:
+    header_bytes = json.dumps(header).encode()
+    return struct.pack(">I", len(header_bytes)) + header_bytes + payload
+
+
+@pytest.mark.parametrize(
+    "frame",
+    [
+        b"\x00\x00",
+        struct.pack(">I", 100) + b"{}",
+        _frame({"content_length": -1}, b"x"),
+        _frame({"content_length": "1"}, b"x"),
+        _frame({"content_length": 1.0}, b"x"),
+        _frame({"content_length": True}, b"x"),
+        _frame({"content_length": 2}, b"x"),
+        _frame({"content_length": 1}, b"xy"),
+        _frame({"id": 1}, b"trailing"),
+        _frame([1, 2]),
+        _frame({"messages": [1]}),
+    ],
+)
+def test_malformed_frames_are_rejected(frame):
+    with pytest.raises(ValueError):
+        decode_frame(frame)
+
+
+def test_frames_with_an_unknown_type_are_not_stored(client, make_user):
+    alice, bob = make_user(), make_user()
+    with client.websocket_connect(f"/ws/{alice.token}") as ws:
+        ws.send_json({"type": "typing", "recipient": {"id": bob.id, "username": bob.username}, "content": "AAE="})
+        assert "Unknown message type" in ws.receive_json()["error"]
+        ws.send_json({"recipient": {"id": bob.id, "username": bob.username}, "content": "QQ"})
+        assert ws.receive_json()["type"] == "delivery_status"
+    messages = client.get(f"/users/{bob.id}/chat", headers=alice.headers).json()
+    assert [m["content"] for m in messages] == ["QQ"]
@@ -0,0 +1,85 @@
+import time
+import asyncio
+import threading
+
+import pytest
+
+from hasher import PasswordHasher, HasherBusy
+
+
+def test_counts_completed_and_failed_hashes():
+    hasher = PasswordHasher(workers=2, max_queue=4)
+
+    def fail():
+        raise ValueError("bad hash")
+
+    async def main():
+        assert await hasher.run(lambda a, b: a + b, 1, 2) == 3
+        with pytest.raises(ValueError, match="bad hash"):
+            await hasher.run(fail)
+
+    asyncio.run(main())
+    stats = hasher.stats()
+    assert (stats["completed"], stats["failed"], stats["in_flight"]) == (1, 1, 0)
+    hasher.shutdown()
+
+
+def test_rejects_beyond_the_queue_limit():
+    hasher = PasswordHasher(workers=1, max_queue=1)
+    release = threading.Event()
+
+    async def main():
+        running = [asyncio.ensure_future(hasher.run(release.wait)) for _ in range(2)]
+        await asyncio.sleep(0)
+        assert hasher.in_flight == 2 and hasher.queued == 1
+        with pytest.raises(HasherBusy):
+            await hasher.run(release.wait)
+        release.set()
+        await asyncio.gather(*running)
+
+    asyncio.run(main())
+    stats = hasher.stats()
+    assert (stats["completed"], stats["rejected"], stats["peak_queue"]) == (2, 1, 1)
+    assert stats["in_flight"] == 0
+    hasher.shutdown()
+
+
+def test_stats_stay_consistent_under_concurrent_hashes():
+    hasher = PasswordHasher(workers=8, max_queue=1000)
+
+    async def main():
+        await asyncio.gather(*(hasher.run(time.sleep, 0.001) for _ in range(500)))
+
+    asyncio.run(main())
+    stats = hasher.stats()
+    assert stats["completed"] == 500 and stats["in_flight"] == 0
+    assert stats["avg_run_ms"] >= 1
+    hasher.shutdown()
+
+
+def test_cancelled_callers_keep_their_running_hash_counted():
+    hasher = PasswordHasher(workers=1, max_queue=0)
+    release, started = threading.Event(), threading.Event()
+
+    def hash_slowly():
+        started.set()
+        release.wait()
+
+    async def main():
+        caller = asyncio.ensure_future(hasher.run(hash_slowly))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait)
+        caller.cancel()  # the client disconnected, bcrypt keeps running
+        await asyncio.sleep(0.01)
+        assert hasher.in_flight == 1
+        with pytest.raises(HasherBusy):
+            await asyncio.wait_for(hasher.run(hash_slowly), 1)
+        release.set()
+        while hasher.in_flight:
+            await asyncio.sleep(0.01)
+
+    try:
+        asyncio.run(main())
+    finally:
+        release.set()
+    assert hasher.stats()["rejected"] == 1
+    hasher.shutdown()
@@ -0,0 +1,55 @@
+import json
+import base64
+import asyncio
+
+import pytest
+
+import crypto_utils
+from loadtest import SimUser, Stats, pair_users
+
+
+def _users(n, stats=None):
+    users = [SimUser(i, "t", None, "ws://test", stats or Stats()) for i in range(n)]
+    for i, user in enumerate(users):
+        user.id = 100 + i
+    return users
+
+
+@pytest.mark.parametrize("n", [2, 3, 4, 5, 8])
+def test_every_sender_is_known_to_its_receiver(n):
+    users = _users(n)
+    pair_users(users)
+    for user in users:
+        assert user.peer is not user
+        assert user.peer.senders[user.id] is user
+    assert sum(len(user.senders) for user in users) == n
+
+
+class FakeSocket:
+    def __init__(self, frames):
+        self.frames = frames
+
+    async def __aiter__(self):
+        for frame in self.frames:
+            yield frame
+
+
+def test_messages_from_both_senders_of_user_zero_count_as_delivered():
+    stats = Stats()
+    users = _users(3, stats)
+    pair_users(users)
+    receiver = users[0]
+    assert set(receiver.senders) == {users[1].id, users[2].id}
+
+    frames = []
+    for sender in receiver.senders.values():
+        key = receiver.keys[sender.id] = b"k" * 32
+        sender.sent_at[1] = 0.0
+        frames.append(json.dumps({
+            "sender": {"id": sender.id},
+            "content": base64.b64encode(crypto_utils.encrypt(key, "message 1")).decode(),
+            "message_number": 1,
+        }))
+    receiver.ws = FakeSocket(frames)
+    asyncio.run(receiver.receive())
+    assert stats.delivered == 2 and stats.errors == {}
@@ -0,0 +1,67 @@
+import sys
+import json
+import atexit
+import logging
+
+import logger as logger_module
+from logger import JsonFormatter, SampleFilter, RateLimitFilter, setup_logging
+
+
+def _record(msg="message %s", args=("x",), level=logging.INFO, **extra):
+    record = logging.makeLogRecord({"msg": msg, "args": args, "levelno": level, "name": "murmly"})
+    record.levelname = logging.getLevelName(level)
+    for key, value in extra.items():
+        setattr(record, key, value)
+    return record
+
+
+def test_json_lines_carry_extra_fields_and_exceptions():
+    try:
+        raise RuntimeError("boom")
+    except RuntimeError:
+        record = _record(message_id=7, exc_info=sys.exc_info())
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry["message"] == "message x"
+    assert entry["level"] == "INFO" and entry["logger"] == "murmly"
+    assert entry["message_id"] == 7
+    assert "RuntimeError: boom" in entry["exc"]
+
+
+def test_sampling_keeps_warnings(monkeypatch):
+    monkeypatch.setattr(logger_module.random, "random", lambda: 0.5)
+    assert SampleFilter(0.6).filter(_record())
+    assert not SampleFilter(0.4).filter(_record())
+    assert SampleFilter(0.0).filter(_record(level=logging.WARNING))
+
+
+def test_rate_limit_per_template_reports_dropped(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(logger_module.time, "monotonic", lambda: now[0])
+    limit = RateLimitFilter(per_second=2)
+
+    assert [limit.filter(_record()) for _ in range(5)] == [True, True, False, False, False]
+    # another template has its own budget
+    assert limit.filter(_record(msg="other %s"))
+
+    now[0] += 1
+    record = _record()
+    assert limit.filter(record)
+    assert record.dropped == 3
+    record = _record()
+    assert limit.filter(record) and not hasattr(record, "dropped")
+
+
+def test_records_are_written_by_the_listener_thread(tmp_path):
+    root = logging.getLogger()
+    handlers, level = root.handlers, root.level
+    log_file = tmp_path / "murmly.log"
+    listener = setup_logging("INFO", "json", str(log_file))
+    try:
+        logging.getLogger("murmly.test").info("hello %s", "world", extra={"user_id": 1})
+    finally:
+        listener.stop()
+        atexit.unregister(listener.stop)
+        root.handlers, root.level = handlers, level
+    (line,) = log_file.read_text().splitlines()
+    entry = json.loads(line)
+    assert entry["message"] == "hello world" and entry["user_id"] == 1
@@ -0,0 +1,84 @@
+import asyncio
+
+from sqlalchemy import event, func, select
+
+from models import Message, UserChat
+
+
+def count_commits(db) -> list:
+    commits = []
+    event.listen(db.engine.sync_engine, "commit", lambda conn: commits.append(1))
+    return commits
+
+
+async def _chats(db, user_id):
+    async with db.read_session_factory() as session:
+        rows = await session.execute(select(UserChat.peer_id, UserChat.last_message_id).where(UserChat.user_id == user_id))
+        return dict(rows.all())
+
+
+def test_store_message_is_one_transaction(with_db):
+    async def run(db):
+        a = await db.create_user("a", "pw")
+        b = await db.create_user("b", "pw")
+        commits = count_commits(db)
+        first = await db.store_message(a, b, "hi", 1)
+        second = await db.store_message(b, a, "hello", 1)
+        assert len(commits) == 2
+        # both users point at the newest message of the conversation
+        assert await _chats(db, a.id) == {b.id: second.id}
+        assert await _chats(db, b.id) == {a.id: second.id}
+        assert first.id < second.id
+
+    with_db(run)
+
+
+def test_group_commit_batches_concurrent_messages(with_db):
+    async def run(db):
+        a = await db.create_user("a", "pw")
+        b = await db.create_user("b", "pw")
+        db.start_writer(window_ms=20, max_messages=50)
+        commits = count_commits(db)
+        messages = await asyncio.gather(*(db.enqueue_message(a, b, f"m{i}", i) for i in range(120)))
+        await db.stop_writer()
+
+        assert len({m.id for m in messages}) == 120
+        # 120 messages, at most 50 per batch
+        assert 3 <= len(commits) < 10
+        async with db.read_session_factory() as session:
+            assert await session.scalar(select(func.count()).select_from(Message)) == 120
+        assert await _chats(db, b.id) == {a.id: max(m.id for m in messages)}
+
+    with_db(run)
+
+
+def test_stop_writer_flushes_queued_messages(with_db):
+    async def run(db):
+        a = await db.create_user("a", "pw")
+        db.start_writer(window_ms=1000)
+        pending = asyncio.ensure_future(db.enqueue_message(a, a, "note"))
+        await asyncio.sleep(0)
+        await db.stop_writer()
+        assert (await pending).id is not None
+
+    with_db(run)
+
+
+def test_failed_batch_fails_every_waiter(with_db):
+    async def run(db):
+        a = await db.create_user("a", "pw")
+        db.start_writer(window_ms=20)
+
+        async def broken(session, rows):
+            raise RuntimeError("disk full")
+
+        db._upsert_user_chats = broken
+        results = await asyncio.gather(
+            *(db.enqueue_message(a, a, f"m{i}") for i in range(5)), return_exceptions=True
+        )
+        await db.stop_writer()
+        assert all(isinstance(r, RuntimeError) for r in results)
+        async with db.read_session_factory() as session:
+            assert await session.scalar(select(func.count()).select_from(Message)) == 0
+
+    with_db(run)
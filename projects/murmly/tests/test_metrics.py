@@ -0,0 +1,73 @@
+import pytest
+
+import metrics
+from metrics import Counter, Gauge, Histogram
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """Metrics created by a test are rendered alone and dropped after it."""
+    monkeypatch.setattr(metrics, "_registry", [])
+    return metrics._registry
+
+
+def test_counters_and_gauges_render(registry):
+    plain = Counter("t_plain_total", "Plain")
+    labelled = Counter("t_labelled_total", "Labelled", ("policy",))
+    gauge = Gauge("t_gauge", "Set")
+    read = Gauge("t_read", "Read at scrape", lambda: 7)
+    per_user = Gauge("t_depth", "Labelled", lambda: {("1",): 3, ("2",): 0}, ("user",))
+
+    labelled.inc("drop")
+    labelled.inc("drop", amount=2)
+    gauge.inc(5)
+    gauge.dec()
+
+    text = metrics.render()
+    assert "# TYPE t_plain_total counter\nt_plain_total 0\n" in text
+    assert 't_labelled_total{policy="drop"} 3' in text
+    assert "# HELP t_gauge Set\n# TYPE t_gauge gauge\nt_gauge 4.0\n" in text
+    assert "t_read 7\n" in text
+    assert 't_depth{user="1"} 3\nt_depth{user="2"} 0\n' in text
+    assert [plain, labelled, gauge, read, per_user] == registry
+
+
+def test_counts_kept_elsewhere_are_counters(registry):
+    counts = {"rejected": 2}
+    Counter("t_rejected_total", "Read at scrape", fn=lambda: counts["rejected"])
+    counts["rejected"] += 1
+    assert "# TYPE t_rejected_total counter\nt_rejected_total 3\n" in metrics.render()
+
+
+def test_hasher_counts_are_exported_as_counters(client):
+    text = client.get("/metrics").text
+    assert "# TYPE murmly_hasher_rejected_total counter" in text
+    assert "# TYPE murmly_hasher_failed_total counter" in text
+
+
+def test_histogram_buckets_are_cumulative(registry):
+    latency = Histogram("t_seconds", "Latency", ("route",), buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        latency.observe(value, "home")
+    lines = list(latency.lines())
+    assert lines == [
+        't_seconds_bucket{route="home",le="0.1"} 2',
+        't_seconds_bucket{route="home",le="1"} 3',
+        't_seconds_bucket{route="home",le="+Inf"} 4',
+        't_seconds_sum{route="home"} 3.65',
+        't_seconds_count{route="home"} 4',
+    ]
+
+
+def test_requests_are_labelled_by_endpoint(client, make_user):
+    user = make_user()
+    client.get(f"/users/{user.id}/chat", headers=user.headers)
+    client.get("/no/such/path")
+
+    text = client.get("/metrics").text
+    assert 'murmly_http_request_duration_seconds_count{route="get_chat_history",method="GET"}' in text
+    assert 'murmly_http_request_duration_seconds_count{route="other",method="GET"}' in text
+    # no series per path parameter
+    assert f"/users/{user.id}" not in text
+    assert 'murmly_db_query_duration_seconds_count{engine="write"}' in text
+    assert "murmly_websocket_connections" in text
@@ -0,0 +1,89 @@
+import sqlite3
+
+from sqlalchemy import text
+
+from migrations import MIGRATIONS
+
+# the schema before migrations.py, as in db_bench.py
+OLD_SCHEMA = [
+    "CREATE TABLE messages (id INTEGER PRIMARY KEY, sender_id INTEGER, recipient_id INTEGER, "
+    "content TEXT, timestamp DATETIME, is_read BOOLEAN, message_number INTEGER)",
+    "CREATE TABLE user_chats (id INTEGER PRIMARY KEY, user_id INTEGER, peer_id INTEGER, "
+    "last_message_id INTEGER, last_interaction DATETIME)",
+]
+
+
+def _old_database(path):
+    conn = sqlite3.connect(path)
+    for stmt in OLD_SCHEMA:
+        conn.execute(stmt)
+    conn.executemany(
+        "INSERT INTO messages (sender_id, recipient_id, content, timestamp, is_read, message_number) "
+        "VALUES (?, ?, ?, '2024-01-01 00:00:00', 0, 0)",
+        [(1, 2, "a"), (2, 1, "b"), (3, 1, "c")],
+    )
+    # duplicate chat rows, allowed before migration 1
+    conn.executemany(
+        "INSERT INTO user_chats (user_id, peer_id, last_message_id) VALUES (?, ?, ?)",
+        [(1, 2, 1), (1, 2, 2), (2, 1, 2)],
+    )
+    conn.commit()
+    conn.close()
+
+
+def _indexes(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA index_list({table})")}
+
+
+def test_old_database_is_migrated_to_the_current_version(tmp_path, with_db):
+    path = tmp_path / "old.db"
+    _old_database(path)
+
+    async def check(db):
+        history = await db.get_chat_history(1, 2)
+        assert [row.content for row in history] == ["a", "b"]
+        assert [row.content for row in await db.get_chat_history(1, 3)] == ["c"]
+
+    with_db(check, url=f"sqlite+aiosqlite:///{path}")
+
+    conn = sqlite3.connect(path)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == MIGRATIONS[-1][0]
+    assert conn.execute("SELECT conversation_key FROM messages ORDER BY id").fetchall() == [
+        ("1:2",), ("1:2",), ("1:3",),
+    ]
+    # the newest row of each duplicated pair is kept
+    assert conn.execute(
+        "SELECT user_id, peer_id, last_message_id FROM user_chats ORDER BY user_id"
+    ).fetchall() == [(1, 2, 2), (2, 1, 2)]
+    assert "ix_user_chats_user_peer" in _indexes(conn, "user_chats")
+    indexes = _indexes(conn, "messages")
+    assert "ix_messages_conversation_id" in indexes
+    assert "ix_messages_conversation_time" not in indexes
+    assert "ciphertext" in {row[1] for row in conn.execute("PRAGMA table_info(messages)")}
+    conn.close()
+
+
+def test_migrations_run_once(tmp_path, with_db):
+    path = tmp_path / "old.db"
+    _old_database(path)
+    url = f"sqlite+aiosqlite:///{path}"
+
+    async def version(db):
+        async with db.engine.connect() as conn:
+            return (await conn.execute(text("PRAGMA user_version"))).scalar()
+
+    assert with_db(version, url=url) == MIGRATIONS[-1][0]
+    # a restart finds the database up to date
+    assert with_db(version, url=url) == MIGRATIONS[-1][0]
+
+
+def test_new_messages_get_a_conversation_key(with_db):
+    async def check(db):
+        alice = await db.create_user("alice", "pw")
+        bob = await db.create_user("bob", "pw")
+        await db.store_message(bob, alice, "hi")
+        await db.store_message(alice, bob, b"\x00raw")
+        rows = await db.get_chat_history(alice.id, bob.id)
+        assert [(row.content, row.ciphertext) for row in rows] == [("hi", None), (None, b"\x00raw")]
+
+    with_db(check)
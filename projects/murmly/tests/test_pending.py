@@ -0,0 +1,56 @@
+def _frames_until_status(ws, recipient, text="ping"):
+    """Sends a message and returns the frames that arrived before its delivery status."""
+    ws.send_json({"recipient": {"id": recipient.id, "username": recipient.username}, "content": text})
+    frames = []
+    while (frame := ws.receive_json()).get("type") != "delivery_status":
+        frames.append(frame)
+    return frames
+
+
+def test_offline_messages_are_redelivered_until_acked(client, make_user):
+    alice, bob, carol = make_user(), make_user(), make_user()
+    with client.websocket_connect(f"/ws/{alice.token}") as ws:
+        assert _frames_until_status(ws, bob, "one") == []
+        assert _frames_until_status(ws, bob, "two") == []
+
+    for _ in range(2):  # not acknowledged, sent again on the next connect
+        with client.websocket_connect(f"/ws/{bob.token}") as ws:
+            (frame,) = _frames_until_status(ws, carol)
+            assert frame["type"] == "pending_messages" and frame["more"] is False
+            assert [m["content"] for m in frame["messages"]] == ["one", "two"]
+            assert frame["messages"][0]["sender"] == {"id": alice.id, "username": alice.username}
+
+    with client.websocket_connect(f"/ws/{bob.token}") as ws:
+        (frame,) = _frames_until_status(ws, carol)
+        ws.send_json({"type": "ack", "message_ids": [frame["messages"][0]["id"]]})
+        _frames_until_status(ws, carol)
+
+    with client.websocket_connect(f"/ws/{bob.token}") as ws:
+        (frame,) = _frames_until_status(ws, carol)
+        assert [m["content"] for m in frame["messages"]] == ["two"]
+        ws.send_json({"type": "ack", "message_ids": [frame["messages"][0]["id"]]})
+        _frames_until_status(ws, carol)
+
+    with client.websocket_connect(f"/ws/{bob.token}") as ws:
+        assert _frames_until_status(ws, carol) == []
+
+
+def test_pending_deliveries_are_read_in_batches(with_db):
+    async def check(db):
+        alice = await db.create_user("alice", "pw")
+        bob = await db.create_user("bob", "pw")
+        for i in range(5):
+            message = await db.store_message(alice, bob, f"m{i}")
+            await db.enqueue_pending_delivery(bob.id, message.id)
+
+        first = await db.get_pending_deliveries(bob.id, limit=3)
+        rest = await db.get_pending_deliveries(bob.id, first[-1].pending_id, limit=3)
+        assert [row.content for row in first + rest] == [f"m{i}" for i in range(5)]
+        assert rest[0].sender_username == "alice"
+
+        assert await db.delete_pending_deliveries(bob.id, [row.id for row in first]) == 3
+        # another user cannot acknowledge bob's messages
+        assert await db.delete_pending_deliveries(alice.id, [row.id for row in rest]) == 0
+        assert [row.content for row in await db.get_pending_deliveries(bob.id)] == ["m3", "m4"]
+
+    with_db(check)
@@ -0,0 +1,109 @@
+from datetime import datetime, timedelta
+
+from presence import PresenceTracker
+
+
+async def _users(db, n):
+    return [await db.create_user(f"p{i}", "pw") for i in range(n)]
+
+
+async def _online(db, user_id):
+    db.users_by_id.clear()
+    return (await db.get_user_by_id(user_id)).is_online
+
+
+def test_changes_are_written_in_one_batch(with_db):
+    async def run(db):
+        a, b, c = await _users(db, 3)
+        tracker = PresenceTracker(db)
+        batches = []
+        write = db.bulk_update_presence
+
+        async def counting(rows):
+            batches.append(len(rows))
+            await write(rows)
+
+        db.bulk_update_presence = counting
+        for _ in range(10):
+            tracker.touch(a.id)
+        tracker.connect(b.id)
+        # nothing is written before the flush
+        assert not await _online(db, a.id)
+
+        await tracker.flush()
+        assert batches == [2]
+        assert await _online(db, a.id) and await _online(db, b.id)
+        assert not await _online(db, c.id)
+
+        await tracker.flush()
+        assert batches == [2]
+
+    with_db(run)
+
+
+def test_offline_after_last_socket_and_forgotten_after_flush(with_db):
+    async def run(db):
+        (a,) = await _users(db, 1)
+        tracker = PresenceTracker(db)
+        tracker.connect(a.id)
+        tracker.connect(a.id)
+        await tracker.disconnect(a.id)
+        assert tracker.get(a.id)[0]
+
+        await tracker.disconnect(a.id)
+        assert tracker.get(a.id)[0] is False
+        await tracker.flush()
+        assert not await _online(db, a.id)
+        assert tracker.get(a.id) is None
+
+    with_db(run)
+
+
+def test_sweep_expires_sessions_without_a_socket(with_db):
+    async def run(db):
+        a, b = await _users(db, 2)
+        tracker = PresenceTracker(db, timeout=60)
+        changes = []
+        tracker.listeners.append(lambda user_id, online: changes.append((user_id, online)))
+        tracker.touch(a.id)
+        tracker.connect(b.id)
+        long_ago = datetime.utcnow() - timedelta(minutes=5)
+        tracker.state = {user_id: (True, long_ago) for user_id in tracker.state}
+
+        await tracker.sweep()
+        assert tracker.get(a.id)[0] is False
+        assert tracker.get(b.id)[0] is True
+        assert changes[-1] == (a.id, False)
+
+    with_db(run)
+
+
+def test_users_with_a_websocket_on_another_worker_are_left_to_it(with_db):
+    async def run(db):
+        a, b, c = await _users(db, 3)
+        remote = {a.id, b.id}
+
+        async def elsewhere(user_ids):
+            return remote & set(user_ids)
+
+        tracker = PresenceTracker(db, elsewhere, timeout=60)
+        changes = []
+        tracker.listeners.append(lambda user_id, online: changes.append((user_id, online)))
+        # a and c only made requests here, b closed one of two websockets
+        tracker.touch(a.id)
+        tracker.touch(c.id)
+        tracker.connect(b.id)
+        await tracker.flush()
+        long_ago = datetime.utcnow() - timedelta(minutes=5)
+        tracker.state = {user_id: (True, long_ago) for user_id in tracker.state}
+        changes.clear()
+
+        await tracker.disconnect(b.id)
+        await tracker.sweep()
+        assert changes == [(c.id, False)]
+        assert tracker.get(a.id) is None and tracker.get(b.id) is None
+        await tracker.flush()
+        assert await _online(db, a.id) and await _online(db, b.id)
+        assert not await _online(db, c.id)
+
+    with_db(run)
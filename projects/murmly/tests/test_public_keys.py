@@ -0,0 +1,112 @@
+import pytest
+
+import crypto_utils
+import client as client_module
+from config import PUBLIC_KEY_BATCH_MAX
+
+
+@pytest.fixture
+def upload_key(client, dh_parameters):
+    def upload(user) -> str:
+        _, public_key = crypto_utils.generate_pair(dh_parameters)
+        serialized = crypto_utils.serialize_pub_key(public_key).decode()
+        assert client.put("/update_public_key", json={"public_key": serialized}, headers=user.headers).status_code == 200
+        return serialized
+
+    return upload
+
+
+def test_single_key_status_codes(client, make_user, upload_key):
+    me, peer, keyless = make_user(), make_user(), make_user()
+    # own key before uploading one is still forbidden, not missing
+    assert client.get(f"/users/{me.id}/public_key", headers=me.headers).status_code == 403
+    assert client.get("/users/999999/public_key", headers=me.headers).status_code == 404
+    response = client.get(f"/users/{keyless.id}/public_key", headers=me.headers)
+    assert response.status_code == 404 and response.json()["detail"] == "Public key not found for user"
+
+    key = upload_key(peer)
+    response = client.get(f"/users/{peer.id}/public_key", headers=me.headers)
+    assert response.json() == {"username": peer.username, "public_key": key}
+    etag = response.headers["ETag"]
+    assert client.get(
+        f"/users/{peer.id}/public_key", headers={**me.headers, "If-None-Match": etag}
+    ).status_code == 304
+
+
+def test_batch_forbids_the_own_key_like_the_single_endpoint(client, make_user, upload_key):
+    me, peer = make_user(), make_user()
+    upload_key(me)
+    upload_key(peer)
+    response = client.get("/users/public_keys", params=[("ids", peer.id), ("ids", me.id)], headers=me.headers)
+    assert response.status_code == 403
+    assert client.get(f"/users/{me.id}/public_key", headers=me.headers).status_code == 403
+    response = client.get("/users/public_keys", params=[("ids", peer.id)], headers=me.headers)
+    assert [k["id"] for k in response.json()["keys"]] == [peer.id]
+
+
+def test_batch_etag_known_versions_and_invalidation(client, make_user, upload_key):
+    me, a, b, keyless = make_user(), make_user(), make_user(), make_user()
+    upload_key(a)
+    upload_key(b)
+    params = [("ids", a.id), ("ids", b.id), ("ids", keyless.id)]
+
+    response = client.get("/users/public_keys", params=params, headers=me.headers)
+    data = response.json()
+    assert data["missing"] == [keyless.id]
+    versions = {k["id"]: k["version"] for k in data["keys"]}
+    assert all("public_key" in k for k in data["keys"])
+    etag = response.headers["ETag"]
+    assert client.get(
+        "/users/public_keys", params=params, headers={**me.headers, "If-None-Match": etag}
+    ).status_code == 304
+
+    known = [("known", f"{i}:{v}") for i, v in versions.items()]
+    data = client.get("/users/public_keys", params=params + known, headers=me.headers).json()
+    assert not any("public_key" in k for k in data["keys"])
+
+    # a new key drops the cached one, the version and the ETag change
+    new_key = upload_key(a)
+    response = client.get(
+        "/users/public_keys", params=params + known, headers={**me.headers, "If-None-Match": etag}
+    )
+    assert response.status_code == 200 and response.headers["ETag"] != etag
+    changed = {k["id"]: k for k in response.json()["keys"]}
+    assert changed[a.id]["public_key"] == new_key and changed[a.id]["version"] != versions[a.id]
+    assert "public_key" not in changed[b.id]
+
+
+def test_too_many_ids_are_rejected(client, make_user):
+    me = make_user()
+    params = [("ids", i) for i in range(PUBLIC_KEY_BATCH_MAX + 1)]
+    assert client.get("/users/public_keys", params=params, headers=me.headers).status_code == 400
+
+
+def test_client_revalidates_and_ends_channels_on_a_new_key(client, make_user, upload_key, chat_client, monkeypatch):
+    me, peer = make_user(), make_user()
+    upload_key(peer)
+    chat = chat_client(me)
+    requests_made = []
+    monkeypatch.setattr(
+        client_module.requests, "get", lambda url, **kw: requests_made.append(kw) or client.get(url, **kw)
+    )
+
+    # snapshot prefetches the keys of everyone online in one request
+    chat.on_message(None, '{"type": "presence_snapshot", "users": [{"id": %d, "username": "x"}]}' % peer.id)
+    assert len(requests_made) == 1 and peer.id in chat.peer_keys
+    assert chat.establish_sec_channel(peer.id)
+    assert len(requests_made) == 1
+
+    # older than PEER_KEY_MAX_AGE: asked again with the known version
+    version, key, fetched = chat.peer_keys[peer.id]
+    chat.peer_keys[peer.id] = (version, key, fetched - client_module.PEER_KEY_MAX_AGE - 1)
+    assert chat.get_public_key_user(peer.id) is key
+    assert ("known", f"{peer.id}:{version}") in requests_made[-1]["params"]
+    assert peer.id in chat.session_keys
+
+    # the peer reconnects with a new key, the channel is re-established
+    upload_key(peer)
+    chat.on_message(
+        None, '{"type": "presence", "online": [{"id": %d, "username": "x"}], "offline": []}' % peer.id
+    )
+    assert peer.id not in chat.session_keys
+    assert chat.peer_keys[peer.id][0] != version
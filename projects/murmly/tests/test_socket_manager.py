@@ -0,0 +1,212 @@
+import asyncio
+from types import SimpleNamespace
+
+from socket_manager import SocketManager
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.scope = {"subprotocols": []}
+        self.state = SimpleNamespace()
+        self.sent = []
+        self.closed = None
+        # cleared to stall the client
+        self.readable = asyncio.Event()
+        self.readable.set()
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_json(self, message):
+        await self.readable.wait()
+        self.sent.append(message)
+
+    async def close(self, code=1000):
+        self.closed = code
+
+    def chat_ids(self):
+        """Ids of the chat messages in the order the client got them."""
+        ids = []
+        for frame in self.sent:
+            messages = frame["messages"] if frame.get("type") == "pending_messages" else [frame]
+            ids += [m["id"] for m in messages if "id" in m]
+        return ids
+
+
+class PendingStore:
+    """The pending_deliveries table of one user."""
+
+    def __init__(self, manager: SocketManager):
+        self.manager = manager
+        self.rows: list[tuple[int, dict]] = []
+        manager.start(self.spill, self.redeliver)
+
+    async def spill(self, user_id, message):
+        self.rows.append((len(self.rows) + 1, message))
+
+    async def redeliver(self, websocket, user, after_id):
+        rows = [(pending_id, m) for pending_id, m in self.rows if pending_id > after_id]
+        if not rows:
+            return after_id
+        await self.manager.send_to(websocket, {"type": "pending_messages", "messages": [m for _, m in rows]})
+        return rows[-1][0]
+
+
+async def _connect(manager, user_id=1):
+    websocket = FakeWebSocket()
+    connection = await manager.connect(websocket, SimpleNamespace(id=user_id, username=f"u{user_id}"))
+    await connection.redeliver()
+    return websocket, connection
+
+
+async def _drain(connection):
+    while not connection.queue.empty() or connection.sending is not None or connection.spilled:
+        await asyncio.sleep(0.01)
+
+
+def test_spilled_messages_keep_their_order():
+    async def main():
+        manager = SocketManager(queue_size=1, policy="spill")
+        PendingStore(manager)
+        websocket, connection = await _connect(manager)
+        websocket.readable.clear()
+
+        await manager.send(1, {"id": 1})
+        await asyncio.sleep(0.01)  # the writer is stuck sending 1
+        await manager.send(1, {"id": 2})
+        await manager.send(1, {"id": 3})  # queue full, spilled
+        assert connection.spilled
+        await manager.send(1, {"id": 4})  # would overtake 3 in the queue
+        assert connection.queue.qsize() == 1
+        await manager.send(1, {"type": "presence", "online": True})  # not a chat message, queued
+        websocket.readable.set()
+        await _drain(connection)
+
+        await manager.send(1, {"id": 5})
+        await _drain(connection)
+        assert websocket.chat_ids() == [1, 2, 3, 4, 5]
+        await manager.stop()
+
+    asyncio.run(main())
+
+
+def test_pending_messages_are_not_resent_on_the_same_socket():
+    async def main():
+        manager = SocketManager(queue_size=1, policy="spill")
+        store = PendingStore(manager)
+        await store.spill(1, {"id": 1})  # arrived while offline, never acknowledged
+        websocket, connection = await _connect(manager)
+        assert websocket.chat_ids() == [1]
+        assert not connection.spilled
+
+        # sent while the pending messages of the connect are read
+        await connection.spill({"id": 2})
+        await connection.redeliver()
+        await _drain(connection)  # the writer took its wake up out of the queue
+        websocket.readable.clear()
+        await manager.send(1, {"id": 3})
+        await asyncio.sleep(0.01)
+        await manager.send(1, {"id": 4})
+        await manager.send(1, {"id": 5})
+        websocket.readable.set()
+        await _drain(connection)
+        assert websocket.chat_ids() == [1, 2, 3, 4, 5]
+
+        # a new socket gets everything unacknowledged again
+        websocket, _ = await _connect(manager)
+        assert websocket.chat_ids() == [1, 2, 5]
+        await manager.stop()
+
+    asyncio.run(main())
+
+
+def test_messages_wait_for_the_pending_messages_of_the_connect():
+    async def main():
+        manager = SocketManager(queue_size=4, policy="spill")
+        store = PendingStore(manager)
+        await store.spill(1, {"id": 1})
+        connection = await manager.connect(FakeWebSocket(), SimpleNamespace(id=1, username="u1"))
+        # before the handler sent the pending messages
+        await manager.send(1, {"id": 2})
+        await connection.redeliver()
+        await _drain(connection)
+        assert connection.websocket.chat_ids() == [1, 2]
+        await manager.stop()
+
+    asyncio.run(main())
+
+
+def test_reconnect_closes_the_replaced_connection():
+    async def main():
+        manager = SocketManager(queue_size=4, policy="spill")
+        PendingStore(manager)
+        old_socket, old = await _connect(manager)
+        old_socket.readable.clear()
+        for i in range(1, 4):
+            await manager.send(1, {"id": i})
+        await asyncio.sleep(0.01)
+
+        new_socket, new = await _connect(manager)
+        assert old.task.done()
+        # 1 was being sent, the client may not have it
+        assert new_socket.chat_ids() == [1, 2, 3]
+        # the old handler finishing does not touch the new connection
+        await manager.remove(SimpleNamespace(id=1, username="u1"), old_socket)
+        assert manager.connections[1] is new
+        await manager.stop()
+        assert new.task.done()
+
+    asyncio.run(main())
+
+
+def test_full_queue_policies():
+    async def main():
+        for policy in ("drop", "disconnect"):
+            manager = SocketManager(queue_size=1, policy=policy)
+            store = PendingStore(manager)
+            websocket, connection = await _connect(manager)
+            websocket.readable.clear()
+            await manager.send(1, {"id": 1})
+            await asyncio.sleep(0.01)
+            await manager.send(1, {"id": 2})
+            assert await manager.send(1, {"id": 3})
+
+            if policy == "drop":
+                assert store.rows == [] and manager.is_connected(1)
+                websocket.readable.set()
+                await _drain(connection)
+                assert websocket.chat_ids() == [1, 2]
+            else:
+                assert not manager.is_connected(1)
+                await asyncio.sleep(0.01)
+                # everything the client may not have waits for the reconnect
+                assert websocket.closed == 1013
+                assert sorted(m["id"] for _, m in store.rows) == [1, 2, 3]
+            await manager.stop()
+
+    asyncio.run(main())
+
+
+def test_queue_metrics_are_aggregated(client):
+    async def main():
+        manager = SocketManager(queue_size=4, policy="spill")
+        PendingStore(manager)
+        assert manager.queue_depths() == [] and manager.spilled_count() == 0
+        websocket, connection = await _connect(manager, 1)
+        await _connect(manager, 2)
+        websocket.readable.clear()
+        for i in range(3):
+            await manager.send(1, {"id": i})
+        await asyncio.sleep(0.01)
+        assert sorted(manager.queue_depths()) == [0, 2]
+        assert manager.spilled_count() == 0
+        websocket.readable.set()
+        await manager.stop()
+
+    asyncio.run(main())
+
+    text = client.get("/metrics").text
+    assert "murmly_send_queue_depth_max " in text
+    assert "murmly_send_queue_depth_total " in text
+    assert "murmly_send_queue_spilled " in text
+    assert 'murmly_send_queue_depth{' not in text
@@ -0,0 +1,44 @@
+def test_pages_follow_the_cursor(client, make_user):
+    me, a, b, c = make_user(), make_user(), make_user(), make_user()
+
+    response = client.get("/users/online", params={"limit": 2, "cursor": a.id - 1}, headers=me.headers)
+    assert [u["id"] for u in response.json()] == [a.id, b.id]
+    assert response.headers["X-Next-Cursor"] == str(b.id)
+
+    response = client.get(
+        "/users/online", params={"limit": 2, "cursor": response.headers["X-Next-Cursor"]}, headers=me.headers
+    )
+    assert [u["id"] for u in response.json()] == [c.id]
+    assert "X-Next-Cursor" not in response.headers
+
+
+def test_without_limit_every_other_user_is_listed(client, make_user):
+    me, other = make_user(), make_user()
+    ids = [u["id"] for u in client.get("/users/online", headers=me.headers).json()]
+    assert other.id in ids
+    assert me.id not in ids
+    assert ids == sorted(ids)
+
+
+def test_last_message_per_peer(client, make_user):
+    me, peer, silent = make_user(), make_user(), make_user()
+    with client.websocket_connect(f"/ws/{me.token}") as ws:
+        for text in ("first", "second"):
+            ws.send_json({"recipient": {"id": peer.id, "username": peer.username}, "content": text})
+            assert ws.receive_json()["queued"]
+
+    users = {u["id"]: u for u in client.get("/users/online", params={"cursor": peer.id - 1}, headers=me.headers).json()}
+    assert users[peer.id]["last_message"]["content"] == "second"
+    assert users[peer.id]["last_message"]["is_mine"]
+    assert users[silent.id]["last_message"] is None
+
+    theirs = {u["id"]: u for u in client.get("/users/online", params={"cursor": me.id - 1}, headers=peer.headers).json()}
+    assert theirs[me.id]["last_message"]["is_mine"] is False
+
+
+def test_browsers_may_read_the_cursor(client, make_user):
+    me = make_user()
+    response = client.get(
+        "/users/online", params={"limit": 1}, headers={**me.headers, "Origin": "https://chat.example"}
+    )
+    assert "X-Next-Cursor" in response.headers["Access-Control-Expose-Headers"]